@@ -1,23 +1,74 @@
 // 標準入出力によるプロセス間通信によりシミュレータを公開
-// chunk単位をjsonシリアライズして1行で送受信
+// 1プロセスで複数のバトルを並行して扱うため、chunkにバトルIDを付けた[battle_id, chunk]をjsonシリアライズして1行で送受信
+// --binary オプション指定時は、長さ付きのバイナリフレームで送受信する
+// フレーム: ペイロード長(uint32 LE), バトルID(uint32 LE), chunkの種類(uint8), ペイロード(UTF-8)
+// chunkの種類: 0=update, 1=sideupdate, 2=end (入力方向はコマンドのみなので常に0)
+// ペイロードはchunkの種類の行を除いた残りをそのまま格納する(requestのjsonが二重にエスケープされない)
 
 const bs = require('../Pokemon-Showdown/.sim-dist/battle-stream');
 const BattleStream = bs.BattleStream;
 
-// keepAlive: 複数回バトルを行えるようにする(デフォルトではバトルが終了するとストリームが閉じられる)
-const stream = new BattleStream({ debug: false, keepAlive: true });
+const binaryMode = process.argv.includes('--binary');
+const HEADER_SIZE = 9;
+const CHUNK_TYPES = ['update', 'sideupdate', 'end'];
 
-const reader = require('readline').createInterface({
-    input: process.stdin,
-    output: process.stdout
-});
-reader.on('line', function (line) {
-    stream.write(JSON.parse(line));
-});
+function writeFrame(battleId, chunk) {
+    const sep = chunk.indexOf('\n');
+    const chunkType = CHUNK_TYPES.indexOf(sep >= 0 ? chunk.slice(0, sep) : chunk);
+    const payload = Buffer.from(sep >= 0 ? chunk.slice(sep + 1) : '', 'utf8');
+    const header = Buffer.alloc(HEADER_SIZE);
+    header.writeUInt32LE(payload.length, 0);
+    header.writeUInt32LE(battleId, 4);
+    header.writeUInt8(chunkType, 8);
+    process.stdout.write(Buffer.concat([header, payload]));
+}
 
-(async () => {
-    let chunk;
-    while (chunk = await stream.read()) {
-        process.stdout.write(JSON.stringify(chunk) + '\n');
+// バトルIDごとのストリーム
+// keepAliveなしなので、バトルが終了する(endを出力する)とストリームが閉じられ、ここから削除される
+const streams = new Map();
+
+function getStream(battleId) {
+    let stream = streams.get(battleId);
+    if (!stream) {
+        stream = new BattleStream({ debug: false });
+        streams.set(battleId, stream);
+        (async () => {
+            let chunk;
+            while (chunk = await stream.read()) {
+                if (binaryMode) {
+                    writeFrame(battleId, chunk);
+                } else {
+                    process.stdout.write(JSON.stringify([battleId, chunk]) + '\n');
+                }
+            }
+            streams.delete(battleId);
+        })();
     }
-})();
+    return stream;
+}
+
+if (binaryMode) {
+    let buffer = Buffer.alloc(0);
+    process.stdin.on('data', function (data) {
+        buffer = buffer.length > 0 ? Buffer.concat([buffer, data]) : data;
+        while (buffer.length >= HEADER_SIZE) {
+            const length = buffer.readUInt32LE(0);
+            if (buffer.length < HEADER_SIZE + length) {
+                break;
+            }
+            const battleId = buffer.readUInt32LE(4);
+            const chunk = buffer.toString('utf8', HEADER_SIZE, HEADER_SIZE + length);
+            buffer = buffer.subarray(HEADER_SIZE + length);
+            getStream(battleId).write(chunk);
+        }
+    });
+} else {
+    const reader = require('readline').createInterface({
+        input: process.stdin,
+        output: process.stdout
+    });
+    reader.on('line', function (line) {
+        const [battleId, chunk] = JSON.parse(line);
+        getStream(battleId).write(chunk);
+    });
+}
@@ -45,19 +45,34 @@ const reader = require('readline').createInterface({
     input: process.stdin,
     output: process.stdout
 });
-reader.on('line', async function (line) {
-    const request = JSON.parse(line);
-    const method = methods[request['method']];
+async function callMethod(methodName, params) {
+    const method = methods[methodName];
     let result = null;
     let error = null;
     if (method) {
         try {
-            result = await method(request['params']);
+            result = await method(params);
         } catch (ex) {
             error = ex;
         }
     } else {
-        error = { 'message': `No method named ${request['method']}` };
+        error = { 'message': `No method named ${methodName}` };
+    }
+    return { result, error };
+}
+
+reader.on('line', async function (line) {
+    const request = JSON.parse(line);
+    let response;
+    if ('params_list' in request) {
+        // 一括呼び出し: 各paramsに対する{ result, error }のリストをresultとして返す
+        const results = [];
+        for (const params of request['params_list']) {
+            results.push(await callMethod(request['method'], params));
+        }
+        response = { result: results, error: null };
+    } else {
+        response = await callMethod(request['method'], request['params']);
     }
-    process.stdout.write(JSON.stringify({ result, error }) + '\n');
+    process.stdout.write(JSON.stringify(response) + '\n');
 });
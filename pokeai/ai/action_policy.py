@@ -1,14 +1,20 @@
 """
 行動選択AIのベースクラス
 """
+import random
+
 from pokeai.ai.battle_status import BattleStatus
 
 
 class ActionPolicy:
     train: bool
+    rng: random.Random  # 行動選択に用いる乱数生成器。シード付きのバトルではBattleStreamProcessorが設定する
+    # Trueの場合、BattleStreamProcessorはbattle_status.state_featureに差分更新する状態特徴量を設定する
+    use_state_feature_buffer = False
 
     def __init__(self):
         self.train = False
+        self.rng = random  # 未設定の場合は標準のrandomモジュール(random, choiceを同様に持つ)
 
     def game_start(self):
         """
@@ -42,3 +48,11 @@ class ActionPolicy:
         :return:
         """
         pass
+
+    def game_abort(self):
+        """
+        シミュレータの異常などでゲームが途中で打ち切られた時に呼び出される
+        同じゲームが最初からやり直されることがある
+        :return:
+        """
+        pass
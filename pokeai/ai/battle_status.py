@@ -1,60 +1,141 @@
 """
 バトルの状態を表すオブジェクト
 あるプレイヤーから見た状態を管理する
+
+多数のバトルを同時に進行させるため、各クラスは__slots__を持ち、状態異常・状態変化・場の状態を整数で保持する
+snapshot()の戻り値は不変な値のみからなるタプルで、restore()で同じ状態に戻せる(行動選択ごとの記録や先読み探索用)
 """
 import json
 import re
-from typing import Dict, Set, Optional, Tuple
+import sys
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
 
 from pokeai.sim.party_generator import Party
 
 
+STATUS_NAMES = ['', 'psn', 'tox', 'par', 'brn', 'slp', 'frz', 'fnt']  # 状態異常。コードはこのリストのインデックス
+STATUS_CODES = {name: code for code, name in enumerate(STATUS_NAMES)}
+_HP_CONDITION_PATTERN = re.compile('^(\\d+)/(\\d+)(?: (psn|tox|par|brn|slp|frz|fnt)|)?$')
+# 例外的な種族名 'Nidoran-F', 'Porygon2', 'Mr. Mime', "Farfetch'd"
+_DETAILS_PATTERN = re.compile('^([A-Za-z-]+|Porygon2|Mr\\. Mime|Farfetch\'d), L(\\d+)(?:, (M|F|N))?$')
+# 解析結果のキャッシュ。detailsは同じ文字列がバトル中・バトル間で繰り返し現れる
+# HPも相手側は100分率の表示なので種類が限られる
+_PARSE_CACHE_SIZE = 10000
+_details_cache = {}  # type: Dict[str, Tuple[str, int, str]]
+_hp_condition_cache = {}  # type: Dict[str, Tuple[int, int, int]]
+
+
+def parse_hp_condition_code(hp_condition: str) -> Tuple[int, int, int]:
+    """
+    HPと状態異常を表す文字列のパース
+    :param hp_condition: '50/200' (現在HP=50, 最大HP=200, 状態異常なし) or '50/200 psn' (状態異常の時)
+    :return: 現在HP, 最大HP, 状態異常のコード(STATUS_NAMESのインデックス)
+    """
+    parsed = _hp_condition_cache.get(hp_condition)
+    if parsed is None:
+        if hp_condition == '0 fnt':
+            # 瀕死の時は0という表示になっている
+            # 便宜上最大HP100として返している
+            parsed = 0, 100, STATUS_CODES['fnt']
+        else:
+            m = _HP_CONDITION_PATTERN.match(hp_condition)
+            assert m is not None, f"HP_CONDITION '{hp_condition}' cannot be parsed."
+            # m[3]は状態異常がないときNoneとなる
+            parsed = int(m[1]), int(m[2]), STATUS_CODES[m[3] or '']
+        if len(_hp_condition_cache) >= _PARSE_CACHE_SIZE:
+            _hp_condition_cache.clear()
+        _hp_condition_cache[hp_condition] = parsed
+    return parsed
+
+
 def parse_hp_condition(hp_condition: str) -> Tuple[int, int, str]:
     """
     HPと状態異常を表す文字列のパース
     :param hp_condition: '50/200' (現在HP=50, 最大HP=200, 状態異常なし) or '50/200 psn' (状態異常の時)
     :return: 現在HP, 最大HP, 状態異常('', 'psn'(毒), 'tox'(猛毒), 'par', 'brn', 'slp', 'frz', 'fnt'(瀕死))
     """
-    if hp_condition == '0 fnt':
-        # 瀕死の時は0という表示になっている
-        # 便宜上最大HP100として返している
-        return 0, 100, 'fnt'
-    m = re.match('^(\\d+)/(\\d+)(?: (psn|tox|par|brn|slp|frz|fnt)|)?$', hp_condition)
-    assert m is not None, f"HP_CONDITION '{hp_condition}' cannot be parsed."
-    # m[3]は状態異常がないときNoneとなる
-    return int(m[1]), int(m[2]), m[3] or ''
+    hp_current, hp_max, status_code = parse_hp_condition_code(hp_condition)
+    return hp_current, hp_max, STATUS_NAMES[status_code]
 
 
 def _parse_details(details: str) -> Tuple[str, int, str]:
     """
     ポケモンの情報をパース
     :param details: 種族名・レベル・性別情報　例:'Ninetales, L50, M'
-    :return:
+    :return: 種族名(intern済み), レベル, 性別
+    """
+    parsed = _details_cache.get(details)
+    if parsed is None:
+        m = _DETAILS_PATTERN.match(details)
+        assert m is not None, f"DETAILS '{details}' cannot be parsed."
+        # 性別不明だとm[3]はNone
+        parsed = sys.intern(m[1]), int(m[2]), m[3] or 'N'
+        if len(_details_cache) >= _PARSE_CACHE_SIZE:
+            _details_cache.clear()
+        _details_cache[details] = parsed
+    return parsed
+
+
+RANK_NAMES = ('atk', 'def', 'spa', 'spd', 'spe', 'accuracy', 'evasion')
+RANK_INDEXES = {name: i for i, name in enumerate(RANK_NAMES)}
+
+
+class FlagRegistry:
+    """
+    状態名と、ビットマスクのビットの対応
+    状態名の種類はメッセージに依存し事前に列挙しきれないので、未知の名前は初出時にビットを割り当てる
+    ビットの割り当てはプロセスごとに異なりうるため、pickleする際は名前に戻す
     """
-    # 例外的な種族名 'Nidoran-F', 'Porygon2', 'Mr. Mime', "Farfetch'd"
-    m = re.match('^([A-Za-z-]+|Porygon2|Mr\\. Mime|Farfetch\'d), L(\\d+)(?:, (M|F|N))?$', details)
-    assert m is not None, f"DETAILS '{details}' cannot be parsed."
-    # 性別不明だとm[3]はNone
-    return m[1], int(m[2]), m[3] or 'N'
+
+    def __init__(self, names: Iterable[str]):
+        self._bits = {}  # type: Dict[str, int]
+        self._names = []  # type: List[str]
+        for name in names:
+            self.bit(name)
+
+    def bit(self, name: str) -> int:
+        b = self._bits.get(name)
+        if b is None:
+            b = self._bits[name] = 1 << len(self._names)
+            self._names.append(name)
+        return b
+
+    def mask(self, names: Iterable[str]) -> int:
+        m = 0
+        for name in names:
+            m |= self.bit(name)
+        return m
+
+    def names(self, mask: int) -> List[str]:
+        return [name for i, name in enumerate(self._names) if mask >> i & 1]
+
+
+# 第2世代で生じる主なもの。これ以外も初出時に登録される
+volatile_registry = FlagRegistry(['Substitute', 'confusion', 'move: Leech Seed', 'Disable', 'Encore', 'Attract',
+                                  'Foresight', 'Nightmare', 'Curse', 'move: Bide', 'move: Focus Energy', 'Mimic',
+                                  'perish0', 'perish1', 'perish2', 'perish3'])
+side_condition_registry = FlagRegistry(['Reflect', 'move: Light Screen', 'Spikes', 'Safeguard'])
 
 
 class ActivePokeStatus:
     """
     場に出ているポケモンの状態
     """
-    RANK_INITIAL = {'atk': 0, 'def': 0, 'spa': 0, 'spd': 0, 'spe': 0, 'accuracy': 0, 'evasion': 0}
+    RANK_INITIAL = (0,) * len(RANK_NAMES)
     RANK_MAX = 6
     RANK_MIN = -6
     RANK_ZERO = 0
+    __slots__ = ['pokemon', 'species', 'level', 'gender', 'hp_current', 'hp_max', 'status_code', 'ranks',
+                 'volatile_mask']
     pokemon: str  # |switch|POKEMON|DETAILS|HP STATUSにおけるPOKEMON部分。例：'p1a: Ninetales'
     species: str  # 種族　例：'Ninetales'
     level: int
     gender: str
     hp_current: int
     hp_max: int
-    status: str  # 状態異常 (異常がない時は'')
-    ranks: Dict[str, int]
-    volatile_statuses: Set[str]  # 状態変化
+    status_code: int  # 状態異常のSTATUS_NAMESにおけるインデックス (異常がない時は0)
+    ranks: Tuple[int, ...]  # RANK_NAMESの順のランク補正
+    volatile_mask: int  # 状態変化(volatile_registryのビットマスク)
 
     def __init__(self, pokemon: str, species: str, level: int, gender: str, hp_current: int, hp_max: int, status: str):
         """
@@ -71,39 +152,106 @@ class ActivePokeStatus:
         self.gender = gender
         self.hp_current = hp_current
         self.hp_max = hp_max
-        self.status = status
-        self.ranks = ActivePokeStatus.RANK_INITIAL.copy()
-        self.volatile_statuses = set()
+        self.status_code = STATUS_CODES[status]
+        self.ranks = ActivePokeStatus.RANK_INITIAL
+        self.volatile_mask = 0
+
+    @property
+    def status(self) -> str:
+        """
+        状態異常 (異常がない時は'')
+        """
+        return STATUS_NAMES[self.status_code]
+
+    @status.setter
+    def status(self, value: str):
+        self.status_code = STATUS_CODES[value]
+
+    @property
+    def volatile_statuses(self) -> FrozenSet[str]:
+        """
+        状態変化の名前の集合
+        """
+        return frozenset(volatile_registry.names(self.volatile_mask))
+
+    def add_volatile(self, name: str):
+        self.volatile_mask |= volatile_registry.bit(name)
+
+    def discard_volatile(self, name: str):
+        self.volatile_mask &= ~volatile_registry.bit(name)
+
+    def get_rank(self, stat: str) -> int:
+        return self.ranks[RANK_INDEXES[stat]]
 
     def rank_boost(self, stat: str, amount: int):
-        self._rank_set_clip(stat, self.ranks[stat] + amount)
+        self._rank_set_clip(stat, self.get_rank(stat) + amount)
 
     def rank_unboost(self, stat: str, amount: int):
-        self._rank_set_clip(stat, self.ranks[stat] - amount)
+        self._rank_set_clip(stat, self.get_rank(stat) - amount)
 
     def rank_setboost(self, stat: str, amount: int):
         self._rank_set_clip(stat, amount)
 
     def _rank_set_clip(self, stat: str, value: int):
-        assert stat in self.ranks
-        self.ranks[stat] = min(max(value, ActivePokeStatus.RANK_MIN), ActivePokeStatus.RANK_MAX)
+        assert stat in RANK_INDEXES
+        ranks = list(self.ranks)
+        ranks[RANK_INDEXES[stat]] = min(max(value, ActivePokeStatus.RANK_MIN), ActivePokeStatus.RANK_MAX)
+        self.ranks = tuple(ranks)
 
     def rank_clearallboost(self):
-        for stat in self.ranks.keys():
-            self.ranks[stat] = ActivePokeStatus.RANK_ZERO
+        self.ranks = ActivePokeStatus.RANK_INITIAL
 
     @property
     def hp_ratio(self) -> float:
         return self.hp_current / self.hp_max
 
+    def snapshot(self) -> tuple:
+        return (self.pokemon, self.species, self.level, self.gender, self.hp_current, self.hp_max, self.status_code,
+                self.ranks, self.volatile_mask)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: tuple) -> "ActivePokeStatus":
+        poke = cls.__new__(cls)
+        poke.pokemon, poke.species, poke.level, poke.gender, poke.hp_current, poke.hp_max, poke.status_code, \
+            poke.ranks, poke.volatile_mask = snapshot
+        return poke
+
+    def to_dict(self) -> dict:
+        return {'pokemon': self.pokemon, 'species': self.species, 'level': self.level, 'gender': self.gender,
+                'hp_current': self.hp_current, 'hp_max': self.hp_max, 'status': self.status,
+                'ranks': dict(zip(RANK_NAMES, self.ranks)),
+                'volatile_statuses': volatile_registry.names(self.volatile_mask)}
+
+    def __getstate__(self):
+        # ビットマスクは名前に戻す
+        return self.snapshot()[:-1] + (tuple(volatile_registry.names(self.volatile_mask)),)
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            self.pokemon, self.species, self.level, self.gender, self.hp_current, self.hp_max, self.status_code, \
+                self.ranks, volatile_statuses = state
+            self.volatile_mask = volatile_registry.mask(volatile_statuses)
+            return
+        # 以前の辞書ベースの実装でpickleされたもの
+        self.pokemon = state['pokemon']
+        self.species = state['species']
+        self.level = state['level']
+        self.gender = state['gender']
+        self.hp_current = state['hp_current']
+        self.hp_max = state['hp_max']
+        self.status_code = STATUS_CODES[state['status']]
+        self.ranks = tuple(state['ranks'][stat] for stat in RANK_NAMES)
+        self.volatile_mask = volatile_registry.mask(state['volatile_statuses'])
+
 
 class SideStatus:
     """
     一方のプレイヤーの状態
     """
+    __slots__ = ['active', 'reserve_pokes', 'side_condition_mask', 'total_pokes', 'remaining_pokes']
     active: Optional[ActivePokeStatus]
     reserve_pokes: Dict[str, ActivePokeStatus]  # 控えのポケモンの交代直前の状態(瀕死状態のポケモンも含む)
-    side_statuses: Set[str]  # プレイヤーの場の状態
+    side_condition_mask: int  # プレイヤーの場の状態(side_condition_registryのビットマスク)
     total_pokes: int  # 全手持ちポケモン数
     remaining_pokes: int  # 残っているポケモン数
 
@@ -113,10 +261,26 @@ class SideStatus:
         """
         self.active = None
         self.reserve_pokes = {}
-        self.side_statuses = set()
+        self.side_condition_mask = 0
         self.total_pokes = 0
         self.remaining_pokes = 0
 
+    @property
+    def side_statuses(self) -> FrozenSet[str]:
+        """
+        プレイヤーの場の状態の名前の集合
+        """
+        return frozenset(side_condition_registry.names(self.side_condition_mask))
+
+    def add_side_condition(self, name: str):
+        self.side_condition_mask |= side_condition_registry.bit(name)
+
+    def remove_side_condition(self, name: str):
+        bit = side_condition_registry.bit(name)
+        if not self.side_condition_mask & bit:
+            raise KeyError(name)
+        self.side_condition_mask &= ~bit
+
     def switch(self, active: ActivePokeStatus):
         """
         ポケモンを交換、またはゲームの最初に繰り出す
@@ -149,15 +313,54 @@ class SideStatus:
         assert self.total_pokes > 0
         return self.remaining_pokes / self.total_pokes
 
+    def snapshot(self) -> tuple:
+        return (self.active.snapshot() if self.active is not None else None,
+                tuple(poke.snapshot() for poke in self.reserve_pokes.values()),
+                self.side_condition_mask, self.total_pokes, self.remaining_pokes)
+
+    def restore(self, snapshot: tuple):
+        active, reserve_pokes, self.side_condition_mask, self.total_pokes, self.remaining_pokes = snapshot
+        self.active = ActivePokeStatus.from_snapshot(active) if active is not None else None
+        self.reserve_pokes = {}
+        for poke_snapshot in reserve_pokes:
+            poke = ActivePokeStatus.from_snapshot(poke_snapshot)
+            self.reserve_pokes[poke.species] = poke
+
+    def to_dict(self) -> dict:
+        return {'active': self.active.to_dict() if self.active is not None else None,
+                'reserve_pokes': {species: poke.to_dict() for species, poke in self.reserve_pokes.items()},
+                'side_statuses': side_condition_registry.names(self.side_condition_mask),
+                'total_pokes': self.total_pokes,
+                'remaining_pokes': self.remaining_pokes}
+
+    def __getstate__(self):
+        return (self.active, self.reserve_pokes, tuple(side_condition_registry.names(self.side_condition_mask)),
+                self.total_pokes, self.remaining_pokes)
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            self.active, self.reserve_pokes, side_statuses, self.total_pokes, self.remaining_pokes = state
+            self.side_condition_mask = side_condition_registry.mask(side_statuses)
+            return
+        # 以前の辞書ベースの実装でpickleされたもの
+        self.active = state['active']
+        self.reserve_pokes = state['reserve_pokes']
+        self.side_condition_mask = side_condition_registry.mask(state['side_statuses'])
+        self.total_pokes = state['total_pokes']
+        self.remaining_pokes = state['remaining_pokes']
+
 
 class BattleStatus:
     WEATHER_NONE = 'none'
+    _STATE_SLOTS = ['turn', 'side_friend', 'side_opponent', 'side_party', 'weather', 'side_statuses']
+    __slots__ = _STATE_SLOTS + ['state_feature']
     turn: int  # ターン番号(最初が0)
     side_friend: str  # 自分側のside ('p1' or 'p2')
     side_opponent: str  # 相手側のside ('p1' or 'p2')
     side_party: Party  # 自分側のパーティ
     weather: str  # 天候（なしの時はWEATHER_NONE='none'）
     side_statuses: Dict[str, SideStatus]  # key: 'p1' or 'p2'
+    state_feature: Optional["StateFeatureBuffer"]  # BattleStreamProcessorが差分更新する状態特徴量(使わない場合None)
 
     def __init__(self, side_friend: str, side_party: Party):
         assert side_friend in ['p1', 'p2']
@@ -167,22 +370,53 @@ class BattleStatus:
         self.turn = 0
         self.weather = BattleStatus.WEATHER_NONE
         self.side_statuses = {'p1': SideStatus(), 'p2': SideStatus()}
+        self.state_feature = None
 
     def switch(self, pokemon: str, details: str, hp_condition: str):
         side = pokemon[:2]
         species, level, gender = _parse_details(details)
-        hp_current, hp_max, status = parse_hp_condition(hp_condition)
-        poke = ActivePokeStatus(pokemon, species, level, gender, hp_current, hp_max, status)
+        hp_current, hp_max, status_code = parse_hp_condition_code(hp_condition)
+        poke = ActivePokeStatus(pokemon, species, level, gender, hp_current, hp_max, STATUS_NAMES[status_code])
         self.side_statuses[side].switch(poke)
 
     def get_side(self, pokemon: str) -> SideStatus:
         return self.side_statuses[pokemon[:2]]
 
+    def snapshot(self) -> tuple:
+        """
+        現在の状態を不変な値のタプルとして取り出す
+        パーティなどバトル中に変化しない情報は含まない
+        :return:
+        """
+        return self.turn, self.weather, self.side_statuses['p1'].snapshot(), self.side_statuses['p2'].snapshot()
+
+    def restore(self, snapshot: tuple):
+        """
+        snapshot()の時点の状態に戻す
+        :param snapshot:
+        :return:
+        """
+        self.turn, self.weather, p1, p2 = snapshot
+        self.side_statuses['p1'].restore(p1)
+        self.side_statuses['p2'].restore(p2)
+        if self.state_feature is not None:
+            self.state_feature.refresh()
+
+    def to_dict(self) -> dict:
+        return {'side_friend': self.side_friend, 'side_opponent': self.side_opponent, 'side_party': self.side_party,
+                'turn': self.turn, 'weather': self.weather,
+                'side_statuses': {side: ss.to_dict() for side, ss in self.side_statuses.items()}}
+
     def json_dumps(self) -> str:
-        def default(obj):
-            if isinstance(obj, set):
-                return list(obj)
-            else:
-                return obj.__dict__
+        return json.dumps(self.to_dict())
+
+    def __getstate__(self):
+        # 状態特徴量は含めない
+        return tuple(getattr(self, slot) for slot in BattleStatus._STATE_SLOTS)
 
-        return json.dumps(self, default=default)
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = dict(zip(BattleStatus._STATE_SLOTS, state))
+        for slot in BattleStatus._STATE_SLOTS:
+            setattr(self, slot, state[slot])
+        self.state_feature = None
@@ -31,14 +31,16 @@ def main():
                     if cand_poke not in fix_species:
                         fix_species.append(cand_poke)
                 try:
-                    party = gen.generate(fix_species=fix_species)
+                    party = gen.generate(fix_species=fix_species, validate=False)
                     parties.append({'_id': ObjectId(), 'party': party, 'tags': tags})
                     break
                 except ValueError:
                     # 制約条件を満たせなかった場合（LV55でしか存在しないポケモンが複数いる場合）
                     continue
+        # パーティ全体の検証はまとめて行う
+        gen.validate_parties([doc['party'] for doc in parties])
     else:
-        parties = [{'_id': ObjectId(), 'party': gen.generate(), 'tags': tags} for _ in range(args.n)]
+        parties = [{'_id': ObjectId(), 'party': party, 'tags': tags} for party in gen.generate_many(args.n)]
     col_party.insert_many(parties)
 
 
@@ -0,0 +1,243 @@
+"""
+actor/learner分離による強化学習
+actorプロセス群が学習用エージェントで自己対戦を行って遷移を送り、learner(呼び出し元のプロセス)はそれを受け取りながら学習を続ける
+バトルと学習が並行して進むので、rl_trainの通常のモードのようにシミュレータと学習の一方が待つことがない
+
+モデルのパラメータは共有メモリ上のモデル(Trainer.agent_model)を介してactorに配る
+learnerはtarget_update回のoptimizeごとにそれを更新し、actorは次のバトルの開始時に自身のモデルに読み込む
+遷移はキューで送る。リプレイバッファがディスク上(MemmapReplayBuffer)でシャード数がactor数と等しい場合は、
+actorが自身のシャードに直接書き込み、learnerはサンプリングのみ行う
+"""
+import multiprocessing
+import queue
+import traceback
+from logging import getLogger
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import torch
+
+from pokeai.ai.generic_move_model.agent_train import AgentTrain
+from pokeai.ai.generic_move_model.memmap_replay_buffer import MemmapReplayBuffer
+from pokeai.ai.generic_move_model.replay_buffer import ReplayBufferItem
+from pokeai.ai.generic_move_model.trainer import Trainer
+from pokeai.ai.generic_move_model.versioned_model import VersionedModel
+from pokeai.ai.rl_policy import RLPolicy
+from pokeai.ai.surrogate_reward_config import SurrogateRewardConfig
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import Sim, BattleSpec
+
+logger = getLogger(__name__)
+
+
+class ActorResult(NamedTuple):
+    job_id: int
+    winner: str  # 'p1', 'p2', '' (forcetieで引き分けの時)
+    steps: int  # 両プレイヤーの遷移数の合計
+    replay: Optional[List[ReplayBufferItem]]  # 遷移。actorがリプレイバッファに直接書き込んだ場合はNone
+    weights_version: int  # バトルに用いたモデルのバージョン(learnerのupdate_steps)
+
+
+def _run_battles(sim: Sim, jobs: List[Tuple[int, List[Party]]], model: torch.nn.Module, trainer: Trainer,
+                 epsilon: float, surrogate_reward_config: SurrogateRewardConfig) -> List[Tuple[int, str, list]]:
+    specs = []
+    agents_list = []
+    for job_id, target_parties in jobs:
+        bsps = []
+        agents = []
+        for player in range(2):
+            agent = AgentTrain(model, trainer.feature_extractor, epsilon)
+            bsp = BattleStreamProcessor()
+            bsp.set_policy(RLPolicy(agent, surrogate_reward_config))
+            agents.append(agent)
+            bsps.append(bsp)
+        specs.append(BattleSpec(target_parties, bsps))
+        agents_list.append(agents)
+    battle_results = sim.run_multi(specs)
+    results = []
+    for (job_id, _), agents, battle_result in zip(jobs, agents_list, battle_results):
+        replay = []
+        for agent in agents:
+            replay.extend(agent._replay_buffer.buffer)
+        results.append((job_id, battle_result["winner"], replay))
+    return results
+
+
+def _actor_main(constructor_params: dict, shared_model: VersionedModel, shared_epsilon, job_queue, result_queue,
+                surrogate_reward_config: SurrogateRewardConfig, battles_per_actor: int, sim_kwargs: Dict[str, Any],
+                replay_buffer: Optional[MemmapReplayBuffer]):
+    # actorではモデルの推論のみ行う。多数のactorが並行するので、各プロセスのtorchのスレッドは1つとする
+    torch.set_grad_enabled(False)
+    torch.set_num_threads(1)
+    trainer = Trainer(**constructor_params)
+    model = trainer.model
+    model.eval()
+    version = -1
+    epsilon = 0.0
+    sim = Sim(**sim_kwargs)
+    while True:
+        item = job_queue.get()
+        if item is None:
+            break
+        items = [item]
+        # 1つのシミュレータで複数のバトルを並行して進める
+        while len(items) < battles_per_actor:
+            try:
+                item = job_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # 終了指示は他のactorのために戻す
+                job_queue.put(None)
+                break
+            items.append(item)
+        # バトル中にパラメータが書き換わらないよう、自身のモデルに読み込んで使う
+        pulled = shared_model.copy_to(model, version)
+        if pulled is not None:
+            version = pulled
+            epsilon = shared_epsilon.value
+        try:
+            results = _run_battles(sim, items, model, trainer, epsilon, surrogate_reward_config)
+        except Exception:
+            for job_id, _ in items:
+                result_queue.put((job_id, None, traceback.format_exc()))
+            # シミュレータの状態が不明なので作り直す
+            sim = Sim(**sim_kwargs)
+            continue
+        for job_id, winner, replay in results:
+            steps = len(replay)
+            if replay_buffer is not None:
+                replay_buffer.extend(replay)
+                replay = None
+            result_queue.put((job_id, ActorResult(job_id, winner, steps, replay, version), None))
+    if replay_buffer is not None:
+        replay_buffer.flush()
+
+
+class ActorLearner:
+    """
+    actorプロセス群の管理と、learner側の処理
+    submitでバトルを依頼し、receiveで結果を受け取ってリプレイバッファに追加し、learn_stepで学習を進める
+    """
+
+    def __init__(self, trainer: Trainer, n_actors: int, surrogate_reward_config: SurrogateRewardConfig,
+                 battles_per_actor: int = 1, sim_kwargs: Optional[Dict[str, Any]] = None):
+        """
+        actorプロセスを起動する
+        :param trainer: 学習するTrainer。このプロセスで学習を行う
+        :param n_actors: actorプロセス数
+        :param surrogate_reward_config:
+        :param battles_per_actor: 各actorが1つのシミュレータで同時に進行させるバトル数
+        :param sim_kwargs: actor内のSimの引数。Noneの場合read_timeoutのみ設定する(SimPoolと同様)
+        """
+        if sim_kwargs is None:
+            sim_kwargs = {'read_timeout': 60.0}
+        self.trainer = trainer
+        # torchを使うためforkではなくspawnを用いる
+        ctx = multiprocessing.get_context("spawn")
+        self._shared_epsilon = ctx.Value('d', trainer.current_epsilon, lock=False)
+        self.publish()
+        self._job_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+        self.n_pending = 0
+        # ディスク上のリプレイバッファで、actorごとのシャードがあれば直接書き込ませる
+        # learnerが追加を行うシャード0もactorに割り当てる(learnerのシャードが空のままだと容量が減る)
+        replay_buffer = trainer.replay_buffer
+        direct_replay = False
+        if isinstance(replay_buffer, MemmapReplayBuffer):
+            direct_replay = replay_buffer.n_shards == n_actors
+            if not direct_replay and replay_buffer.n_shards > 1:
+                logger.warning(f"replay buffer has {replay_buffer.n_shards} shards for {n_actors} actors; "
+                               f"transitions are sent to the learner and only shard {replay_buffer.shard} is used. "
+                               f"set replay_buffer_shards to {n_actors} to let actors write directly")
+        self._actors = []
+        for actor_idx in range(n_actors):
+            actor = ctx.Process(target=_actor_main,
+                                args=(trainer.constructor_params, trainer.agent_model, self._shared_epsilon,
+                                      self._job_queue,
+                                      self._result_queue, surrogate_reward_config, battles_per_actor, sim_kwargs,
+                                      replay_buffer.for_shard(actor_idx) if direct_replay else None),
+                                daemon=True)
+            actor.start()
+            self._actors.append(actor)
+
+    def publish(self):
+        """
+        現在のモデルのパラメータをactorに配る
+        :return:
+        """
+        trainer = self.trainer
+        self._shared_epsilon.value = trainer.current_epsilon
+        trainer.agent_model.update(trainer.model, trainer.update_steps)
+
+    def submit(self, job_id: int, target_parties: List[Party]):
+        """
+        バトルを依頼する
+        :param job_id: receiveの結果に含まれる識別子
+        :param target_parties:
+        :return:
+        """
+        self._job_queue.put((job_id, target_parties))
+        self.n_pending += 1
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[ActorResult]:
+        """
+        終了したバトルの結果を1つ受け取り、遷移をリプレイバッファに追加する
+        :param timeout: 待つ最大秒数。0なら待たない
+        :return: 結果。timeoutまでに終了したバトルがなければNone
+        """
+        try:
+            if timeout == 0:
+                job_id, result, error = self._result_queue.get_nowait()
+            else:
+                job_id, result, error = self._result_queue.get(timeout=timeout)
+        except queue.Empty:
+            # actorが異常終了していると結果が返らず停止するので検出する
+            dead = [actor.pid for actor in self._actors if not actor.is_alive()]
+            if len(dead) > 0:
+                raise RuntimeError(f"actor processes {dead} exited unexpectedly")
+            return None
+        self.n_pending -= 1
+        if error is not None:
+            raise RuntimeError(f"battle job {job_id} failed in actor:\n" + error)
+        if result.replay is not None:
+            self.trainer.replay_buffer.extend(result.replay)
+        self.trainer.total_steps += result.steps
+        self.trainer.total_battles += 1
+        return result
+
+    def learn_step(self) -> bool:
+        """
+        学習を1ステップ進める。target_update回のoptimizeごとにパラメータをactorに配る
+        :return: 学習が追いついていて進めなかった場合False
+        """
+        trainer = self.trainer
+        if trainer.train(max_steps=1) == 0:
+            return False
+        if trainer.update_steps - trainer.agent_model.version >= trainer.optimize_per_steps * trainer.target_update:
+            self.publish()
+        return True
+
+    def close(self):
+        """
+        依頼済みのバトルの終了を待ってactorを終了する。受け取っていない結果は捨てる
+        :return:
+        """
+        for _ in self._actors:
+            self._job_queue.put(None)
+        for actor in self._actors:
+            # キューに結果を残したプロセスは終了しないので、読み捨てながら待つ
+            while actor.is_alive():
+                try:
+                    self._result_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            actor.join()
+        self._actors = []
+        self.n_pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,18 +1,42 @@
+import functools
 import json
 import logging
+import random
 from logging import getLogger
+from typing import List
+
 import numpy as np
 import torch
 
-from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor
+from pokeai import stage_timer
+from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor, SparseObsVector
+from pokeai.sim.decision_batcher import decision_batcher
 
 logger = getLogger(__name__)
 
 
+def forward_sparse_batch(model: torch.nn.Module, sparse_obs_list: List[SparseObsVector]) -> np.ndarray:
+    """
+    複数の観測のQ値をまとめて計算する
+    decision_batcherが任意のスレッドで呼ぶので、勾配計算の無効化はここで行う(torch.no_gradはスレッドごとの設定)
+    :param model:
+    :param sparse_obs_list:
+    :return: (len(sparse_obs_list), output_dim) float32
+    """
+    batch = FeatureExtractor.collate_sparse(sparse_obs_list)
+    with torch.no_grad():
+        return model.forward_sparse(torch.from_numpy(batch.state), torch.from_numpy(batch.choice_indices),
+                                    torch.from_numpy(batch.choice_offsets)).numpy()
+
+
 class Agent:
+    rng: random.Random  # ランダム行動に用いる乱数生成器。RLPolicyが設定する
+
     def __init__(self, model: torch.nn.Module, feature_extractor: FeatureExtractor):
         self._model = model
         self._feature_extractor = feature_extractor
+        self._forward_sparse_batch = functools.partial(forward_sparse_batch, model)
+        self.rng = random
 
     def act(self, obs: object, reward: float) -> int:
         raise NotImplementedError
@@ -20,17 +44,56 @@ class Agent:
     def stop_episode(self, reward: float) -> None:
         raise NotImplementedError
 
+    def abort_episode(self) -> None:
+        """
+        エピソードを途中で打ち切る
+        :return:
+        """
+        pass
+
+    def _transform(self, obs: object):
+        t = stage_timer.start()
+        obs_vector, action_mask = self._feature_extractor.transform(obs)
+        stage_timer.stop("agent.feature", t)
+        return obs_vector, action_mask
+
     def _calc_q_vector(self, obs_vector) -> np.ndarray:
         # GPUを使うなら入力を.to(device)し、出力を.cpu().numpy()とする
+        t = stage_timer.start()
         q_vector = self._model(torch.from_numpy(obs_vector[np.newaxis, ...])).numpy()[0]
+        stage_timer.stop("agent.forward", t)
+        return q_vector
+
+    def _transform_sparse(self, obs: object):
+        t = stage_timer.start()
+        sparse_obs, action_mask = self._feature_extractor.transform_sparse(obs)
+        stage_timer.stop("agent.feature", t)
+        return sparse_obs, action_mask
+
+    def _calc_q_vector_sparse(self, sparse_obs) -> np.ndarray:
+        t = stage_timer.start()
+        # Sim.run_multi(batch_decisions=True)で並行に処理中の他のバトルの計算と、モデルごとにまとめる
+        q_vector = decision_batcher.submit(self._model, self._forward_sparse_batch, sparse_obs)
+        stage_timer.stop("agent.forward", t)
         return q_vector
 
     def _calc_q_vector_batch(self, obs_vector_batch) -> np.ndarray:
+        t = stage_timer.start()
         q_vectors = self._model(torch.from_numpy(obs_vector_batch)).numpy()
+        stage_timer.stop("agent.forward_batch", t)
         return q_vectors
 
     def _act_by_model(self, obs_vector, action_mask) -> int:
-        q_vector = self._calc_q_vector(obs_vector)
+        """
+        モデルのQ値が最大の合法手を選ぶ
+        :param obs_vector: FeatureExtractor.transformまたはtransform_sparseの特徴量
+        :param action_mask:
+        :return:
+        """
+        if isinstance(obs_vector, SparseObsVector):
+            q_vector = self._calc_q_vector_sparse(obs_vector)
+        else:
+            q_vector = self._calc_q_vector(obs_vector)
         q_vector[action_mask == 0] = -np.inf
         action = int(np.argmax(q_vector))
         if logger.isEnabledFor(logging.DEBUG):
@@ -42,4 +105,4 @@ class Agent:
 
     def _act_random(self, obs_vector, action_mask) -> int:
         actions = np.flatnonzero(action_mask)
-        return int(np.random.choice(actions))
+        return int(self.rng.choice(actions))
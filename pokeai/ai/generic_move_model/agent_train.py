@@ -1,5 +1,3 @@
-import numpy as np
-
 from pokeai.ai.generic_move_model.agent import Agent
 from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor
 from pokeai.ai.generic_move_model.replay_buffer import ReplayBuffer, ReplayBufferItem
@@ -20,14 +18,16 @@ class AgentTrain(Agent):
         self._last_state = None
         self._last_action_mask = None
         self._last_action = 0
+        self._episode_items = 0  # 現在のエピソードでリプレイバッファに追加した要素数
 
     def act(self, obs: RLPolicyObservation, reward: float) -> int:
-        obs_vector, action_mask = self._feature_extractor.transform(obs)
+        obs_vector, action_mask = self._transform_sparse(obs)
         if self._last_state is not None:
             self._replay_buffer.append(
                 ReplayBufferItem(self._last_state, self._last_action_mask, self._last_action, obs_vector, action_mask,
                                  reward))
-        if np.random.random() < self._epsilon:
+            self._episode_items += 1
+        if self.rng.random() < self._epsilon:
             action = self._act_random(obs_vector, action_mask)
         else:
             action = self._act_by_model(obs_vector, action_mask)
@@ -42,3 +42,13 @@ class AgentTrain(Agent):
         self._last_state = None
         self._last_action_mask = None
         self._last_action = 0
+        self._episode_items = 0
+
+    def abort_episode(self) -> None:
+        # 打ち切られたエピソードの遷移は終端がないので学習に使わない
+        for _ in range(self._episode_items):
+            self._replay_buffer.buffer.pop()
+        self._last_state = None
+        self._last_action_mask = None
+        self._last_action = 0
+        self._episode_items = 0
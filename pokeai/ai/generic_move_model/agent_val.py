@@ -6,8 +6,9 @@ class AgentVal(Agent):
         super().__init__(model, feature_extractor)
 
     def act(self, obs: object, reward: float) -> int:
-        obs_vector, action_mask = self._feature_extractor.transform(obs)
-        action = self._act_by_model(obs_vector, action_mask)
+        # 学習用の記録が不要なので、密な特徴量を作らない
+        sparse_obs, action_mask = self._transform_sparse(obs)
+        action = self._act_by_model(sparse_obs, action_mask)
         return action
 
     def stop_episode(self, reward: float) -> None:
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, NamedTuple
 
 from pokeai.ai.battle_status import BattleStatus
 import numpy as np
@@ -7,6 +7,15 @@ from pokeai.ai.rl_policy_observation import RLPolicyObservation
 from pokeai.util import json_load, DATASET_DIR
 
 
+class SparseChoiceVec(NamedTuple):
+    """
+    選択肢の特徴量(値が0または1)の非ゼロ次元のみを保持する形式
+    選択肢iの非ゼロ次元は indices[offsets[i]:offsets[i+1]] (最後の選択肢は末尾まで)
+    """
+    indices: np.ndarray  # (非ゼロ要素数,) int64
+    offsets: np.ndarray  # (選択肢数,) int64
+
+
 class ChoiceToVec:
     """
     選択肢をベクトルに変換する特徴抽出器
@@ -59,3 +68,42 @@ class ChoiceToVec:
                 feat[n2d["move/" + possible_action.move], a_idx] = 1
             feat[n2d["item/" + possible_action.item], a_idx] = 1
         return feat
+
+    def transform_sparse(self, obs: RLPolicyObservation) -> SparseChoiceVec:
+        """
+        特徴抽出(非ゼロ次元のみ)
+        transformの結果の各列の非ゼロ次元と等しい
+        :return:
+        """
+        n2d = self.name_to_dim
+        indices = []
+        offsets = []
+        for possible_action in obs.possible_actions:
+            offsets.append(len(indices))
+            dims = set()
+            if possible_action.force_switch:
+                dims.add(n2d["force_switch"])
+            if possible_action.switch:
+                dims.add(n2d["switch"])
+                for move in possible_action.allMoves:
+                    dims.add(n2d["move/" + move])
+            else:
+                dims.add(n2d["move/" + possible_action.move])
+            dims.add(n2d["poke/" + possible_action.poke])
+            dims.add(n2d["item/" + possible_action.item])
+            indices.extend(sorted(dims))
+        return SparseChoiceVec(np.array(indices, dtype=np.int64), np.array(offsets, dtype=np.int64))
+
+    def to_dense(self, sparse: SparseChoiceVec, n_columns: int) -> np.ndarray:
+        """
+        transform_sparseの結果をtransformと同じ形式に変換する
+        :param sparse:
+        :param n_columns: 列数。選択肢数以上であること(余りの列は0)
+        :return: (self.get_dims(), n_columns) float32
+        """
+        feat = np.zeros((self.get_dims(), n_columns), dtype=np.float32)
+        n_items = len(sparse.offsets)
+        ends = np.append(sparse.offsets[1:], len(sparse.indices))
+        columns = np.repeat(np.arange(n_items), ends - sparse.offsets)
+        feat[sparse.indices, columns] = 1.0
+        return feat
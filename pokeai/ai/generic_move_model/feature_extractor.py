@@ -1,18 +1,43 @@
-from typing import Tuple
+from typing import List, NamedTuple, Tuple
 
 import numpy as np
 
 from pokeai.ai.state_feature_extractor import StateFeatureExtractor
-from pokeai.ai.generic_move_model.choice_to_vec import ChoiceToVec
+from pokeai.ai.generic_move_model.choice_to_vec import ChoiceToVec, SparseChoiceVec
 from pokeai.ai.rl_policy_observation import RLPolicyObservation
 
 
+class SparseObsVector(NamedTuple):
+    """
+    FeatureExtractor.transformの特徴量を、状態特徴量と選択肢特徴量の非ゼロ次元で表したもの
+    transformの特徴量は、全列に状態特徴量を並べ、その下に選択肢特徴量を置いた行列
+    """
+    state: np.ndarray  # (状態特徴次元,) float32
+    choice: SparseChoiceVec  # offsetsはoutput_dim個。合法手でない行動は空
+
+
+class SparseObsBatch(NamedTuple):
+    """
+    SparseObsVectorのバッチ。選択肢特徴量はtorch.nn.functional.embedding_bagの入力形式
+    """
+    state: np.ndarray  # (batch, 状態特徴次元) float32
+    choice_indices: np.ndarray  # (全非ゼロ要素数,) int64
+    choice_offsets: np.ndarray  # (batch * output_dim,) int64
+
+
 class FeatureExtractor:
     def __init__(self, party_size: int):
         self.party_size = party_size
         self.state_feature_extractor = StateFeatureExtractor(feature_types=None, party_size=self.party_size)
         self.choice_to_vec = ChoiceToVec()
 
+    @property
+    def state_dims(self) -> int:
+        """
+        入力特徴量のうち、状態特徴量の次元数(先頭に置かれる)
+        """
+        return self.state_feature_extractor.get_dims()
+
     @property
     def input_shape(self):
         """
@@ -50,3 +75,96 @@ class FeatureExtractor:
         choice_vec = np.zeros((self.output_dim,), dtype=np.int32)
         choice_vec[:len(obs.possible_actions)] = 1
         return feat, choice_vec
+
+    def transform_sparse(self, obs: RLPolicyObservation) -> Tuple[SparseObsVector, np.ndarray]:
+        """
+        観測を疎な形式の特徴量に変換
+        密な行列を確保しないので、transformより軽量
+        :param obs:
+        :return: 特徴量および合法手マスク((self.output_dim,), int32)
+        """
+        state_feat = self.state_feature_extractor.transform(obs)
+        choice = self.choice_to_vec.transform_sparse(obs)
+        # 合法手でない行動は空の選択肢とする
+        n_actions = len(obs.possible_actions)
+        offsets = np.full((self.output_dim,), len(choice.indices), dtype=np.int64)
+        offsets[:n_actions] = choice.offsets
+        choice_vec = np.zeros((self.output_dim,), dtype=np.int32)
+        choice_vec[:n_actions] = 1
+        return SparseObsVector(state_feat, SparseChoiceVec(choice.indices, offsets)), choice_vec
+
+    def densify(self, sparse: SparseObsVector) -> np.ndarray:
+        """
+        transform_sparseの特徴量を、transformの特徴量に変換
+        :param sparse:
+        :return: (self.input_shape, float32)
+        """
+        return self.densify_batch([sparse])[0]
+
+    def densify_batch(self, sparses: List[SparseObsVector]) -> np.ndarray:
+        """
+        transform_sparseの特徴量のリストを、transformの特徴量のバッチに変換
+        :param sparses:
+        :return: (len(sparses), *self.input_shape) float32
+        """
+        state_dims = self.state_dims
+        feat = np.zeros((len(sparses),) + self.input_shape, dtype=np.float32)
+        if len(sparses) == 0:
+            return feat
+        feat[:, :state_dims, :] = np.stack([sparse.state for sparse in sparses])[:, :, np.newaxis]
+        action_idxs = np.arange(self.output_dim)
+        for i, sparse in enumerate(sparses):
+            indices, offsets = sparse.choice
+            counts = np.diff(offsets, append=len(indices))
+            feat[i, state_dims + indices, np.repeat(action_idxs, counts)] = 1.0
+        return feat
+
+    def densify_padded(self, state: np.ndarray, choice: np.ndarray) -> np.ndarray:
+        """
+        状態特徴量と、行動ごとに幅を揃えた選択肢特徴量の非ゼロ次元(RingReplayBufferの形式)から、transformの特徴量のバッチを生成
+        :param state: (batch, self.state_dims) float32
+        :param choice: (batch, self.output_dim, 幅) 整数。余りは負の値
+        :return: (batch, *self.input_shape) float32
+        """
+        batch_size = len(state)
+        state_dims = self.state_dims
+        n_rows, n_columns = self.input_shape
+        # 余りの要素は末尾の1要素に書き込み、最後に捨てる
+        flat = np.zeros((batch_size * n_rows * n_columns + 1,), dtype=np.float32)
+        feat = flat[:-1].reshape((batch_size, n_rows, n_columns))
+        feat[:, :state_dims, :] = state[:, :, np.newaxis]
+        choice = choice.astype(np.int64)
+        flat_idxs = (np.arange(batch_size)[:, np.newaxis, np.newaxis] * n_rows + state_dims + choice) * n_columns + \
+                    np.arange(n_columns)[np.newaxis, :, np.newaxis]
+        flat[np.where(choice >= 0, flat_idxs, len(flat) - 1)] = 1.0
+        return feat
+
+    def sparsify(self, feat: np.ndarray) -> SparseObsVector:
+        """
+        transformの特徴量をtransform_sparseの形式に変換する(densifyの逆)
+        :param feat: (self.input_shape, float32)
+        :return:
+        """
+        state_dims = self.state_dims
+        # 列ごとの非ゼロ次元。np.nonzeroは行優先で走査するので、転置して列ごとにまとめる
+        actions, indices = np.nonzero(feat[state_dims:, :].T)
+        offsets = np.searchsorted(actions, np.arange(self.output_dim))
+        return SparseObsVector(feat[:state_dims, 0].copy(),
+                               SparseChoiceVec(indices.astype(np.int64), offsets.astype(np.int64)))
+
+    @staticmethod
+    def collate_sparse(sparses: List[SparseObsVector]) -> SparseObsBatch:
+        """
+        疎な形式の特徴量をバッチにまとめる
+        FeatureExtractorの設定によらないので、インスタンスを持たないプロセス(InferenceServer)からも呼べる
+        :param sparses:
+        :return:
+        """
+        offsets = []
+        base = 0
+        for sparse in sparses:
+            offsets.append(sparse.choice.offsets + base)
+            base += len(sparse.choice.indices)
+        return SparseObsBatch(np.stack([sparse.state for sparse in sparses]),
+                              np.concatenate([sparse.choice.indices for sparse in sparses]),
+                              np.concatenate(offsets))
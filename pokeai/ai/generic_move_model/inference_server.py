@@ -0,0 +1,245 @@
+"""
+複数のバトルの推論要求をまとめて処理する推論サーバ
+Agentはバトルの行動選択ごとにバッチサイズ1でモデルを計算するが、このモデルの大きさではCPU上の呼び出しごとのオーバーヘッドが支配的になる
+推論サーバは別プロセスで動作し、SimPoolのワーカーやactorなど多数のプロセスの要求を集めて1回のforward_sparseで計算する
+
+要求を受け取ってから最大max_latency秒待ち、接続中の全クライアントの要求がそろうか、max_batch_sizeに達したら計算する
+(クライアントは結果を受け取るまで次の要求を出さないので、全クライアントの要求がそろえばそれ以上待つ必要がない)
+1つの要求は複数の観測を含められる。Sim(batch_decisions=True)のプロセス内では、並行に進むバトルの行動選択が
+decision_batcherでまとめられ、1回の要求として送られる
+
+モデルはVersionedModelで渡し、バージョンが進めば次のバッチから新しいパラメータを用いる
+
+使用例
+server = InferenceServer({"train": trainer.agent_model})
+agent = BatchedAgentVal(InferenceClient(server.address), "train", trainer.feature_extractor)  # 他のプロセスでも構築できる
+...
+server.close()
+"""
+import copy
+import functools
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+from logging import getLogger
+from multiprocessing.connection import Client, Connection, Listener, wait
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from pokeai import stage_timer
+from pokeai.ai.generic_move_model.agent import forward_sparse_batch
+from pokeai.ai.generic_move_model.agent_train import AgentTrain
+from pokeai.ai.generic_move_model.agent_val import AgentVal
+from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor, SparseObsVector
+from pokeai.ai.generic_move_model.versioned_model import VersionedModel
+from pokeai.sim.decision_batcher import decision_batcher
+
+logger = getLogger(__name__)
+
+
+def _accept_loop(listener: Listener, new_conns: queue.Queue):
+    while True:
+        try:
+            new_conns.put(listener.accept())
+        except OSError:
+            # listenerが閉じられた
+            break
+
+
+def _forward(models: Dict[str, torch.nn.Module], requests: List[Tuple[Connection, str, List[SparseObsVector]]]):
+    # モデルごとにまとめて計算し、各クライアントに返す
+    keys = sorted(set(key for _, key, _ in requests))
+    for key in keys:
+        key_requests = [(conn, sparse_obs_list) for conn, req_key, sparse_obs_list in requests if req_key == key]
+        q_vectors = forward_sparse_batch(models[key], [sparse_obs for _, sparse_obs_list in key_requests
+                                                       for sparse_obs in sparse_obs_list])
+        begin = 0
+        for conn, sparse_obs_list in key_requests:
+            end = begin + len(sparse_obs_list)
+            try:
+                conn.send(q_vectors[begin:end])
+            except OSError:
+                # クライアントが終了した。接続は次の受信時に除く
+                pass
+            begin = end
+
+
+def _server_main(address: str, versioned_models: Dict[str, VersionedModel], ready_event, stop_event,
+                 max_batch_size: int, max_latency: float, num_threads: int):
+    torch.set_grad_enabled(False)
+    torch.set_num_threads(num_threads)
+    # 計算中にパラメータが書き換わらないよう、各モデルを複製して使う
+    models = {}  # type: Dict[str, torch.nn.Module]
+    versions = {}  # type: Dict[str, int]
+    for key, versioned_model in versioned_models.items():
+        models[key] = copy.deepcopy(versioned_model.model)
+        versions[key] = versioned_model.version
+    listener = Listener(address, family="AF_UNIX")
+    new_conns = queue.Queue()
+    threading.Thread(target=_accept_loop, args=(listener, new_conns), daemon=True).start()
+    ready_event.set()
+    conns = []  # type: List[Connection]
+    requests = []  # type: List[Tuple[Connection, str, List[SparseObsVector]]]
+    deadline = None
+    while not stop_event.is_set():
+        while not new_conns.empty():
+            conns.append(new_conns.get())
+        if len(conns) == 0:
+            stop_event.wait(0.01)
+            continue
+        waiting = [conn for conn in conns if all(conn is not req_conn for req_conn, _, _ in requests)]
+        timeout = 0.05 if deadline is None else max(deadline - time.perf_counter(), 0.0)
+        for conn in wait(waiting, timeout=timeout):
+            try:
+                key, sparse_obs_list = conn.recv()
+            except (EOFError, OSError):
+                conns.remove(conn)
+                continue
+            requests.append((conn, key, sparse_obs_list))
+            if deadline is None:
+                deadline = time.perf_counter() + max_latency
+        if len(requests) == 0:
+            continue
+        if len(requests) < min(max_batch_size, len(conns)) and time.perf_counter() < deadline:
+            continue
+        for key, versioned_model in versioned_models.items():
+            version = versioned_model.copy_to(models[key], versions[key])
+            if version is not None:
+                versions[key] = version
+        t = stage_timer.start()
+        _forward(models, requests)
+        stage_timer.stop("inference_server.forward", t)
+        requests = []
+        deadline = None
+    listener.close()
+    for conn in conns:
+        conn.close()
+
+
+class InferenceServer:
+    """
+    推論サーバのプロセスを管理する
+    """
+
+    def __init__(self, models: Dict[str, VersionedModel], address: Optional[str] = None, max_batch_size: int = 64,
+                 max_latency: float = 0.002, num_threads: int = 1):
+        """
+        推論サーバのプロセスを起動する
+        :param models: モデル名 => モデル。クライアントは要求にモデル名を指定する
+        :param address: Unixソケットのパス。Noneなら一時ディレクトリに作成する
+        :param max_batch_size: 1回の計算にまとめる最大の要求数(1つの要求は複数の観測を含みうる)
+        :param max_latency: 最初の要求を受け取ってから、他の要求を待つ最大秒数
+        :param num_threads: サーバプロセスのtorchのスレッド数
+        """
+        if address is None:
+            address = os.path.join(tempfile.gettempdir(), f"pokeai_inference_{os.getpid()}_{id(self)}.sock")
+        self.address = address
+        # torchを使うためforkではなくspawnを用いる
+        ctx = multiprocessing.get_context("spawn")
+        ready_event = ctx.Event()
+        self._stop_event = ctx.Event()
+        self._process = ctx.Process(target=_server_main,
+                                    args=(address, models, ready_event, self._stop_event, max_batch_size,
+                                          max_latency, num_threads),
+                                    daemon=True)
+        self._process.start()
+        if not ready_event.wait(timeout=60.0):
+            raise RuntimeError("inference server did not start")
+
+    def close(self):
+        if self._process is not None:
+            self._stop_event.set()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class InferenceClient:
+    """
+    推論サーバへの接続
+    pickle可能で、接続は使用するプロセス内で最初の要求時に行う
+    """
+
+    def __init__(self, address: str):
+        self.address = address
+        self._conn = None  # type: Optional[Connection]
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def calc_q_vector(self, model_key: str, sparse_obs: SparseObsVector) -> np.ndarray:
+        """
+        1つの観測に対するQ値を、推論サーバで計算する
+        :param model_key: 推論サーバのモデル名
+        :param sparse_obs:
+        :return: (output_dim,) float32
+        """
+        return self.calc_q_vectors(model_key, [sparse_obs])[0]
+
+    def calc_q_vectors(self, model_key: str, sparse_obs_list: List[SparseObsVector]) -> np.ndarray:
+        """
+        複数の観測に対するQ値を、1回の要求で推論サーバに計算させる
+        :param model_key: 推論サーバのモデル名
+        :param sparse_obs_list:
+        :return: (len(sparse_obs_list), output_dim) float32
+        """
+        with self._lock:
+            if self._conn is None or self._pid != os.getpid():
+                self._conn = Client(self.address, family="AF_UNIX")
+                self._pid = os.getpid()
+            self._conn.send((model_key, sparse_obs_list))
+            return self._conn.recv()
+
+    def __getstate__(self):
+        return {"address": self.address}
+
+    def __setstate__(self, state):
+        self.__init__(state["address"])
+
+
+def _calc_q_vector_by_server(client: InferenceClient, model_key: str, calc_q_vectors, sparse_obs) -> np.ndarray:
+    t = stage_timer.start()
+    # プロセス内で並行に処理中の他のバトルの観測とまとめて、1回の要求で送る
+    q_vector = decision_batcher.submit((client, model_key), calc_q_vectors, sparse_obs)
+    stage_timer.stop("agent.forward", t)
+    return q_vector
+
+
+class BatchedAgentTrain(AgentTrain):
+    """
+    Q値の計算を推論サーバで行う学習用エージェント
+    """
+
+    def __init__(self, client: InferenceClient, model_key: str, feature_extractor: FeatureExtractor,
+                 epsilon: float):
+        super().__init__(None, feature_extractor, epsilon)
+        self._client = client
+        self._model_key = model_key
+        self._calc_q_vectors = functools.partial(client.calc_q_vectors, model_key)
+
+    def _calc_q_vector_sparse(self, sparse_obs) -> np.ndarray:
+        return _calc_q_vector_by_server(self._client, self._model_key, self._calc_q_vectors, sparse_obs)
+
+
+class BatchedAgentVal(AgentVal):
+    """
+    Q値の計算を推論サーバで行う評価用エージェント
+    """
+
+    def __init__(self, client: InferenceClient, model_key: str, feature_extractor: FeatureExtractor):
+        super().__init__(None, feature_extractor)
+        self._client = client
+        self._model_key = model_key
+        self._calc_q_vectors = functools.partial(client.calc_q_vectors, model_key)
+
+    def _calc_q_vector_sparse(self, sparse_obs) -> np.ndarray:
+        return _calc_q_vector_by_server(self._client, self._model_key, self._calc_q_vectors, sparse_obs)
@@ -0,0 +1,255 @@
+"""
+np.memmapによるディスク上のリプレイバッファ
+RAMに収まらない数の遷移を保持でき、学習の再開時はpickleから復元する代わりにファイルを開き直す
+既存のシャードを開き直すのはpickleから復元したインスタンス(学習の再開、actorへの受け渡し)のみ
+新規に生成したインスタンスは、ディレクトリに以前の実行のシャードがあればエラーとする(別の実行の遷移を混ぜない)
+
+ディレクトリ構成
+directory/shard000/header.npy  [次に書き込む位置, 格納されている要素数] int64
+directory/shard000/state.npy など  RingReplayBufferの各配列(.npy形式なので形状はファイル自身が持つ)
+directory/shard001/...
+
+シャードごとに書き込むプロセスは1つとし、複数のプロセスが別々のシャードに同時に追加できる
+読み出し(サンプリング)は全シャードにまたがって行う
+書き込みは要素の内容、ヘッダの順に行うので、読み出し側は書き込み途中の要素を新しい要素として読むことはない
+(リングバッファが一周して上書き中の要素を読む可能性はあるが、リプレイバッファの用途では許容する)
+"""
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import numpy as np
+
+from pokeai.ai.generic_move_model.replay_buffer import ReplayBatch, ReplayBufferItem, RingReplayBuffer
+
+_HEADER_NEXT = 0
+_HEADER_COUNT = 1
+
+
+def _shard_dir(directory: Path, shard: int) -> Path:
+    return directory.joinpath(f"shard{shard:03d}")
+
+
+class MemmapShard(RingReplayBuffer):
+    """
+    1つのシャード。配列をnp.memmapで確保したRingReplayBuffer
+    書き込み位置と要素数はヘッダファイルに置くので、他のプロセスによる追加も参照できる
+    """
+
+    def __init__(self, directory: Union[str, Path], size: int, state_dims: int, output_dim: int,
+                 choice_width: int = 8):
+        """
+        ディレクトリにシャードがあれば開き、なければ作成する
+        :param directory: シャードのディレクトリ
+        :param size:
+        :param state_dims:
+        :param output_dim:
+        :param choice_width: 1つの行動の選択肢特徴量の非ゼロ次元数の上限。ファイル作成後は変更できない
+        """
+        self.directory = Path(directory)
+        self.size = size
+        self.state_dims = state_dims
+        self.output_dim = output_dim
+        header_path = self.directory.joinpath("header.npy")
+        if header_path.exists():
+            self._open()
+            if self._state.shape != (size, state_dims) or self._action_mask.shape != (size, output_dim):
+                raise ValueError(f"replay buffer at {self.directory} has different shape: "
+                                 f"state {self._state.shape}, action_mask {self._action_mask.shape}")
+        else:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._allocate(choice_width)
+            # ヘッダは最後に作成する(ヘッダの存在がシャードの作成完了を表す)
+            header = np.lib.format.open_memmap(str(header_path), mode="w+", dtype=np.int64, shape=(2,))
+            del header
+            self._open()
+
+    def _array_path(self, name: str) -> str:
+        return str(self.directory.joinpath(name.lstrip("_") + ".npy"))
+
+    def _allocate(self, choice_width: int):
+        # RingReplayBufferと同じ形状・初期値の配列をファイルとして作成する
+        shapes = {
+            "_state": ((self.size, self.state_dims), np.float32, 0),
+            "_choice": ((self.size, self.output_dim, choice_width), np.int16, self._CHOICE_PAD),
+            "_action_mask": ((self.size, self.output_dim), np.int8, 0),
+            "_action": ((self.size,), np.int64, 0),
+            "_next_state": ((self.size, self.state_dims), np.float32, 0),
+            "_next_choice": ((self.size, self.output_dim, choice_width), np.int16, self._CHOICE_PAD),
+            "_next_action_mask": ((self.size, self.output_dim), np.int8, 0),
+            "_reward": ((self.size,), np.float32, 0),
+            "_done": ((self.size,), bool, 0),
+        }
+        for name, (shape, dtype, fill) in shapes.items():
+            array = np.lib.format.open_memmap(self._array_path(name), mode="w+", dtype=dtype, shape=shape)
+            if fill != 0:
+                array[...] = fill
+            array.flush()
+            del array
+
+    def _open(self):
+        for name in ["_state", "_choice", "_action_mask", "_action", "_next_state", "_next_choice",
+                     "_next_action_mask", "_reward", "_done"]:
+            setattr(self, name, np.lib.format.open_memmap(self._array_path(name), mode="r+"))
+        self._header = np.lib.format.open_memmap(str(self.directory.joinpath("header.npy")), mode="r+")
+
+    def _widen_choice(self, choice_width: int):
+        raise ValueError(f"choice features wider than {self._choice.shape[2]} cannot be stored in {self.directory}; "
+                         f"recreate the replay buffer with larger choice_width")
+
+    @property
+    def _next(self) -> int:
+        return int(self._header[_HEADER_NEXT])
+
+    @_next.setter
+    def _next(self, value: int):
+        self._header[_HEADER_NEXT] = value
+
+    @property
+    def _count(self) -> int:
+        return int(self._header[_HEADER_COUNT])
+
+    @_count.setter
+    def _count(self, value: int):
+        self._header[_HEADER_COUNT] = value
+
+    def flush(self):
+        for name in ["_state", "_choice", "_action_mask", "_action", "_next_state", "_next_choice",
+                     "_next_action_mask", "_reward", "_done", "_header"]:
+            getattr(self, name).flush()
+
+    def __getstate__(self):
+        # 内容はファイルにあるので、開き直すための情報のみ
+        self.flush()
+        return {
+            "directory": str(self.directory),
+            "size": self.size,
+            "state_dims": self.state_dims,
+            "output_dim": self.output_dim,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class MemmapReplayBuffer:
+    """
+    シャードに分かれたディスク上のリプレイバッファ
+    追加は自身のシャード(shard)に行い、サンプリングは全シャードの要素から一様に行う
+    ファイルは最初に使用する時に開く(推論のみに用いるTrainerではディレクトリを作成しない)
+    新規に生成したインスタンスは、最初に使用する時にディレクトリにシャードがないことを確認する
+    """
+    _shards: List[Optional[MemmapShard]]
+
+    def __init__(self, directory: Union[str, Path], size: int, state_dims: int, output_dim: int,
+                 n_shards: int = 1, shard: int = 0, choice_width: int = 8):
+        """
+        :param directory: 実行ごとのディレクトリ
+        :param size: 全シャード合計の最大要素数
+        :param state_dims:
+        :param output_dim:
+        :param n_shards: シャード数(同時に追加するプロセス数)
+        :param shard: このインスタンスが追加を行うシャード
+        :param choice_width:
+        """
+        self.directory = Path(directory)
+        self.size = size
+        self.state_dims = state_dims
+        self.output_dim = output_dim
+        self.n_shards = n_shards
+        self.shard = shard
+        self.choice_width = choice_width
+        self.shard_size = -(-size // n_shards)
+        self._shards = [None] * n_shards
+        self._claimed = False  # ディレクトリのシャードがこのリプレイバッファのものであることを確認済み
+
+    def claim(self):
+        """
+        ディレクトリに他の実行のシャードがないことを確認する。新規に生成したインスタンスは最初に使用する時に自動で行う
+        :return:
+        """
+        if self._claimed:
+            return
+        existing = [i for i in range(self.n_shards) if _shard_dir(self.directory, i).joinpath("header.npy").exists()]
+        if len(existing) > 0:
+            raise ValueError(f"replay buffer directory {self.directory} already contains shards {existing} "
+                             f"of another run; remove it or resume the run that created it")
+        self._claimed = True
+
+    def for_shard(self, shard: int) -> "MemmapReplayBuffer":
+        """
+        同じディレクトリの別のシャードに追加するインスタンスを生成する(別プロセスのactor用)
+        :param shard:
+        :return:
+        """
+        self.claim()
+        replay_buffer = MemmapReplayBuffer(self.directory, self.size, self.state_dims, self.output_dim, self.n_shards,
+                                           shard, self.choice_width)
+        replay_buffer._claimed = True
+        return replay_buffer
+
+    def _own_shard(self) -> MemmapShard:
+        if self._shards[self.shard] is None:
+            self.claim()
+            self._shards[self.shard] = MemmapShard(_shard_dir(self.directory, self.shard), self.shard_size,
+                                                   self.state_dims, self.output_dim, self.choice_width)
+        return self._shards[self.shard]
+
+    def _open_shards(self) -> List[MemmapShard]:
+        # 他のプロセスが作成したシャードを開く。自身のシャードは追加するまで作成しない(他のプロセスが書き込む場合がある)
+        self.claim()
+        for i in range(self.n_shards):
+            if self._shards[i] is None and _shard_dir(self.directory, i).joinpath("header.npy").exists():
+                self._shards[i] = MemmapShard(_shard_dir(self.directory, i), self.shard_size, self.state_dims,
+                                              self.output_dim)
+        return [shard for shard in self._shards if shard is not None]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._open_shards())
+
+    def append(self, item: ReplayBufferItem):
+        self._own_shard().append(item)
+
+    def extend(self, items: Iterable[ReplayBufferItem]):
+        self._own_shard().extend(items)
+
+    def sample(self, size: int) -> ReplayBatch:
+        """
+        全シャードの要素から一様ランダムに(重複を許して)取り出す
+        :param size:
+        :return:
+        """
+        shards = self._open_shards()
+        counts = np.array([len(shard) for shard in shards], dtype=np.int64)
+        total = int(counts.sum())
+        if total < size:
+            raise IndexError
+        global_idxs = np.random.randint(0, total, size=size)
+        ends = np.cumsum(counts)
+        shard_idxs = np.searchsorted(ends, global_idxs, side="right")
+        local_idxs = global_idxs - (ends - counts)[shard_idxs]
+        parts = [shard.get_batch(local_idxs[shard_idxs == i]) for i, shard in enumerate(shards)
+                 if np.any(shard_idxs == i)]
+        return ReplayBatch(*[np.concatenate(arrays) for arrays in zip(*parts)])
+
+    def flush(self):
+        if self._shards[self.shard] is not None:
+            self._shards[self.shard].flush()
+
+    def __getstate__(self):
+        # 復元したインスタンスは確認せずにシャードを開くので、保存前に確認する
+        self.claim()
+        self.flush()
+        return {
+            "directory": str(self.directory),
+            "size": self.size,
+            "state_dims": self.state_dims,
+            "output_dim": self.output_dim,
+            "n_shards": self.n_shards,
+            "shard": self.shard,
+            "choice_width": self.choice_width,
+        }
+
+    def __setstate__(self, state):
+        # 保存したリプレイバッファの再開なので、既存のシャードを開き直す
+        self.__init__(**state)
+        self._claimed = True
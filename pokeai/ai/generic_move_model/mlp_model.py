@@ -1,3 +1,6 @@
+from collections import OrderedDict
+
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -17,6 +20,7 @@ class MLPModel(nn.Module):
         self.bn_layers = nn.ModuleList(bn_layers)
         self.output = nn.Conv1d(cur_hidden_ch, 1, 1)
         self.bn = bn
+        self._sparse_weight_cache = None
 
     def forward(self, x):
         h = x  # batch, feature_dim, 4
@@ -28,3 +32,151 @@ class MLPModel(nn.Module):
         h = self.output(h)
         h = h.view(h.shape[0], -1)  # batch, 4
         return h
+
+    def _split_first_weight(self, first: nn.Conv1d, state_dims: int):
+        """
+        最初の層の重みを、状態特徴量に対する部分(out, state_dims)と選択肢特徴量に対する部分(choice_dims, out)に分ける
+        embedding_bagの重みは転置して連続したメモリに置く必要があるため、勾配が不要なら重みが更新されるまで再利用する
+        """
+        weight = first.weight
+        if weight.requires_grad and torch.is_grad_enabled():
+            return weight[:, :state_dims, 0], weight[:, state_dims:, 0].t().contiguous()
+        # 重みのin-placeの更新(optimizer, load_state_dict)でバージョンが変わる
+        key = (weight.data_ptr(), weight._version, state_dims)
+        cache = self._sparse_weight_cache
+        if cache is None or cache[0] != key:
+            weight = weight.detach()
+            cache = self._sparse_weight_cache = (key, weight[:, :state_dims, 0],
+                                                 weight[:, state_dims:, 0].t().contiguous())
+        return cache[1], cache[2]
+
+    def forward_sparse(self, state: torch.Tensor, choice_indices: torch.Tensor, choice_offsets: torch.Tensor):
+        """
+        FeatureExtractor.collate_sparseの形式の入力に対するforward
+        forward(FeatureExtractor.transformの特徴量)と同じ結果となる
+        最初の層のConv1d(kernel=1)を、状態特徴量に対する行列積と選択肢特徴量に対するembedding_bag(和)に分けて計算する
+        :param state: (batch, 状態特徴次元)
+        :param choice_indices: 選択肢特徴量の非ゼロ次元
+        :param choice_offsets: (batch * 行動数,)
+        :return: (batch, 行動数)
+        """
+        first = self.layers[0] if len(self.layers) > 0 else self.output
+        batch_size = state.shape[0]
+        weight_state, weight_choice = self._split_first_weight(first, state.shape[1])
+        h_state = F.linear(state, weight_state, first.bias)  # batch, out
+        h_choice = F.embedding_bag(choice_indices, weight_choice, choice_offsets, mode='sum')
+        h = h_choice.view(batch_size, -1, h_choice.shape[1]).transpose(1, 2) + h_state.unsqueeze(2)  # batch, out, 4
+        if len(self.layers) == 0:
+            return h.reshape(batch_size, -1)
+        if self.bn:
+            h = self.bn_layers[0](h)
+        h = F.relu(h)
+        for i in range(1, len(self.layers)):
+            h = self.layers[i](h)
+            if self.bn:
+                h = self.bn_layers[i](h)
+            h = F.relu(h)
+        h = self.output(h)
+        h = h.view(h.shape[0], -1)  # batch, 4
+        return h
+
+
+def factorize_mlp_state_dict(state_dict: dict, state_dims: int) -> "OrderedDict[str, torch.Tensor]":
+    """
+    MLPModelのstate_dictをFactorizedMLPModelの形式に変換する
+    :param state_dict: MLPModelのstate_dict
+    :param state_dims: 入力のうち状態特徴量の次元数
+    :return:
+    """
+    converted = OrderedDict()
+    for key, value in state_dict.items():
+        if key == 'layers.0.weight':
+            converted['first_state.weight'] = value[:, :state_dims, 0].clone()
+            converted['first_choice.weight'] = value[:, state_dims:, 0].t().clone()
+        elif key == 'layers.0.bias':
+            converted['first_state.bias'] = value.clone()
+        elif key.startswith('layers.'):
+            # 2層目以降は1つずつ前にずれる
+            _, idx, name = key.split('.', 2)
+            converted[f'layers.{int(idx) - 1}.{name}'] = value
+        else:
+            converted[key] = value
+    return converted
+
+
+class FactorizedMLPModel(nn.Module):
+    """
+    MLPModelの最初の層を、状態特徴量の射影と選択肢特徴量の埋め込みの和に分解したもの
+    状態特徴量は全行動で共通なので、射影は行動ごとでなく1回だけ計算する
+    MLPModelと同じ関数を表し、MLPModelのstate_dictも読み込める(load_state_dictで変換する)
+    """
+
+    def __init__(self, input_shape, output_dim, state_dims, n_layers=2, n_channels=64, bn=False):
+        super().__init__()
+        assert n_layers >= 1
+        self.state_dims = state_dims
+        self.first_state = nn.Linear(state_dims, n_channels, bias=not bn)
+        self.first_choice = nn.EmbeddingBag(input_shape[0] - state_dims, n_channels, mode='sum')
+        layers = []
+        bn_layers = []
+        for i in range(n_layers - 1):
+            layers.append(nn.Conv1d(n_channels, n_channels, 1, bias=not bn))
+        if bn:
+            for i in range(n_layers):
+                bn_layers.append(nn.BatchNorm1d(n_channels))
+        self.layers = nn.ModuleList(layers)
+        self.bn_layers = nn.ModuleList(bn_layers)
+        self.output = nn.Conv1d(n_channels, 1, 1)
+        self.bn = bn
+        # 初期値の分布をMLPModelと揃える
+        first = nn.Conv1d(input_shape[0], n_channels, 1, bias=not bn)
+        with torch.no_grad():
+            self.first_state.weight.copy_(first.weight[:, :state_dims, 0])
+            self.first_choice.weight.copy_(first.weight[:, state_dims:, 0].t())
+            if not bn:
+                self.first_state.bias.copy_(first.bias)
+
+    def load_state_dict(self, state_dict, strict: bool = True):
+        if 'first_state.weight' not in state_dict:
+            # MLPModelのstate_dict
+            state_dict = factorize_mlp_state_dict(state_dict, self.state_dims)
+        return super().load_state_dict(state_dict, strict)
+
+    def _forward_hidden(self, h):
+        # 最初の層の出力(batch, n_channels, 行動数)以降の計算
+        if self.bn:
+            h = self.bn_layers[0](h)
+        h = F.relu(h)
+        for i in range(len(self.layers)):
+            h = self.layers[i](h)
+            if self.bn:
+                h = self.bn_layers[i + 1](h)
+            h = F.relu(h)
+        h = self.output(h)
+        h = h.view(h.shape[0], -1)  # batch, 4
+        return h
+
+    def forward(self, x):
+        """
+        MLPModelと同じ入力(FeatureExtractor.transformの特徴量)に対するforward
+        状態特徴量は全列で同じなので、最初の列のみ用いる
+        :param x: (batch, feature_dim, 行動数)
+        :return: (batch, 行動数)
+        """
+        h_state = self.first_state(x[:, :self.state_dims, 0])  # batch, out
+        h_choice = torch.matmul(self.first_choice.weight.t(), x[:, self.state_dims:, :])  # batch, out, 4
+        return self._forward_hidden(h_choice + h_state.unsqueeze(2))
+
+    def forward_sparse(self, state: torch.Tensor, choice_indices: torch.Tensor, choice_offsets: torch.Tensor):
+        """
+        FeatureExtractor.collate_sparseの形式の入力に対するforward
+        :param state: (batch, 状態特徴次元)
+        :param choice_indices: 選択肢特徴量の非ゼロ次元
+        :param choice_offsets: (batch * 行動数,)
+        :return: (batch, 行動数)
+        """
+        batch_size = state.shape[0]
+        h_state = self.first_state(state)  # batch, out
+        h_choice = self.first_choice(choice_indices, choice_offsets)  # batch * 4, out
+        h = h_choice.view(batch_size, -1, h_choice.shape[1]).transpose(1, 2) + h_state.unsqueeze(2)
+        return self._forward_hidden(h)
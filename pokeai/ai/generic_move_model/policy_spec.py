@@ -0,0 +1,140 @@
+"""
+SimPoolのワーカープロセス内で、pickle可能な指定(policy spec)から方策を構築する
+
+policy specの形式
+{"type": "random"}: ランダム方策
+{"type": "trainer", "trainer_id": "xxx"}: 保存済みtrainerの評価用エージェント(trainer_id@battles形式も可)
+{"type": "train", "version": 123, "epsilon": 0.3, "surrogate_reward_config": SurrogateRewardConfig}:
+ 学習中モデルの学習用エージェント
+{"type": "val", "version": 123}: 学習中モデルの評価用エージェント
+
+"train", "val"の学習中モデルは、init_workerで渡した共有メモリ上のモデル(Trainer.agent_model)である
+パラメータはジョブごとには送らず、"version"(学習中モデルのupdate_steps)が変わったときにワーカーが共有モデルから読み込む
+
+"type"が"trainer", "train", "val"のspecに以下を加えると、モデルの計算を推論サーバ(InferenceServer)で行う
+この場合ワーカー内でモデルを構築しない
+"inference": {"address": InferenceServer.address, "model_key": "xxx", "feature_params": {"party_size": 3}}
+"""
+import json
+from typing import Dict, Optional
+
+import torch
+
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.ai.generic_move_model.agent_train import AgentTrain
+from pokeai.ai.generic_move_model.agent_val import AgentVal
+from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor
+from pokeai.ai.generic_move_model.inference_server import BatchedAgentTrain, BatchedAgentVal, InferenceClient
+from pokeai.ai.generic_move_model.trainer import Trainer
+from pokeai.ai.generic_move_model.trainer_loader import load_trainer
+from pokeai.ai.generic_move_model.versioned_model import VersionedModel
+from pokeai.ai.random_policy import RandomPolicy
+from pokeai.ai.rl_policy import RLPolicy
+from pokeai.ai.surrogate_reward_config import SurrogateRewardConfigZero
+
+# 保存済みtrainerの評価用エージェント(trainer_id => AgentVal)。対戦中の内部状態を持たないので共有する
+_saved_agents = {}  # type: Dict[str, AgentVal]
+# 学習中モデル。init_workerで設定し、trainerのモデルに共有モデルの最新versionのパラメータを読み込んで使う
+_train_snapshot = {"constructor_params": None, "shared_model": None, "version": None, "trainer": None}
+# 推論サーバを使う場合の特徴抽出器(feature_paramsのjson表現 => FeatureExtractor)と接続(address => InferenceClient)
+_feature_extractors = {}  # type: Dict[str, FeatureExtractor]
+_inference_clients = {}  # type: Dict[str, InferenceClient]
+
+
+def init_worker(constructor_params: Optional[dict] = None, shared_model: Optional[VersionedModel] = None):
+    """
+    ワーカーの初期化(SimPoolのinitializer)
+    :param constructor_params: 学習中モデル("train", "val")を使う場合、そのTrainer.constructor_params
+    :param shared_model: 学習中モデルを使う場合、そのTrainer.agent_model
+    :return:
+    """
+    # ワーカー内ではモデルの推論のみ行う
+    torch.set_grad_enabled(False)
+    _train_snapshot["constructor_params"] = constructor_params
+    _train_snapshot["shared_model"] = shared_model
+
+
+def _get_saved_agent(trainer_id: str) -> AgentVal:
+    if trainer_id not in _saved_agents:
+        _saved_agents[trainer_id] = load_trainer(trainer_id).get_val_agent()
+    return _saved_agents[trainer_id]
+
+
+def _get_batched_agent(spec: dict, epsilon: Optional[float] = None):
+    """
+    推論サーバでモデルを計算するエージェントを構築する
+    :param spec:
+    :param epsilon: 学習用エージェントの場合そのランダム行動確率。Noneなら評価用エージェント
+    :return:
+    """
+    inference = spec["inference"]
+    feature_key = json.dumps(inference["feature_params"], sort_keys=True)
+    if feature_key not in _feature_extractors:
+        _feature_extractors[feature_key] = FeatureExtractor(**inference["feature_params"])
+    if inference["address"] not in _inference_clients:
+        _inference_clients[inference["address"]] = InferenceClient(inference["address"])
+    feature_extractor = _feature_extractors[feature_key]
+    client = _inference_clients[inference["address"]]
+    if epsilon is None:
+        return BatchedAgentVal(client, inference["model_key"], feature_extractor)
+    return BatchedAgentTrain(client, inference["model_key"], feature_extractor, epsilon)
+
+
+def _get_train_snapshot(spec: dict) -> Trainer:
+    shared_model = _train_snapshot["shared_model"]  # type: VersionedModel
+    if shared_model is None:
+        raise ValueError("policy spec for training model requires init_worker(constructor_params, shared_model)")
+    if _train_snapshot["trainer"] is None:
+        trainer = Trainer(**_train_snapshot["constructor_params"])
+        trainer.model.eval()
+        _train_snapshot["trainer"] = trainer
+    trainer = _train_snapshot["trainer"]
+    if _train_snapshot["version"] != spec["version"]:
+        # 共有モデルはバトル中に書き換わりうるので、自身のモデルに読み込んで使う
+        pulled = shared_model.copy_to(trainer.model, _train_snapshot["version"])
+        if pulled is not None:
+            _train_snapshot["version"] = pulled
+        if _train_snapshot["version"] != spec["version"]:
+            raise ValueError(f"shared model has version {_train_snapshot['version']}, "
+                             f"but policy spec requires {spec['version']}")
+    return trainer
+
+
+def build_policy(spec: dict) -> ActionPolicy:
+    """
+    policy specから方策を構築する。バトルごとに新しい方策オブジェクトを返す
+    :param spec:
+    :return:
+    """
+    spec_type = spec["type"]
+    if spec_type == "random":
+        return RandomPolicy()
+    elif "inference" in spec:
+        if spec_type == "train":
+            return RLPolicy(_get_batched_agent(spec, spec["epsilon"]), spec["surrogate_reward_config"])
+        elif spec_type in ["trainer", "val"]:
+            return RLPolicy(_get_batched_agent(spec), SurrogateRewardConfigZero)
+        else:
+            raise ValueError(f"Unknown policy spec type {spec_type}")
+    elif spec_type == "trainer":
+        return RLPolicy(_get_saved_agent(spec["trainer_id"]), SurrogateRewardConfigZero)
+    elif spec_type == "train":
+        trainer = _get_train_snapshot(spec)
+        # 推論のみなのでモデルはバトル間で共有する
+        agent = AgentTrain(trainer.model, trainer.feature_extractor, spec["epsilon"])
+        return RLPolicy(agent, spec["surrogate_reward_config"])
+    elif spec_type == "val":
+        trainer = _get_train_snapshot(spec)
+        return RLPolicy(AgentVal(trainer.model, trainer.feature_extractor), SurrogateRewardConfigZero)
+    else:
+        raise ValueError(f"Unknown policy spec type {spec_type}")
+
+
+def collect_replay(policy: ActionPolicy) -> list:
+    """
+    バトル終了後の学習用方策から、リプレイバッファの内容を取り出す
+    :param policy:
+    :return: ReplayBufferItemのリスト
+    """
+    assert isinstance(policy, RLPolicy)
+    return list(policy.agent._replay_buffer.buffer)
@@ -1,19 +1,29 @@
 from collections import deque
 import random
-from typing import NamedTuple, Optional, List, Iterable
+from typing import NamedTuple, Optional, List, Iterable, Tuple
 import numpy as np
 
+from pokeai.ai.generic_move_model.choice_to_vec import SparseChoiceVec
+from pokeai.ai.generic_move_model.feature_extractor import SparseObsVector
+
 
 class ReplayBufferItem(NamedTuple):
-    state: np.ndarray
+    # 状態はFeatureExtractor.transform_sparseの形式で保持し、学習時にdensify_batchで密な行列に戻す
+    # (密な行列は全列に同じ状態特徴量が並び、選択肢特徴量もほぼ0なので、保持するとメモリを浪費する)
+    state: SparseObsVector
     action_mask: np.ndarray  # action数次元のnp.float32ベクトルで、合法手に1、それ以外に0を代入
     action: int  # 実際に選んだ行動
-    next_state: Optional[np.ndarray]  # エピソード終端ではNone
+    next_state: Optional[SparseObsVector]  # エピソード終端ではNone
     next_action_mask: Optional[np.ndarray]
     reward: float
 
 
 class ReplayBuffer:
+    """
+    ReplayBufferItemのリスト
+    AgentTrainがエピソード中の遷移を蓄積し、ワーカー間の受け渡しに用いる。学習時のバッファはRingReplayBuffer
+    """
+
     def __init__(self, size: Optional[int]):
         self.buffer = deque(maxlen=size)
 
@@ -30,3 +40,272 @@ class ReplayBuffer:
         if len(self) < size:
             raise IndexError
         return random.sample(self.buffer, size)
+
+
+class ReplayBatch(NamedTuple):
+    """
+    RingReplayBufferから取り出したバッチ
+    選択肢特徴量は、行動ごとの非ゼロ次元を幅を揃えて並べたもの(余りは-1)。FeatureExtractor.densify_paddedで密な行列に戻す
+    """
+    state: np.ndarray  # (batch, 状態特徴次元) float32
+    choice: np.ndarray  # (batch, output_dim, 幅) int16
+    action_mask: np.ndarray  # (batch, output_dim) int8
+    action: np.ndarray  # (batch,) int64
+    next_state: np.ndarray  # (batch, 状態特徴次元) float32 エピソード終端では0
+    next_choice: np.ndarray  # (batch, output_dim, 幅) int16 エピソード終端では-1
+    next_action_mask: np.ndarray  # (batch, output_dim) int8 エピソード終端では0
+    reward: np.ndarray  # (batch,) float32
+    done: np.ndarray  # (batch,) bool エピソード終端ならTrue
+
+
+def _pad_choice(choice: SparseChoiceVec, out: np.ndarray):
+    """
+    疎な形式の選択肢特徴量を、行動ごとに幅を揃えた配列に書き込む
+    :param choice:
+    :param out: (output_dim, 幅)の書き込み先。-1で初期化されていること
+    :return:
+    """
+    indices, offsets = choice
+    counts = np.diff(offsets, append=len(indices))
+    actions = np.repeat(np.arange(len(offsets)), counts)
+    positions = np.arange(len(indices)) - np.repeat(offsets, counts)
+    out[actions, positions] = indices
+
+
+class RingReplayBuffer:
+    """
+    事前確保したnumpy配列によるリングバッファ
+    Trainerが学習に用いる。要素ごとのPythonオブジェクトを持たないので、サンプリングとバッチの構築がバッチサイズに比例する時間で済む
+    追加はReplayBufferItem単位で受け付ける(AgentTrainはエピソード中の遷移をReplayBufferに蓄積する)
+    配列は最初の追加時に確保する(推論のみに用いるTrainerではメモリを消費しない)
+    """
+    _CHOICE_PAD = -1  # 選択肢特徴量の余りを表す値
+
+    def __init__(self, size: int, state_dims: int, output_dim: int, choice_width: int = 8):
+        """
+        :param size: 最大要素数。超えると古いものから上書きする
+        :param state_dims: 状態特徴量の次元数
+        :param output_dim: 行動数
+        :param choice_width: 1つの行動の選択肢特徴量の非ゼロ次元数の初期値。超える要素が追加されると拡張する
+        """
+        self.size = size
+        self.state_dims = state_dims
+        self.output_dim = output_dim
+        self._initial_choice_width = choice_width
+        self._state = None  # type: Optional[np.ndarray]
+        self._next = 0  # 次に書き込む位置
+        self._count = 0  # 格納されている要素数
+
+    def _ensure_allocated(self):
+        if self._state is None:
+            self._allocate(self._initial_choice_width)
+
+    def _allocate(self, choice_width: int):
+        size, state_dims, output_dim = self.size, self.state_dims, self.output_dim
+        self._state = np.zeros((size, state_dims), dtype=np.float32)
+        self._choice = np.full((size, output_dim, choice_width), self._CHOICE_PAD, dtype=np.int16)
+        self._action_mask = np.zeros((size, output_dim), dtype=np.int8)
+        self._action = np.zeros((size,), dtype=np.int64)
+        self._next_state = np.zeros((size, state_dims), dtype=np.float32)
+        self._next_choice = np.full((size, output_dim, choice_width), self._CHOICE_PAD, dtype=np.int16)
+        self._next_action_mask = np.zeros((size, output_dim), dtype=np.int8)
+        self._reward = np.zeros((size,), dtype=np.float32)
+        self._done = np.zeros((size,), dtype=bool)
+
+    def _widen_choice(self, choice_width: int):
+        for name in ["_choice", "_next_choice"]:
+            old = getattr(self, name)
+            new = np.full(old.shape[:2] + (choice_width,), self._CHOICE_PAD, dtype=np.int16)
+            new[:, :, :old.shape[2]] = old
+            setattr(self, name, new)
+
+    def _required_width(self, choice: SparseChoiceVec) -> int:
+        counts = np.diff(choice.offsets, append=len(choice.indices))
+        return int(counts.max()) if len(counts) > 0 else 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, item: ReplayBufferItem):
+        self._ensure_allocated()
+        width = self._required_width(item.state.choice)
+        if item.next_state is not None:
+            width = max(width, self._required_width(item.next_state.choice))
+        if width > self._choice.shape[2]:
+            self._widen_choice(width)
+        i = self._next
+        self._state[i] = item.state.state
+        self._choice[i] = self._CHOICE_PAD
+        _pad_choice(item.state.choice, self._choice[i])
+        self._action_mask[i] = item.action_mask
+        self._action[i] = item.action
+        self._next_choice[i] = self._CHOICE_PAD
+        if item.next_state is not None:
+            self._next_state[i] = item.next_state.state
+            _pad_choice(item.next_state.choice, self._next_choice[i])
+            self._next_action_mask[i] = item.next_action_mask
+            self._done[i] = False
+        else:
+            self._next_state[i] = 0.0
+            self._next_action_mask[i] = 0
+            self._done[i] = True
+        self._reward[i] = item.reward
+        self._next = (i + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+    def extend(self, items: Iterable[ReplayBufferItem]):
+        for item in items:
+            self.append(item)
+
+    def sample(self, size: int) -> ReplayBatch:
+        """
+        一様ランダムに(重複を許して)要素を取り出す
+        :param size:
+        :return:
+        """
+        if len(self) < size:
+            raise IndexError
+        idxs = np.random.randint(0, self._count, size=size)
+        return self.get_batch(idxs)
+
+    def get_batch(self, idxs: np.ndarray) -> ReplayBatch:
+        return ReplayBatch(self._state[idxs], self._choice[idxs], self._action_mask[idxs], self._action[idxs],
+                           self._next_state[idxs], self._next_choice[idxs], self._next_action_mask[idxs],
+                           self._reward[idxs], self._done[idxs])
+
+    def _ordered_indexes(self) -> np.ndarray:
+        # 古い順の位置
+        return (np.arange(self._count) + self._next - self._count) % self.size
+
+    def __getstate__(self):
+        # 確保済みの領域全体ではなく、格納済みの要素のみを古い順に保存する。未確保なら配列は保存しない
+        return {
+            "size": self.size,
+            "state_dims": self.state_dims,
+            "output_dim": self.output_dim,
+            "choice_width": self._initial_choice_width,
+            "batch": self.get_batch(self._ordered_indexes()) if self._state is not None else None,
+        }
+
+    def __setstate__(self, state):
+        self.size = state["size"]
+        self.state_dims = state["state_dims"]
+        self.output_dim = state["output_dim"]
+        batch = state["batch"]  # type: Optional[ReplayBatch]
+        self._initial_choice_width = state.get("choice_width", 8)
+        self._state = None
+        self._count = 0
+        self._next = 0
+        if batch is None:
+            return
+        self._allocate(batch.choice.shape[2])
+        count = len(batch.action)
+        for name, value in zip(ReplayBatch._fields, batch):
+            getattr(self, "_" + name)[:count] = value
+        self._count = count
+        self._next = count % self.size
+
+
+class PrioritizedReplayBuffer(RingReplayBuffer):
+    """
+    優先度付き経験再生(Prioritized Experience Replay, Schaul et al. 2015)のリングバッファ
+    優先度(TD誤差の絶対値^alpha)をsum-treeで保持し、優先度に比例した確率でサンプリングする
+    サンプリング、優先度の更新ともO(log n)
+    """
+
+    def __init__(self, size: int, state_dims: int, output_dim: int, choice_width: int = 8,
+                 alpha: float = 0.6, eps: float = 1e-6):
+        """
+        :param size:
+        :param state_dims:
+        :param output_dim:
+        :param choice_width:
+        :param alpha: 優先度の指数。0で一様サンプリング
+        :param eps: TD誤差が0の要素もサンプリングされるよう、優先度に加える値
+        """
+        super().__init__(size, state_dims, output_dim, choice_width)
+        self.alpha = alpha
+        self.eps = eps
+        self._allocate_tree()
+        self._max_priority = 1.0  # 追加された要素には、これまでの最大の優先度を与える
+
+    def _allocate_tree(self):
+        # 葉の数は2のべき乗に切り上げる。tree[1]が根、tree[n_leaves + i]が要素iの葉、tree[k]の子はtree[2k], tree[2k+1]
+        self._n_leaves = 1 << max(self.size - 1, 0).bit_length()
+        self._tree = np.zeros((self._n_leaves * 2,), dtype=np.float64)
+
+    def _set_leaves(self, idxs: np.ndarray, values: np.ndarray):
+        pos = idxs + self._n_leaves
+        self._tree[pos] = values
+        pos = np.unique(pos // 2)
+        while pos[0] >= 1:
+            self._tree[pos] = self._tree[pos * 2] + self._tree[pos * 2 + 1]
+            if pos[0] == 1:
+                break
+            pos = np.unique(pos // 2)
+
+    def append(self, item: ReplayBufferItem):
+        self.extend([item])
+
+    def extend(self, items: Iterable[ReplayBufferItem]):
+        idxs = []
+        for item in items:
+            idxs.append(self._next)
+            RingReplayBuffer.append(self, item)
+        if len(idxs) > 0:
+            self._set_leaves(np.array(idxs, dtype=np.int64), self._max_priority ** self.alpha)
+
+    def sample_prioritized(self, size: int, beta: float) -> Tuple[ReplayBatch, np.ndarray, np.ndarray]:
+        """
+        優先度に比例した確率で要素を取り出す
+        優先度の総和をsize個の区間に分け、各区間から1つずつ選ぶ
+        :param size:
+        :param beta: 重要度重みの指数。1で偏りを完全に補正する
+        :return: バッチ、要素の位置(update_prioritiesに与える)、重要度重み((size,) float32 最大値が1)
+        """
+        if len(self) < size:
+            raise IndexError
+        total = self._tree[1]
+        values = (np.arange(size) + np.random.random_sample(size)) * (total / size)
+        pos = np.ones((size,), dtype=np.int64)
+        while pos[0] < self._n_leaves:
+            left = pos * 2
+            left_values = self._tree[left]
+            go_right = values >= left_values
+            values = np.where(go_right, values - left_values, values)
+            pos = left + go_right
+        # 浮動小数点誤差で未使用の葉に到達した場合は最後の要素とみなす
+        idxs = np.minimum(pos - self._n_leaves, self._count - 1)
+        probs = self._tree[idxs + self._n_leaves] / total
+        weights = (self._count * probs) ** (-beta)
+        weights /= weights.max()
+        return self.get_batch(idxs), idxs, weights.astype(np.float32)
+
+    def update_priorities(self, idxs: np.ndarray, td_errors: np.ndarray):
+        """
+        サンプリングした要素の優先度を更新する
+        :param idxs: sample_prioritizedが返した位置
+        :param td_errors: 各要素のTD誤差
+        :return:
+        """
+        priorities = np.abs(td_errors).astype(np.float64) + self.eps
+        self._max_priority = max(self._max_priority, float(priorities.max()))
+        self._set_leaves(idxs, priorities ** self.alpha)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["alpha"] = self.alpha
+        state["eps"] = self.eps
+        state["max_priority"] = self._max_priority
+        state["priorities"] = self._tree[self._ordered_indexes() + self._n_leaves]
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.alpha = state["alpha"]
+        self.eps = state["eps"]
+        self._max_priority = state["max_priority"]
+        self._allocate_tree()
+        priorities = state["priorities"]
+        if len(priorities) > 0:
+            self._set_leaves(np.arange(len(priorities)), priorities)
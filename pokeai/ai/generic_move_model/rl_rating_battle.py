@@ -6,51 +6,68 @@ import argparse
 import json
 import logging
 from logging import getLogger
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import numpy as np
 import torch
 from bson import ObjectId
 
+from pokeai.ai.generic_move_model.inference_server import InferenceServer
+from pokeai.ai.generic_move_model.policy_spec import build_policy, init_worker
 from pokeai.ai.generic_move_model.trainer_loader import load_trainer
 from pokeai.ai.party_db import col_party, col_rate
 from pokeai.ai.random_policy import RandomPolicy
 from pokeai.ai.rl_policy import RLPolicy
 from pokeai.ai.surrogate_reward_config import SurrogateRewardConfigZero
 from pokeai.sim.battle_stream_processor import BattleStreamProcessor
-from pokeai.sim.sim import Sim
+from pokeai.sim.sim import Sim, BattleSpec
+from pokeai.sim.sim_pool import SimPool, BattleJob
 from pokeai.util import json_load
 
 logger = getLogger(__name__)
 
 
-def match_players(sim, parties, policies):
-    bsps = []
-    for i in [0, 1]:
-        bsp = BattleStreamProcessor()
-        bsp.set_policy(policies[i])
-        bsps.append(bsp)
-    sim.set_processor(bsps)
-    sim.set_party(parties)
+def match_players(sim, matches: List[Tuple[list, list]], parallel_battles: int) -> List[int]:
+    """
+    複数の対戦を並行して行う
+    :param sim: SimまたはSimPool
+    :param matches: 各対戦の(パーティ, 方策)。SimPoolの場合、方策はpolicy spec
+    :param parallel_battles: 同時に進行させる対戦数(Simの場合)
+    :return: 各対戦の勝者(0: player 1, 1: player 2, -1: 引き分け)
+    """
+    if isinstance(sim, SimPool):
+        job_results = sim.run([BattleJob(parties, policy_specs) for parties, policy_specs in matches])
+        return [{'p1': 0, 'p2': 1, '': -1}[job_result.winner] for job_result in job_results]
+    specs = []
+    for parties, policies in matches:
+        bsps = []
+        for i in [0, 1]:
+            bsp = BattleStreamProcessor()
+            bsp.set_policy(policies[i])
+            bsps.append(bsp)
+        specs.append(BattleSpec(parties, bsps))
     with torch.no_grad():
-        result = sim.run()
-    winner = {'p1': 0, 'p2': 1, '': -1}[result['winner']]
-    return winner
+        results = sim.run_multi(specs, max_concurrent=parallel_battles)
+    return [{'p1': 0, 'p2': 1, '': -1}[result['winner']] for result in results]
 
 
-def rating_battle(parties, policies, player_ids, match_count: int, fixed_rates: List[float] = None) -> Tuple[
-    List[float], list]:
+def rating_battle(parties, policies, player_ids, match_count: int, fixed_rates: List[float] = None,
+                  parallel_battles: int = 1, sim_pool: Optional[SimPool] = None,
+                  batch_decisions: bool = False) -> Tuple[List[float], list]:
     """
     パーティ同士を多数戦わせ、レーティングを算出する。
     :param parties:
     :param policies:
     :param match_count: 1エージェント当たりの対戦回数
     :param fixed_rates: 各パーティの固定レート。固定されてないパーティは0。
+    :param parallel_battles: 1つのシミュレータで同時に進行させる対戦数
+    :param sim_pool: 指定した場合、ワーカープロセス群で対戦を行う。policiesはpolicy specで与える
+    :param batch_decisions: sim_poolを使わない場合、並行に進む対戦の行動選択のモデル計算をまとめる
     :return: パーティのレーティングおよび対戦ログ
     """
     assert len(parties) == len(policies)
     assert len(fixed_rates) == len(parties)
-    sim = Sim()
+    sim = sim_pool or Sim(batch_decisions=batch_decisions)
 
     # レート初期値設定
     rates = np.full((len(parties),), 1500.0)
@@ -65,6 +82,9 @@ def rating_battle(parties, policies, player_ids, match_count: int, fixed_rates:
         # レーティングに乱数を加算し、ソートして隣接パーティ同士を戦わせる
         rates_with_random = rates + np.random.normal(scale=200., size=rates.shape)
         ranking = np.argsort(rates_with_random).tolist()  # type: List[int]
+        # 1ラウンド内の対戦は互いに異なるパーティ同士なので、並行して行っても結果は変わらない
+        # 方策オブジェクトは複数の対戦で共有されるが、評価用の方策は対戦中の内部状態に依存しない
+        pairs = []
         for j in range(0, len(parties), 2):
             if j + 1 >= len(parties):
                 # 奇数個パーティがある場合
@@ -74,25 +94,35 @@ def rating_battle(parties, policies, player_ids, match_count: int, fixed_rates:
             if fixed_rates[left] != 0 and fixed_rates[right] != 0:
                 # どちらもレート固定パーティなので、対戦不要
                 continue
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug(f"match start: " + json.dumps({
-                    "p1": {"player_id": player_ids[left], "party": parties[left]},
-                    "p2": {"player_id": player_ids[right], "party": parties[right]},
-                }))
-            winner = match_players(sim, [parties[left], parties[right]], [policies[left], policies[right]])
-            # レートを変動させる
-            if winner >= 0:
-                left_winrate = 1.0 / (1.0 + 10.0 ** ((rates[right] - rates[left]) / 400.0))
-                if winner == 0:
-                    left_incr = 32 * (1.0 - left_winrate)
-                else:
-                    left_incr = 32 * (-left_winrate)
-                if fixed_rates[left] == 0:
-                    rates[left] += left_incr
-                if fixed_rates[right] == 0:
-                    rates[right] -= left_incr
-            log.append([left, right, winner])
-            logger.debug(f"match end: winner: {winner}")
+            pairs.append((left, right))
+        if logger.isEnabledFor(logging.DEBUG):
+            # 対戦ログの解析(format_battle_log.py)は対戦が1つずつ順に進むことを前提とするため、並行させない
+            pair_groups = [[pair] for pair in pairs]
+        else:
+            pair_groups = [pairs]
+        for pair_group in pair_groups:
+            for left, right in pair_group:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"match start: " + json.dumps({
+                        "p1": {"player_id": player_ids[left], "party": parties[left]},
+                        "p2": {"player_id": player_ids[right], "party": parties[right]},
+                    }))
+            winners = match_players(sim, [([parties[left], parties[right]], [policies[left], policies[right]])
+                                          for left, right in pair_group], parallel_battles)
+            for (left, right), winner in zip(pair_group, winners):
+                # レートを変動させる
+                if winner >= 0:
+                    left_winrate = 1.0 / (1.0 + 10.0 ** ((rates[right] - rates[left]) / 400.0))
+                    if winner == 0:
+                        left_incr = 32 * (1.0 - left_winrate)
+                    else:
+                        left_incr = 32 * (-left_winrate)
+                    if fixed_rates[left] == 0:
+                        rates[left] += left_incr
+                    if fixed_rates[right] == 0:
+                        rates[right] -= left_incr
+                log.append([left, right, winner])
+                logger.debug(f"match end: winner: {winner}")
         abs_mean_diff = np.mean(np.abs(rates - 1500.0))
         logger.info(f"{i} rate mean diff: {abs_mean_diff}")
     return rates.tolist(), log
@@ -110,6 +140,12 @@ def main():
                         default="INFO")
     parser.add_argument("--log", help="ログファイルパス")
     parser.add_argument("--rate_id")
+    parser.add_argument("--parallel_battles", type=int, default=16, help="1つのシミュレータで同時に進行させる対戦数")
+    parser.add_argument("--workers", type=int, default=0, help="対戦を行うワーカープロセス数(0ならメインプロセスで対戦)")
+    parser.add_argument("--inference_server", action="store_true",
+                        help="ワーカーの行動選択のモデル計算を、推論サーバでまとめて行う(--workers指定時。--batch_decisionsも有効になる)")
+    parser.add_argument("--batch_decisions", action="store_true",
+                        help="1つのシミュレータで並行に進む対戦の行動選択のモデル計算を、まとめて行う")
     args = parser.parse_args()
     logging.basicConfig(level=getattr(logging, args.loglevel), filename=args.log)
     rate_id = ObjectId(args.rate_id)  # Noneならランダム生成
@@ -136,8 +172,27 @@ def main():
             for party_id in src_parties.keys():
                 player_ids.append(f"{trainer_id}+{party_id}")
     src_policies = {}
+    inference_models = {}
+    inference_specs = {}
+    if args.workers > 0 and args.inference_server:
+        for trainer_id in src_trainer_ids:
+            if trainer_id != "#random":
+                trainer = load_trainer(trainer_id)
+                inference_models[trainer_id] = trainer.agent_model
+                inference_specs[trainer_id] = {"model_key": trainer_id,
+                                               "feature_params": trainer.constructor_params["feature_params"]}
+    inference_server = InferenceServer(inference_models) if len(inference_models) > 0 else None
     for trainer_id in src_trainer_ids:
-        if trainer_id == "#random":
+        if args.workers > 0:
+            # ワーカー内で方策を構築する
+            if trainer_id == "#random":
+                policy = {"type": "random"}
+            elif inference_server is not None:
+                policy = {"type": "trainer", "trainer_id": trainer_id,
+                          "inference": dict(inference_specs[trainer_id], address=inference_server.address)}
+            else:
+                policy = {"type": "trainer", "trainer_id": trainer_id}
+        elif trainer_id == "#random":
             policy = RandomPolicy()
         else:
             trainer = load_trainer(trainer_id)
@@ -150,7 +205,20 @@ def main():
         parties.append(src_parties[party_id])
         policies.append(src_policies[trainer_id])
     fixed_rates = [0.0] * len(parties)  # 未使用
-    rates, log = rating_battle(parties, policies, player_ids, args.match_count, fixed_rates=fixed_rates)
+    # 推論サーバへの要求はワーカー内の対戦間でまとめないと、対戦ごとの通信が多くなる
+    batch_decisions = args.batch_decisions or inference_server is not None
+    sim_pool = None
+    if args.workers > 0:
+        sim_pool = SimPool(args.workers, build_policy, initializer=init_worker,
+                           battles_per_worker=args.parallel_battles,
+                           sim_kwargs={'read_timeout': 60.0, 'batch_decisions': batch_decisions})
+    rates, log = rating_battle(parties, policies, player_ids, args.match_count, fixed_rates=fixed_rates,
+                               parallel_battles=args.parallel_battles, sim_pool=sim_pool,
+                               batch_decisions=batch_decisions)
+    if sim_pool is not None:
+        sim_pool.close()
+    if inference_server is not None:
+        inference_server.close()
     print(f"rate_id: {rate_id}")
     col_rate.insert_one({
         "_id": rate_id,
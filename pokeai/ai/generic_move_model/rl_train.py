@@ -4,15 +4,24 @@
 """
 
 import argparse
+import copy
 import os
 import random
-from typing import List, Tuple
+import threading
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import torch
 from bson import ObjectId
 from tqdm import tqdm
 
+from pokeai import stage_timer
+from pokeai.ai.generic_move_model.actor_learner import ActorLearner
+from pokeai.ai.generic_move_model.agent_val import AgentVal
+from pokeai.ai.generic_move_model.inference_server import InferenceServer
+from pokeai.ai.generic_move_model.memmap_replay_buffer import MemmapReplayBuffer
+from pokeai.ai.generic_move_model.policy_spec import build_policy, collect_replay, init_worker
+from pokeai.ai.generic_move_model.replay_buffer import ReplayBuffer
 from pokeai.ai.generic_move_model.trainer import Trainer
 from pokeai.ai.party_db import col_party, col_trainer, fs_checkpoint, pack_obj, unpack_obj
 from pokeai.ai.random_policy import RandomPolicy
@@ -21,7 +30,8 @@ from pokeai.ai.surrogate_reward_config import SurrogateRewardConfigZero, Surroga
     SurrogateRewardConfigDefaults
 from pokeai.sim.battle_stream_processor import BattleStreamProcessor
 from pokeai.sim.party_generator import Party
-from pokeai.sim.sim import Sim
+from pokeai.sim.sim import Sim, BattleSpec
+from pokeai.sim.sim_pool import SimPool, BattleJob
 from pokeai.util import yaml_load
 
 
@@ -39,33 +49,114 @@ def battle_once(sim, trainer: Trainer, target_parties: List[Party]) -> float:
     return {'p1': 1.0, 'p2': 0.0, '': 0.5}[battle_result['winner']]
 
 
+def make_policy_spec(trainer: Trainer, spec_type: str,
+                     surrogate_reward_config: Optional[SurrogateRewardConfig] = None,
+                     inference_server: Optional[InferenceServer] = None) -> dict:
+    """
+    学習中のモデルをSimPoolのワーカーで使うためのpolicy specを生成する
+    SimPoolはinit_workerにtrainer.constructor_params, trainer.agent_modelを渡して起動しておくこと
+    :param trainer:
+    :param spec_type: "train" or "val"
+    :param surrogate_reward_config: "train"の場合に使用
+    :param inference_server: 指定した場合、モデルの計算をこの推論サーバで行う。trainer.agent_modelを"train"の名前で登録しておくこと
+    :return:
+    """
+    # ワーカー(または推論サーバ)が読む共有モデルを最新にする。パラメータ自体はspecに含めない
+    if trainer.agent_model.version != trainer.update_steps:
+        trainer.agent_model.update(trainer.model, trainer.update_steps)
+    if inference_server is not None:
+        spec = {"type": spec_type, "inference": {"address": inference_server.address, "model_key": "train",
+                                                 "feature_params": trainer.constructor_params["feature_params"]}}
+    else:
+        spec = {"type": spec_type, "version": trainer.update_steps}
+    if spec_type == "train":
+        spec["epsilon"] = trainer.current_epsilon
+        spec["surrogate_reward_config"] = surrogate_reward_config
+    return spec
+
+
+def random_val_pool(sim_pool: SimPool, trainer: Trainer, parties: List[Party],
+                    battles: int, inference_server: Optional[InferenceServer] = None) -> float:
+    val_spec = make_policy_spec(trainer, "val", inference_server=inference_server)
+    jobs = [BattleJob(random.sample(parties, 2), [val_spec, {"type": "random"}]) for _ in range(battles)]
+    job_results = sim_pool.run(jobs)
+    # player 1 = エージェント側の勝率
+    agent_scores = [{'p1': 1.0, 'p2': 0.0, '': 0.5}[job_result.winner] for job_result in job_results]
+    return float(np.mean(agent_scores))
+
+
 def random_val(sim, trainer: Trainer, parties: List[Party], battles: int) -> float:
-    agent_scores = []
+    return random_val_agent(sim, trainer.get_val_agent(), parties, battles)
+
+
+def random_val_agent(sim, agent: AgentVal, parties: List[Party], battles: int) -> float:
+    # 評価用エージェントは対戦中の内部状態を持たないので、全対戦で共有して並行に対戦させる
+    specs = []
     for battle_idx in range(battles):
-        target_parties = random.sample(parties, 2)
-        agent_score = battle_once(sim, trainer, target_parties)
-        agent_scores.append(agent_score)
+        bsp_t = BattleStreamProcessor()
+        bsp_t.set_policy(RLPolicy(agent, SurrogateRewardConfigZero))
+        bsp_o = BattleStreamProcessor()
+        bsp_o.set_policy(RandomPolicy())
+        specs.append(BattleSpec(random.sample(parties, 2), [bsp_t, bsp_o]))
+    with torch.no_grad():
+        battle_results = sim.run_multi(specs)
+    # player 1 = エージェント側の勝率
+    agent_scores = [{'p1': 1.0, 'p2': 0.0, '': 0.5}[battle_result['winner']] for battle_result in battle_results]
     return float(np.mean(agent_scores))
 
 
 def train_episode(sim, trainer: Trainer, target_parties: List[Party], surrogate_reward_config: SurrogateRewardConfig):
+    return train_episodes(sim, trainer, [target_parties], surrogate_reward_config)[0]
+
+
+def train_episodes(sim, trainer: Trainer, target_parties_list: List[List[Party]],
+                   surrogate_reward_config: SurrogateRewardConfig) -> List[str]:
+    """
+    同じモデルのエージェントで複数のバトルを並行して行い、その後学習する
+    :param sim:
+    :param trainer:
+    :param target_parties_list: バトルごとのパーティ
+    :param surrogate_reward_config:
+    :return: バトルごとの勝者
+    """
     agents = []
-    bsps = []
-    for player in range(2):
-        agent = trainer.get_train_agent()
-        bsp = BattleStreamProcessor()
-        bsp.set_policy(RLPolicy(agent, surrogate_reward_config))
-        agents.append(agent)
-        bsps.append(bsp)
-    sim.set_processor(bsps)
-    sim.set_party(target_parties)
+    specs = []
+    for target_parties in target_parties_list:
+        bsps = []
+        for player in range(2):
+            agent = trainer.get_train_agent()
+            bsp = BattleStreamProcessor()
+            bsp.set_policy(RLPolicy(agent, surrogate_reward_config))
+            agents.append(agent)
+            bsps.append(bsp)
+        specs.append(BattleSpec(target_parties, bsps))
     with torch.no_grad():
-        battle_result = sim.run()
-    for player in range(2):
-        trainer.extend_replay_buffer(agents[player]._replay_buffer)
-    trainer.total_battles += 1
+        battle_results = sim.run_multi(specs)
+    for agent in agents:
+        trainer.extend_replay_buffer(agent._replay_buffer)
+    trainer.total_battles += len(specs)
+    trainer.train()
+    return [battle_result["winner"] for battle_result in battle_results]  # 'p1', 'p2', '' (forcetieで引き分けの時)
+
+
+def train_episodes_pool(sim_pool: SimPool, trainer: Trainer, target_parties_list: List[List[Party]],
+                        surrogate_reward_config: SurrogateRewardConfig,
+                        inference_server: Optional[InferenceServer] = None) -> List[str]:
+    """
+    train_episodesと同様の処理を、ワーカープロセス群で並列に行う
+    """
+    train_spec = make_policy_spec(trainer, "train", surrogate_reward_config, inference_server)
+    jobs = [BattleJob(target_parties, [train_spec, train_spec], collect_replay=True)
+            for target_parties in target_parties_list]
+    job_results = sim_pool.run(jobs)
+    for job_result in job_results:
+        for replay in job_result.replay:
+            buffer = ReplayBuffer(None)
+            buffer.extend(replay)
+            trainer.extend_replay_buffer(buffer)
+    trainer.total_battles += len(jobs)
     trainer.train()
-    return battle_result["winner"]  # 'p1', 'p2', '' (forcetieで引き分けの時)
+    return [job_result.winner for job_result in job_results]
 
 
 def make_match_pairs(rates: List[float], random_std: float) -> List[Tuple[int, int]]:
@@ -100,6 +191,100 @@ def update_rate(rates: List[float], match_pair: Tuple[int, int], winner: str):
         rates[right] -= left_incr
 
 
+def save_checkpoint(trainer: Trainer, trainer_id: ObjectId, match_pairs_queue: List[Tuple[int, int]],
+                    rates: List[float]):
+    save_state_dict = trainer.save_state(resume=True)
+    # trainerに含まれていないが再開に必要な情報を格納
+    save_state_dict["_rl_train"] = {"match_pairs_queue": match_pairs_queue, "rates": rates}
+    fs_checkpoint.put(pack_obj(save_state_dict), filename=str(trainer_id),
+                      metadata={"battles": trainer.total_battles})
+
+
+def _random_val_background(sim: Sim, agent: AgentVal, parties: List[Party], battles: int, battle_idx: int):
+    # actor/learner分離モードの評価。学習を止めないよう別スレッドで行う
+    score = random_val_agent(sim, agent, parties, battles)
+    print("mean score", score, f"(model at battle {battle_idx})")
+
+
+def train_actor_learner(trainer: Trainer, trainer_id: ObjectId, train_params: dict, parties: List[Party],
+                        rates: List[float], match_pairs_queue: List[Tuple[int, int]],
+                        surrogate_reward_config: SurrogateRewardConfig, stop_file_path: str):
+    """
+    actor/learner分離モードでの学習ループ
+    actorプロセス群がバトルを続け、このプロセスは結果を受け取りながら学習を続ける
+    :param trainer:
+    :param trainer_id:
+    :param train_params:
+    :param parties:
+    :param rates: 更新される
+    :param match_pairs_queue:
+    :param surrogate_reward_config:
+    :param stop_file_path:
+    :return:
+    """
+    workers = train_params["workers"]
+    battles = train_params["battles"]
+    checkpoint_per_battles = train_params["checkpoint_per_battles"]
+    battles_per_actor = max(train_params.get("parallel_battles", 1) // workers, 1)
+    # actorが待たないよう、各actorが同時に進めるバトル数の2倍を依頼しておく
+    max_pending = workers * battles_per_actor * 2
+    pending = {}  # type: Dict[int, Tuple[int, int]]  # job_id => 対戦するパーティの組
+    next_job_id = 0
+    submitted_battles = trainer.total_battles
+    sim = None  # 評価用
+    val_thread = None  # type: Optional[threading.Thread]
+    stopped = False
+    pbar = tqdm(total=battles, initial=trainer.total_battles)
+    sim_kwargs = {'read_timeout': 60.0, 'batch_decisions': train_params.get("batch_decisions", False)}
+    with ActorLearner(trainer, workers, surrogate_reward_config, battles_per_actor, sim_kwargs) as actor_learner:
+        while True:
+            while len(pending) < max_pending and submitted_battles < battles:
+                if len(match_pairs_queue) == 0:
+                    match_pairs_queue = make_match_pairs(rates, train_params["match_config"]["random_std"])
+                match_pair = match_pairs_queue.pop(0)
+                actor_learner.submit(next_job_id, [parties[match_pair[0]], parties[match_pair[1]]])
+                pending[next_job_id] = match_pair
+                next_job_id += 1
+                submitted_battles += 1
+            if len(pending) == 0:
+                break
+            # 学習が追いついていればバトルの終了を待つ
+            learned = actor_learner.learn_step()
+            result = actor_learner.receive(timeout=0 if learned else 1.0)
+            if result is None:
+                continue
+            update_rate(rates, pending.pop(result.job_id), result.winner)
+            pbar.update(1)
+            battle_idx = trainer.total_battles - 1
+            if battle_idx % 1000 == 0:
+                if val_thread is not None and val_thread.is_alive():
+                    print("skipped evaluation because the previous one is still running")
+                else:
+                    if sim is None:
+                        sim = Sim()
+                    # trainer.get_val_agentはactorに配るtrainer.agent_modelを更新してしまうので、モデルの複製を使う
+                    val_model = copy.deepcopy(trainer.model)
+                    val_model.eval()
+                    val_agent = AgentVal(val_model, trainer.feature_extractor)
+                    val_thread = threading.Thread(target=_random_val_background,
+                                                  args=(sim, val_agent, parties, 100, battle_idx), daemon=True)
+                    val_thread.start()
+            stop_file_exists = os.path.exists(stop_file_path)
+            if battle_idx % checkpoint_per_battles == checkpoint_per_battles - 1 or stop_file_exists:
+                # 実行中のバトルの組は、再開時に最初に行う
+                save_checkpoint(trainer, trainer_id, list(pending.values()) + match_pairs_queue, rates)
+                if stop_file_exists:
+                    stopped = True
+                    break
+    pbar.close()
+    if not stopped:
+        # 学習はバトルの結果を受け取るより遅れているので、最後のバトルまでの遷移で学習してから保存する
+        trainer.train()
+        save_checkpoint(trainer, trainer_id, match_pairs_queue, rates)
+    if val_thread is not None:
+        val_thread.join()
+
+
 def main():
     import logging
     parser = argparse.ArgumentParser()
@@ -108,8 +293,13 @@ def main():
     parser.add_argument("--resume", action="store_true")
     parser.add_argument("--loglevel", help="ログ出力(stderr)のレベル", choices=["INFO", "WARNING", "DEBUG"],
                         default="INFO")
+    parser.add_argument("--stage_timer", help="処理段階ごとの所要時間を計測し、指定したjsonファイルに書き出す")
+    parser.add_argument("--stage_timer_interval", type=int, default=0,
+                        help="所要時間の計測結果を書き出すバトル数間隔。0なら終了時のみ")
     args = parser.parse_args()
     logging.basicConfig(level=getattr(logging, args.loglevel))
+    if args.stage_timer:
+        stage_timer.enable()
     train_params = yaml_load(args.train_param_file)
     stop_file_path = args.train_param_file + ".stop"
     if os.path.exists(stop_file_path):
@@ -141,6 +331,9 @@ def main():
             print(f"trainer info for {trainer_id} already exists on db")
             return
         trainer = Trainer(**train_params["trainer"])
+        if isinstance(trainer.replay_buffer, MemmapReplayBuffer):
+            # 以前の実行のリプレイバッファが残っていれば、dbに登録する前に中止する
+            trainer.replay_buffer.claim()
         if args.initialize_by_trainer:
             trainer_for_initialize = unpack_obj(fs_checkpoint.get_last_version(args.initialize_by_trainer).read())
             trainer.load_initial_model(trainer_for_initialize["model"])
@@ -150,26 +343,72 @@ def main():
             "train_params": train_params,
             "tags": tags,
         })
-    sim = Sim()
-    for battle_idx in tqdm(range(trainer.total_battles, train_params["battles"])):
-        if len(match_pairs_queue) == 0:
-            match_pairs_queue = make_match_pairs(rates, train_params["match_config"]["random_std"])
-        match_pair = match_pairs_queue.pop(0)
-        winner = train_episode(sim, trainer, [parties[match_pair[0]], parties[match_pair[1]]], surrogate_reward_config)
-        update_rate(rates, match_pair, winner)
-        if battle_idx % 1000 == 0:
-            print("mean score", random_val(sim, trainer, parties, 100))
+    # 1つのシミュレータ(ワーカーを使う場合は全ワーカー合計)で同時に進行させるバトル数。その間モデルは更新されない
+    parallel_battles = train_params.get("parallel_battles", 1)
+    # バトルを行うワーカープロセス数。0ならメインプロセスで行う
+    workers = train_params.get("workers", 0)
+    if workers > 0 and train_params.get("actor_learner", False):
+        # バトルと学習を別プロセスで並行して行う
+        train_actor_learner(trainer, trainer_id, train_params, parties, rates, match_pairs_queue,
+                            surrogate_reward_config, stop_file_path)
+        if args.stage_timer:
+            stage_timer.dump(args.stage_timer, {"battles": trainer.total_battles})
+        return
+    # 1つのシミュレータで並行に進むバトルの行動選択のモデル計算をまとめる
+    batch_decisions = train_params.get("batch_decisions", False)
+    sim = None
+    sim_pool = None
+    inference_server = None
+    if workers > 0:
+        if train_params.get("inference_server", False):
+            # ワーカーの行動選択のモデル計算を、1つのプロセスでまとめて行う
+            # 推論サーバへの要求はワーカー内のバトル間でもまとめないと、バトルごとの通信が多くなる
+            inference_server = InferenceServer({"train": trainer.agent_model})
+            batch_decisions = True
+        # 学習中モデルのパラメータは共有メモリ上のtrainer.agent_modelを介して渡す
+        sim_pool = SimPool(workers, build_policy, replay_collector=collect_replay, initializer=init_worker,
+                           initargs=(trainer.constructor_params, trainer.agent_model),
+                           battles_per_worker=max(parallel_battles // workers, 1),
+                           sim_kwargs={'read_timeout': 60.0, 'batch_decisions': batch_decisions})
+    else:
+        sim = Sim(batch_decisions=batch_decisions)
+    for battle_idx in tqdm(range(trainer.total_battles, train_params["battles"], parallel_battles)):
+        battle_idxs = range(battle_idx, min(battle_idx + parallel_battles, train_params["battles"]))
+        match_pairs = []
+        for _ in battle_idxs:
+            if len(match_pairs_queue) == 0:
+                match_pairs_queue = make_match_pairs(rates, train_params["match_config"]["random_std"])
+            match_pairs.append(match_pairs_queue.pop(0))
+        target_parties_list = [[parties[match_pair[0]], parties[match_pair[1]]] for match_pair in match_pairs]
+        if sim_pool is not None:
+            winners = train_episodes_pool(sim_pool, trainer, target_parties_list, surrogate_reward_config,
+                                          inference_server)
+        else:
+            winners = train_episodes(sim, trainer, target_parties_list, surrogate_reward_config)
+        for match_pair, winner in zip(match_pairs, winners):
+            update_rate(rates, match_pair, winner)
+        if args.stage_timer and args.stage_timer_interval > 0 and \
+                any(idx % args.stage_timer_interval == (args.stage_timer_interval - 1) for idx in battle_idxs):
+            stage_timer.dump(args.stage_timer, {"battles": trainer.total_battles})
+        if any(idx % 1000 == 0 for idx in battle_idxs):
+            if sim_pool is not None:
+                print("mean score", random_val_pool(sim_pool, trainer, parties, 100, inference_server))
+            else:
+                print("mean score", random_val(sim, trainer, parties, 100))
         stop_file_exists = os.path.exists(stop_file_path)
-        if (battle_idx % train_params["checkpoint_per_battles"] == (
-                train_params["checkpoint_per_battles"] - 1)) or stop_file_exists:
-            save_state_dict = trainer.save_state(resume=True)
-            # trainerに含まれていないが再開に必要な情報を格納
-            save_state_dict["_rl_train"] = {"match_pairs_queue": match_pairs_queue, "rates": rates}
-            fs_checkpoint.put(pack_obj(save_state_dict), filename=str(trainer_id),
-                              metadata={"battles": trainer.total_battles})
-            del save_state_dict
+        if any(idx % train_params["checkpoint_per_battles"] == (train_params["checkpoint_per_battles"] - 1)
+               for idx in battle_idxs) or stop_file_exists:
+            save_checkpoint(trainer, trainer_id, match_pairs_queue, rates)
             if stop_file_exists:
                 break
+    if sim_pool is not None:
+        sim_pool.close()
+    if inference_server is not None:
+        inference_server.close()
+    if args.stage_timer:
+        stage_timer.dump(args.stage_timer, {"battles": trainer.total_battles})
+        for line in stage_timer.format_summary():
+            print(line)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,7 @@
 # https://pytorch.org/tutorials/intermediate/reinforcement_q_learning.html#dqn-algorithm
+import copy
 import math
+from typing import Optional, Union
 
 import numpy as np
 
@@ -9,8 +11,10 @@ import torch.nn.functional as F
 from pokeai.ai.generic_move_model.agent_train import AgentTrain
 from pokeai.ai.generic_move_model.agent_val import AgentVal
 from pokeai.ai.generic_move_model.feature_extractor import FeatureExtractor
-from pokeai.ai.generic_move_model.mlp_model import MLPModel
-from pokeai.ai.generic_move_model.replay_buffer import ReplayBuffer
+from pokeai.ai.generic_move_model.memmap_replay_buffer import MemmapReplayBuffer
+from pokeai.ai.generic_move_model.mlp_model import MLPModel, FactorizedMLPModel
+from pokeai.ai.generic_move_model.replay_buffer import ReplayBuffer, RingReplayBuffer, PrioritizedReplayBuffer
+from pokeai.ai.generic_move_model.versioned_model import VersionedModel
 
 DQN_DEFAULT_PARAMS = {
     "epsilon": 0.3,
@@ -23,9 +27,25 @@ DQN_DEFAULT_PARAMS = {
     "target_update": 100,
     "double_dqn": True,
     "replay_buffer_size": 100000,
+    "prioritized_replay": False,  # 優先度付き経験再生を用いる
+    "prioritized_replay_alpha": 0.6,  # 優先度の指数
+    "prioritized_replay_beta": 0.4,  # 重要度重みの指数の初期値
+    "prioritized_replay_beta_steps": 0,  # 重要度重みの指数を1まで線形に増やす学習ステップ数。0なら初期値のまま
+    # リプレイバッファをnp.memmapでディスク上に置く場合のディレクトリ。Noneならメモリ上
+    # チェックポイントにはディレクトリのみ記録し、再開時はファイルを開き直す
+    "replay_buffer_dir": None,
+    "replay_buffer_shards": 1,  # ディスク上のリプレイバッファのシャード数(同時に追加するプロセス数)
+    # エージェントが共有する推論用モデルを更新する学習ステップ数間隔。0なら学習が進むたびに更新する
+    "agent_model_refresh_steps": 0,
     "lr": 1e-3,
 }
 
+# model_paramsの"class"で選択するモデル。省略時はMLPModel
+MODEL_CLASSES = {
+    "MLPModel": MLPModel,
+    "FactorizedMLPModel": FactorizedMLPModel,
+}
+
 
 class Trainer:
     def __init__(self, model_params: dict, dqn_params: dict, feature_params: dict):
@@ -38,6 +58,8 @@ class Trainer:
         self.model_params = model_params.copy()
         self.model_params["input_shape"] = self.feature_extractor.input_shape
         self.model_params["output_dim"] = self.feature_extractor.output_dim
+        if self.model_params.get("class") == "FactorizedMLPModel":
+            self.model_params["state_dims"] = self.feature_extractor.state_dims
         self.model = self._construct_model()
         self.target_model = self._construct_model()
         self.target_model.load_state_dict(self.model.state_dict())
@@ -53,7 +75,15 @@ class Trainer:
 
         self.optimizer = optim.Adam(self.model.parameters(), lr=dqn_params_with_default["lr"])
 
-        self.replay_buffer = ReplayBuffer(dqn_params_with_default["replay_buffer_size"])
+        self.prioritized_replay = dqn_params_with_default["prioritized_replay"]
+        self.prioritized_replay_alpha = dqn_params_with_default["prioritized_replay_alpha"]
+        self.prioritized_replay_beta = dqn_params_with_default["prioritized_replay_beta"]
+        self.prioritized_replay_beta_steps = dqn_params_with_default["prioritized_replay_beta_steps"]
+        self.replay_buffer_dir = dqn_params_with_default["replay_buffer_dir"]
+        self.replay_buffer_shards = dqn_params_with_default["replay_buffer_shards"]
+        if self.prioritized_replay and self.replay_buffer_dir is not None:
+            raise ValueError("prioritized_replay is not supported with replay_buffer_dir")
+        self.replay_buffer = self._construct_replay_buffer(dqn_params_with_default["replay_buffer_size"])
         self.epsilon = dqn_params_with_default["epsilon"]
         self.epsilon_decay = dqn_params_with_default["epsilon_decay"]
         self.epsilon_min = dqn_params_with_default["epsilon_min"]
@@ -63,12 +93,24 @@ class Trainer:
         self.optimize_per_steps = dqn_params_with_default["optimize_per_steps"]  # step回数ごとにoptimizeする
         self.target_update = dqn_params_with_default["target_update"]  # optimize回数ごとにtarget networkをupdate
         self.double_dqn = dqn_params_with_default["double_dqn"]
+        self.agent_model_refresh_steps = dqn_params_with_default["agent_model_refresh_steps"]
+        self._agent_model = None  # type: Optional[VersionedModel]
 
         self.update_loss_history = []
 
     def _construct_model(self):
-        # TODO: モデルクラスの選択
-        return MLPModel(**self.model_params)
+        model_params = self.model_params.copy()
+        model_class = MODEL_CLASSES[model_params.pop("class", "MLPModel")]
+        return model_class(**model_params)
+
+    def _construct_replay_buffer(self, size: int) -> Union[RingReplayBuffer, MemmapReplayBuffer]:
+        if self.replay_buffer_dir is not None:
+            return MemmapReplayBuffer(self.replay_buffer_dir, size, self.feature_extractor.state_dims,
+                                      self.feature_extractor.output_dim, n_shards=self.replay_buffer_shards)
+        if self.prioritized_replay:
+            return PrioritizedReplayBuffer(size, self.feature_extractor.state_dims, self.feature_extractor.output_dim,
+                                           alpha=self.prioritized_replay_alpha)
+        return RingReplayBuffer(size, self.feature_extractor.state_dims, self.feature_extractor.output_dim)
 
     def save_state(self, resume=False):
         """
@@ -97,49 +139,117 @@ class Trainer:
             }
 
     @classmethod
-    def load_state(cls, state, resume=False) -> "Trainer":
+    def load_state(cls, state, resume=False, model_class: Optional[str] = None) -> "Trainer":
         """
         save_stateで保存した情報を復元したインスタンスを生成する。
         :param state:
         :param resume: 学習の再開に必要な情報をロードする。
+        :param model_class: 保存時と異なるモデルクラス(MODEL_CLASSESのキー)で読み込む場合に指定。
+        MLPModelで保存したものをFactorizedMLPModelで読み込める。この場合optimizerの状態は引き継がない。
         :return:
         """
-        trainer = cls(**state["constructor_params"])
+        constructor_params = state["constructor_params"]
+        saved_model_class = constructor_params["model_params"].get("class", "MLPModel")
+        convert = model_class is not None and model_class != saved_model_class
+        if convert:
+            constructor_params = copy.deepcopy(constructor_params)
+            constructor_params["model_params"]["class"] = model_class
+        trainer = cls(**constructor_params)
         trainer.model.load_state_dict(state["model"])
         trainer.update_steps = state["update_steps"]
         if resume:
             trainer.total_steps = state["total_steps"]
             trainer.total_battles = state["total_battles"]
             trainer.target_model.load_state_dict(state["target_model"])
-            trainer.optimizer.load_state_dict(state["optimizer"])
+            if not convert:
+                trainer.optimizer.load_state_dict(state["optimizer"])
             trainer.replay_buffer = state["replay_buffer"]
+            trainer._migrate_replay_buffer()
             trainer.update_loss_history = state["update_loss_history"]
         return trainer
 
+    def _migrate_replay_buffer(self):
+        """
+        以前の形式(ReplayBufferItemのdeque)のリプレイバッファを、RingReplayBufferに変換する
+        密な行列の状態を保持していたものは疎な形式に変換する
+        :return:
+        """
+        old_buffer = self.replay_buffer
+        if not isinstance(old_buffer, ReplayBuffer):
+            return
+        self.replay_buffer = self._construct_replay_buffer(old_buffer.buffer.maxlen or max(len(old_buffer), 1))
+        sparsify = self.feature_extractor.sparsify
+        for item in old_buffer.buffer:
+            if isinstance(item.state, np.ndarray):
+                item = item._replace(
+                    state=sparsify(item.state),
+                    next_state=sparsify(item.next_state) if item.next_state is not None else None)
+            self.replay_buffer.append(item)
+
     def load_initial_model(self, state_dict):
         self.model.load_state_dict(state_dict)
         self.target_model.load_state_dict(state_dict)
+        if self._agent_model is not None:
+            self._agent_model.update(self.model, self.update_steps)
+
+    @property
+    def current_epsilon(self) -> float:
+        """
+        現在のステップ数における、学習用エージェントのランダム行動確率
+        """
+        return max(math.pow(1.0 - self.epsilon_decay, self.total_steps) * self.epsilon, self.epsilon_min)
+
+    @property
+    def current_prioritized_replay_beta(self) -> float:
+        """
+        現在の学習ステップ数における、優先度付き経験再生の重要度重みの指数
+        """
+        if self.prioritized_replay_beta_steps <= 0:
+            return self.prioritized_replay_beta
+        progress = min(self.update_steps / self.prioritized_replay_beta_steps, 1.0)
+        return self.prioritized_replay_beta + (1.0 - self.prioritized_replay_beta) * progress
+
+    @property
+    def agent_model(self) -> VersionedModel:
+        """
+        エージェントが共有する推論用モデル。バージョンは作成・更新時のupdate_steps
+        更新はrefresh_agent_model(get_train_agent, get_val_agentから呼ばれる)が行う
+        """
+        if self._agent_model is None:
+            self._agent_model = VersionedModel(self.model, self.update_steps)
+        return self._agent_model
+
+    def refresh_agent_model(self) -> torch.nn.Module:
+        """
+        学習がagent_model_refresh_steps以上進んでいれば、推論用モデルを更新する
+        :return: 推論用モデル
+        """
+        agent_model = self.agent_model
+        if self.update_steps - agent_model.version >= max(self.agent_model_refresh_steps, 1):
+            agent_model.update(self.model, self.update_steps)
+        return agent_model.model
 
     def get_train_agent(self):
-        model = self._construct_model()
-        model.load_state_dict(self.model.state_dict())
-        model.eval()
-        epsilon = max(math.pow(1.0 - self.epsilon_decay, self.total_steps) * self.epsilon, self.epsilon_min)
-        return AgentTrain(model, self.feature_extractor, epsilon)
+        # 推論用モデルはバトル間で共有する。バトル中に学習しないこと(モデルが書き換わる)
+        return AgentTrain(self.refresh_agent_model(), self.feature_extractor, self.current_epsilon)
 
     def get_val_agent(self):
-        model = self._construct_model()
-        model.load_state_dict(self.model.state_dict())
-        model.eval()
-        return AgentVal(model, self.feature_extractor)
+        return AgentVal(self.refresh_agent_model(), self.feature_extractor)
 
     def extend_replay_buffer(self, buffer: ReplayBuffer):
         steps = len(buffer)
         self.total_steps += steps
         self.replay_buffer.extend(buffer.buffer)
 
-    def train(self):
-        while self.update_steps < self.total_steps:
+    def train(self, max_steps: Optional[int] = None) -> int:
+        """
+        replay bufferに追加されたステップ数に追いつくまで学習する
+        :param max_steps: 進める最大ステップ数。Noneなら追いつくまで
+        :return: 進めたステップ数
+        """
+        steps = 0
+        while self.update_steps < self.total_steps and (max_steps is None or steps < max_steps):
+            steps += 1
             update_step = self.update_steps
             if update_step % self.optimize_per_steps == 0 and update_step >= self.first_update_steps:
                 # update
@@ -148,27 +258,34 @@ class Trainer:
                 # target update
                 self._target_update()
             self.update_steps += 1
+        return steps
 
     def _update(self):
-        transitions = self.replay_buffer.sample(self.batch_size)
-        b_state, b_action_mask, b_action, b_next_state, b_next_action_mask, b_reward = zip(*transitions)
-        non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
-                                                b_next_state)), dtype=torch.bool)
-        non_final_next_states = torch.from_numpy(np.stack([s for s in b_next_state
-                                                           if s is not None]))
-
-        state_batch = torch.from_numpy(np.stack(b_state))
-        action_batch = torch.from_numpy(np.array(b_action, dtype=np.int64)[:, np.newaxis])
-        reward_batch = torch.from_numpy(np.array(b_reward, dtype=np.float32))
+        if self.prioritized_replay:
+            batch, sample_idxs, sample_weights = self.replay_buffer.sample_prioritized(
+                self.batch_size, self.current_prioritized_replay_beta)
+        else:
+            batch = self.replay_buffer.sample(self.batch_size)
+        non_final = ~batch.done
+        non_final_mask = torch.from_numpy(non_final)
+        # リプレイバッファの疎な形式の状態を、モデルに入力する密な行列に戻す
+        densify = self.feature_extractor.densify_padded
+        non_final_next_states = torch.from_numpy(densify(batch.next_state[non_final], batch.next_choice[non_final]))
+
+        state_batch = torch.from_numpy(densify(batch.state, batch.choice))
+        action_batch = torch.from_numpy(batch.action[:, np.newaxis])
+        reward_batch = torch.from_numpy(batch.reward)
         state_action_values = self.model(state_batch).gather(1, action_batch)
         next_state_values = torch.zeros(self.batch_size)
         # 次のstateの最大action valueを合法手のみから求める
         # 非合法手に対応するaction valueに-infを加算
-        non_final_next_action_mask = np.stack([s for s in b_next_action_mask
-                                               if s is not None])
+        non_final_next_action_mask = batch.next_action_mask[non_final]
         non_final_next_states_bias = torch.from_numpy(
             np.where(non_final_next_action_mask, 0.0, -np.inf).astype(np.float32))
-        if self.double_dqn:
+        if not non_final.any():
+            # 全てエピソード終端
+            pass
+        elif self.double_dqn:
             # Double DQN
             # next_stateでのmodelが最大Q値をとるactionを求め、そのQ値をtarget_modelで求める
             next_action = (self.model(non_final_next_states) + non_final_next_states_bias).max(1)[1].detach()
@@ -184,7 +301,15 @@ class Trainer:
         expected_state_action_values = (next_state_values * self.gamma) + reward_batch
 
         # Compute Huber loss
-        loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1))
+        if self.prioritized_replay:
+            # 重要度重みでサンプリングの偏りを補正し、TD誤差で優先度を更新
+            elementwise_loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1),
+                                                reduction="none").squeeze(1)
+            loss = (elementwise_loss * torch.from_numpy(sample_weights)).mean()
+            td_errors = (state_action_values.squeeze(1) - expected_state_action_values).detach().numpy()
+            self.replay_buffer.update_priorities(sample_idxs, td_errors)
+        else:
+            loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1))
         self.update_loss_history.append(float(loss))
 
         # Optimize the model
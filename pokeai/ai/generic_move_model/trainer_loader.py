@@ -1,9 +1,12 @@
+from typing import Optional
+
 from pokeai.ai.generic_move_model.trainer import Trainer
 from pokeai.ai.party_db import fs_checkpoint, unpack_obj
 
 
-def load_trainer(trainer_id_with_battles: str) -> Trainer:
+def load_trainer(trainer_id_with_battles: str, model_class: Optional[str] = None) -> Trainer:
     # trainer_id@battles 形式で指定されたモデルをロード
+    # model_classを指定すると、そのモデルクラスに変換して読み込む(Trainer.load_state参照)
     elems = trainer_id_with_battles.split("@")
     if len(elems) == 1:
         f = fs_checkpoint.get_last_version(elems[0])
@@ -11,5 +14,5 @@ def load_trainer(trainer_id_with_battles: str) -> Trainer:
         f = fs_checkpoint.find_one({"filename": elems[0], "metadata": {"battles": int(elems[1])}})
     else:
         raise ValueError(f"Invalid trainer_id {trainer_id_with_battles}")
-    trainer = Trainer.load_state(unpack_obj(f.read()), resume=False)
+    trainer = Trainer.load_state(unpack_obj(f.read()), resume=False, model_class=model_class)
     return trainer
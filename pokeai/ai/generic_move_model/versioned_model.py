@@ -0,0 +1,61 @@
+"""
+推論用モデルとそのパラメータのバージョン
+Trainerが学習用・評価用エージェントに共有させるモデルや、actor/learner分離モードでactorに配るモデルに用いる
+"""
+import copy
+import multiprocessing
+from typing import Optional
+
+import torch
+
+
+class VersionedModel:
+    """
+    推論用モデルと、そのパラメータのバージョン(学習ステップ数)
+    パラメータは共有メモリ上に置き、更新は同じテンソルへのコピーで行う
+    このため、モデルを保持したエージェントはそのまま新しいパラメータを使い、spawnしたプロセスにもこのオブジェクトを渡せる
+    """
+
+    def __init__(self, model: torch.nn.Module, version: int):
+        """
+        :param model: コピー元のモデル
+        :param version: modelのパラメータのバージョン
+        """
+        self.model = copy.deepcopy(model)
+        self.model.eval()
+        self.model.requires_grad_(False)
+        self.model.share_memory()
+        # torchを使うプロセスはspawnで起動するので、それに渡せる同期オブジェクトとする
+        ctx = multiprocessing.get_context("spawn")
+        self._version = ctx.Value('q', version, lock=False)
+        self._lock = ctx.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version.value
+
+    def update(self, model: torch.nn.Module, version: int):
+        """
+        パラメータを書き換える
+        :param model: コピー元のモデル(self.modelと同じ構造)
+        :param version:
+        :return:
+        """
+        with self._lock, torch.no_grad():
+            state_dict = self.model.state_dict()
+            for name, tensor in model.state_dict().items():
+                state_dict[name].copy_(tensor)
+            self._version.value = version
+
+    def copy_to(self, model: torch.nn.Module, current_version: int) -> Optional[int]:
+        """
+        バージョンが進んでいれば、パラメータを別のモデルに読み込む(他のプロセスで、書き換え中のパラメータを使わないようにする場合)
+        :param model:
+        :param current_version: modelのパラメータのバージョン
+        :return: 読み込んだ場合そのバージョン、進んでいなければNone
+        """
+        if self._version.value == current_version:
+            return None
+        with self._lock:
+            model.load_state_dict(self.model.state_dict())
+            return self._version.value
@@ -59,7 +59,7 @@ def hillclimb(evaluator: FitnessEvaluator, party_generator: PartyGenerator, seed
     for seed_party in tqdm(seed_parties):
         current_party = seed_party
         for gen in range(generations):
-            candidates = [party_generator.neighbor(current_party) for _ in range(populations - 1)] + [current_party]
+            candidates = party_generator.neighbors(current_party, populations - 1) + [current_party]
             candidate_rates = [evaluator.evaluate(candidate) for candidate in candidates]
             best_rated_idx = int(np.argmax(candidate_rates))
             current_party = candidates[best_rated_idx]
@@ -80,7 +80,7 @@ def main():
         party_generator._pokemons,  # 使用可能全ポケモンとの対面の平均を使う
         config_file["fitness_weight"],
     )
-    seed_parties = [party_generator.generate() for _ in range(config_file["n"])]  # type: List[Party]
+    seed_parties = party_generator.generate_many(config_file["n"])  # type: List[Party]
     dst_tags = config_file["dst_tags"]
     assert isinstance(dst_tags, list)
     generated_parties = hillclimb(evaluator=evaluator,
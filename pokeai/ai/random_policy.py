@@ -1,5 +1,4 @@
 import json
-import random
 import logging
 from logging import getLogger
 
@@ -39,12 +38,12 @@ class RandomPolicy(ActionPolicy):
             else:
                 move_choices.append(ck)
 
-        if len(switch_choices) > 0 and (len(move_choices) == 0 or random.random() < self.switch_prob):
+        if len(switch_choices) > 0 and (len(move_choices) == 0 or self.rng.random() < self.switch_prob):
             # 交換しかできない場合か、両方できる場合で一定確率で交換を選ぶ
-            return random.choice(switch_choices).simulator_key
+            return self.rng.choice(switch_choices).simulator_key
         else:
             assert len(move_choices) > 0
-            return random.choice(move_choices).simulator_key
+            return self.rng.choice(move_choices).simulator_key
 
     def choice_force_switch(self, battle_status: BattleStatus, request: dict) -> str:
         """
@@ -59,6 +58,6 @@ class RandomPolicy(ActionPolicy):
             logger.debug(
                 'policy_choice_force_switch: ' + json.dumps([pa._asdict() for pa in possible_actions]))
         if len(possible_actions) > 1:
-            return random.choice(possible_actions).simulator_key
+            return self.rng.choice(possible_actions).simulator_key
         else:
             return possible_actions[0].simulator_key
@@ -3,6 +3,7 @@ import logging
 from logging import getLogger
 from typing import Optional
 
+from pokeai import stage_timer
 from pokeai.ai.generic_move_model.agent import Agent
 from pokeai.ai.battle_status import BattleStatus
 from pokeai.ai.common import get_possible_actions
@@ -22,6 +23,7 @@ class RLPolicy(RandomPolicy):
     agent: Agent
     surrogate_reward_config: SurrogateRewardConfig
     last_reward_potential: Optional[float]
+    use_state_feature_buffer = True
 
     def __init__(self, agent: Agent, surrogate_reward_config: SurrogateRewardConfig):
         """
@@ -81,6 +83,7 @@ class RLPolicy(RandomPolicy):
         :param choice_keys:
         :return:
         """
+        t = stage_timer.start()
         logger.debug(f"choice of player {battle_status.side_friend}")
         reward_potential = self._calc_reward_potential(battle_status)
         possible_actions = get_possible_actions(battle_status, request)
@@ -88,6 +91,7 @@ class RLPolicy(RandomPolicy):
             # 選択肢が１つだけの場合はモデルに与えない
             # 与える場合、action番号を正しく設定する必要あり(get_possible_actions内コメントに注意)
             logger.debug(f"only one choice: {possible_actions[0]}")
+            stage_timer.stop("policy.choice", t)
             return possible_actions[0].simulator_key
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(
@@ -98,10 +102,13 @@ class RLPolicy(RandomPolicy):
         else:
             surrogate_reward = 0.0
         logger.debug(f"surrogate_reward: {surrogate_reward}")
+        # エージェントは複数のバトルで共有されうるので、このバトルの乱数生成器を都度設定する
+        self.agent.rng = self.rng
         action = self.agent.act(obs, surrogate_reward)
         self.last_reward_potential = reward_potential
         chosen = possible_actions[action]
         logger.debug(f"chosen: {chosen}")
+        stage_timer.stop("policy.choice", t)
         return chosen.simulator_key
 
     def game_end(self, reward: float):
@@ -110,3 +117,7 @@ class RLPolicy(RandomPolicy):
             # 今までに与えた補助報酬をキャンセルし、ゲーム全体の報酬和は勝敗（この関数の引数）だけとする
             reward = reward - self.last_reward_potential
         self.agent.stop_episode(reward)
+
+    def game_abort(self):
+        self.agent.abort_episode()
+        self.last_reward_potential = None
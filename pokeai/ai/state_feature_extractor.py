@@ -1,4 +1,5 @@
-from typing import List, Optional
+import argparse
+from typing import Dict, List, Optional
 
 import numpy as np
 
@@ -32,6 +33,115 @@ NV_CONDITIONS = ["psn", "tox", "par", "brn", "slp", "frz"]
 RANKS = ['atk', 'def', 'spa', 'spd', 'spe', 'accuracy', 'evasion']
 WEATHERS = ["SunnyDay", "RainDance", "Sandstorm"]
 
+# 全特徴種類を用いる場合の各特徴の位置(StateFeatureExtractor.ALL_FEATURE_TYPESの順)
+_OFS_REMAINING_COUNT = 0
+_OFS_POKE_TYPE = _OFS_REMAINING_COUNT + 2
+_OFS_HP_RATIO = _OFS_POKE_TYPE + len(POKE_TYPES)
+_OFS_NV_CONDITION = _OFS_HP_RATIO + 2
+_OFS_RANK = _OFS_NV_CONDITION + len(NV_CONDITIONS) * 2
+_OFS_WEATHER = _OFS_RANK + len(RANKS) * 2
+_ALL_DIMS = _OFS_WEATHER + len(WEATHERS)
+_FEATURE_TYPE_SLICES = {
+    "remaining_count": slice(_OFS_REMAINING_COUNT, _OFS_POKE_TYPE),
+    "poke_type": slice(_OFS_POKE_TYPE, _OFS_HP_RATIO),
+    "hp_ratio": slice(_OFS_HP_RATIO, _OFS_NV_CONDITION),
+    "nv_condition": slice(_OFS_NV_CONDITION, _OFS_RANK),
+    "rank": slice(_OFS_RANK, _OFS_WEATHER),
+    "weather": slice(_OFS_WEATHER, _ALL_DIMS),
+}
+NV_CONDITION2NUM = {cond: i for i, cond in enumerate(NV_CONDITIONS)}
+WEATHER2NUM = {w: i for i, w in enumerate(WEATHERS)}
+
+_poke_type_feats = {}  # type: Dict[str, np.ndarray]
+
+
+def _get_poke_type_feat(species: str) -> np.ndarray:
+    # 種族ごとのタイプのベクトル(変更しないこと)
+    feat = _poke_type_feats.get(species)
+    if feat is None:
+        feat = np.zeros((len(POKE_TYPES),), dtype=np.float32)
+        for poke_type in dex.get_pokedex_by_name(species)["types"]:
+            feat[POKE_TYPE2NUM[poke_type]] = 1.0
+        _poke_type_feats[species] = feat
+    return feat
+
+
+class StateFeatureBuffer:
+    """
+    BattleStreamProcessorがメッセージを処理するたびに、変化した部分だけを更新する状態特徴量
+    全特徴種類(StateFeatureExtractor.ALL_FEATURE_TYPES)をtransformと同じ並びで保持する
+    BattleStatusを直接書き換えた場合はrefresh()を呼ぶこと
+    """
+    __slots__ = ['battle_status', 'feat']
+    battle_status: BattleStatus
+    feat: np.ndarray
+
+    def __init__(self, battle_status: BattleStatus):
+        self.battle_status = battle_status
+        self.feat = np.zeros((_ALL_DIMS,), dtype=np.float32)
+        self.refresh()
+
+    def _side_idx(self, side: str) -> int:
+        # 0: 自分側, 1: 相手側
+        return 0 if side == self.battle_status.side_friend else 1
+
+    def refresh(self):
+        """
+        全ての特徴を計算し直す
+        :return:
+        """
+        for side in ['p1', 'p2']:
+            self.update_remaining_count(side)
+            self.update_active(side)
+        self.update_weather()
+
+    def update_remaining_count(self, side: str):
+        side_status = self.battle_status.side_statuses[side]
+        if side_status.total_pokes > 0:
+            self.feat[_OFS_REMAINING_COUNT + self._side_idx(side)] = \
+                side_status.remaining_pokes / side_status.total_pokes
+
+    def update_active(self, side: str):
+        """
+        場のポケモンが交代した時の更新
+        :param side:
+        :return:
+        """
+        active = self.battle_status.side_statuses[side].active
+        if active is None:
+            return
+        if side == self.battle_status.side_opponent:
+            self.feat[_OFS_POKE_TYPE:_OFS_HP_RATIO] = _get_poke_type_feat(active.species)
+        self.update_hp_status(side)
+        self.update_rank(side)
+
+    def update_hp_status(self, side: str):
+        """
+        HPまたは状態異常が変化した時の更新
+        :param side:
+        :return:
+        """
+        active = self.battle_status.side_statuses[side].active
+        side_idx = self._side_idx(side)
+        self.feat[_OFS_HP_RATIO + side_idx] = active.hp_current / active.hp_max
+        ofs = _OFS_NV_CONDITION + side_idx * len(NV_CONDITIONS)
+        self.feat[ofs:ofs + len(NV_CONDITIONS)] = 0.0
+        cond_idx = NV_CONDITION2NUM.get(active.status)
+        if cond_idx is not None:
+            self.feat[ofs + cond_idx] = 1.0
+
+    def update_rank(self, side: str):
+        active = self.battle_status.side_statuses[side].active
+        ofs = _OFS_RANK + self._side_idx(side) * len(RANKS)
+        for i, cond in enumerate(RANKS):
+            self.feat[ofs + i] = (active.get_rank(cond) + 6.0) / 12.0  # 0~1
+
+    def update_weather(self):
+        self.feat[_OFS_WEATHER:_ALL_DIMS] = 0.0
+        weather_idx = WEATHER2NUM.get(self.battle_status.weather)
+        if weather_idx is not None:
+            self.feat[_OFS_WEATHER + weather_idx] = 1.0
+
 
 class StateFeatureExtractor:
     """
@@ -50,6 +160,12 @@ class StateFeatureExtractor:
     def __init__(self, party_size: int, feature_types: Optional[List[str]] = None):
         self.feature_types = feature_types or StateFeatureExtractor.ALL_FEATURE_TYPES
         self.party_size = party_size
+        # StateFeatureBufferから取り出す位置。全特徴種類を用いる場合はNone(全体をコピー)
+        self._buffer_index = None  # type: Optional[np.ndarray]
+        if self.feature_types != StateFeatureExtractor.ALL_FEATURE_TYPES:
+            self._buffer_index = np.concatenate(
+                [np.arange(_ALL_DIMS)[_FEATURE_TYPE_SLICES[feature_type]]
+                 for feature_type in StateFeatureExtractor.ALL_FEATURE_TYPES if feature_type in self.feature_types])
 
     def get_dims(self) -> int:
         """
@@ -90,6 +206,25 @@ class StateFeatureExtractor:
         return ms
 
     def transform(self, obs: RLPolicyObservation) -> np.ndarray:
+        """
+        観測を特徴量ベクトルに変換
+        バトルの状態にStateFeatureBufferが付随していればそれをコピーし、なければtransform_fullで計算する
+        :param obs:
+        :return:
+        """
+        buffer = obs.battle_status.state_feature  # type: Optional[StateFeatureBuffer]
+        if buffer is None:
+            return self.transform_full(obs)
+        if self._buffer_index is None:
+            return buffer.feat.copy()
+        return buffer.feat[self._buffer_index]
+
+    def transform_full(self, obs: RLPolicyObservation) -> np.ndarray:
+        """
+        観測を特徴量ベクトルに変換(バトルの状態全体から計算する)
+        :param obs:
+        :return:
+        """
         feats = []
         battle_status = obs.battle_status
         if "remaining_count" in self.feature_types:
@@ -177,7 +312,7 @@ class StateFeatureExtractor:
         assert active is not None
         feat = np.zeros((len(RANKS),), dtype=np.float32)
         for i, cond in enumerate(RANKS):
-            rank = active.ranks[cond]
+            rank = active.get_rank(cond)
             feat[i] = (rank + 6.0) / 12.0  # 0~1
         return feat
 
@@ -195,3 +330,62 @@ class StateFeatureExtractor:
                 feat[i] = 1.0
                 break
         return feat
+
+
+def main():
+    # ランダムなバトルの各行動選択時に、StateFeatureBufferとtransform_fullの結果が一致するか確認
+    from pokeai.ai.random_policy import RandomPolicy
+    from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+    from pokeai.sim.random_party_generator import RandomPartyGenerator
+    from pokeai.sim.sim import Sim, BattleSpec
+
+    class CheckPolicy(RandomPolicy):
+        use_state_feature_buffer = True
+
+        def __init__(self, extractor: StateFeatureExtractor):
+            super().__init__()
+            self.extractor = extractor
+            self.n_check = 0
+            self.n_mismatch = 0
+
+        def _check(self, battle_status: BattleStatus):
+            obs = RLPolicyObservation(battle_status, {}, [])
+            expected = self.extractor.transform_full(obs)
+            actual = self.extractor.transform(obs)
+            self.n_check += 1
+            if not np.allclose(expected, actual):
+                self.n_mismatch += 1
+                print("mismatch", battle_status.json_dumps())
+                print("expected", expected.tolist())
+                print("actual  ", actual.tolist())
+
+        def choice_turn_start(self, battle_status: BattleStatus, request: dict) -> str:
+            self._check(battle_status)
+            return super().choice_turn_start(battle_status, request)
+
+        def choice_force_switch(self, battle_status: BattleStatus, request: dict) -> str:
+            self._check(battle_status)
+            return super().choice_force_switch(battle_status, request)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=100, help="バトル数")
+    parser.add_argument("--regulation", default="default")
+    args = parser.parse_args()
+    generator = RandomPartyGenerator(args.regulation)
+    parties = generator.generate_many(args.n * 2)
+    extractor = StateFeatureExtractor(len(parties[0]))
+    policy = CheckPolicy(extractor)
+    specs = []
+    for i in range(args.n):
+        bsps = []
+        for _ in range(2):
+            bsp = BattleStreamProcessor()
+            bsp.set_policy(policy)
+            bsps.append(bsp)
+        specs.append(BattleSpec(parties[i * 2:i * 2 + 2], bsps))
+    Sim().run_multi(specs)
+    print(f"checked: {policy.n_check}, mismatch: {policy.n_mismatch}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""
+asyncioによるシミュレータラッパー
+1つのシミュレータプロセス上の多数のバトルを、1つのイベントループ内のコルーチンとして並行に進める
+
+使用例
+async def main():
+    sim = AsyncSim()
+    results = await asyncio.gather(*[sim.run(parties, processors) for parties, processors in battles])
+    await sim.close()
+"""
+import asyncio
+import logging
+import time
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import SimBattle, SimHangError, SIM_CRASH_ERRORS, FRAME_HEADER, encode_chunk_line, decode_chunk_line, \
+    encode_chunk_frame, decode_chunk_frame
+from pokeai.sim.sim_daemon import start_node_process
+
+logger = getLogger(__name__)
+
+# 1行(1chunk)の最大長。requestは数KB程度だが余裕を持たせる
+STREAM_LIMIT = 2 ** 22
+
+
+class AsyncSim:
+    """
+    asyncioによるシミュレータ
+    プロセスとの通信はノンブロッキングで行い、あるバトルのchunkを待つ間に他のバトルの行動選択を進める
+    プロセスが異常終了・応答しなくなった場合、進行中のバトルは失敗とし、次のバトル開始時にプロセスを起動し直す
+    """
+    _proc: Optional[object]  # subprocess.PopenまたはAttachedProcess
+    _reader: Optional[asyncio.StreamReader]
+    _writer: Optional[asyncio.StreamWriter]
+    _start_task: Optional[asyncio.Task]
+    _reader_task: Optional[asyncio.Task]
+    _queues: Dict[int, asyncio.Queue]  # バトルIDごとの受信chunkのキュー
+    _error: Optional[Exception]  # 読み込みが終了した理由。Noneならプロセスは動作中
+    _debug_lock: Optional[asyncio.Lock]
+
+    def __init__(self, binary: bool = False, max_turns: int = 100, max_battle_seconds: Optional[float] = None,
+                 read_timeout: Optional[float] = None):
+        """
+        :param binary: シミュレータとの通信に、jsonの行ではなく長さ付きのバイナリフレームを用いる
+        :param max_turns: このターン数に達したバトルは引き分けとする(end_reason='turn_limit')
+        :param max_battle_seconds: 開始からこの秒数を超えたバトルは引き分けとする(end_reason='time_limit')
+        :param read_timeout: バトルがシミュレータからこの秒数応答を受け取れない場合、プロセスを停止し、
+        進行中のバトルは引き分けとする(end_reason='sim_hang')。Noneの場合無制限に待つ
+        """
+        self.binary = binary
+        self.max_turns = max_turns
+        self.max_battle_seconds = max_battle_seconds
+        self.read_timeout = read_timeout
+        self.n_restart = 0
+        self._proc = None
+        self._reader = None
+        self._writer = None
+        self._start_task = None
+        self._reader_task = None
+        self._queues = {}
+        self._error = None
+        self._debug_lock = None
+        self._next_battle_id = 0
+
+    async def _start(self):
+        loop = asyncio.get_running_loop()
+        # Sim, SimUtilと同様に起動する(デーモンがあれば起動済みのプロセスを受け取る)。通信はバイナリモードで行う
+        if self.binary:
+            self._proc = start_node_process('js/simpipe', ('--binary',))
+        else:
+            self._proc = start_node_process('js/simpipe')
+        self._reader = asyncio.StreamReader(limit=STREAM_LIMIT)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(self._reader), self._proc.stdout)
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, self._proc.stdin)
+        self._writer = asyncio.StreamWriter(transport, protocol, None, loop)
+        self._reader_task = asyncio.ensure_future(self._read_loop(self._reader))
+
+    async def _stop_process(self):
+        # 待つ間に他のrunが新しいプロセスを起動できるよう、先に状態を初期化する
+        proc, writer, reader_task = self._proc, self._writer, self._reader_task
+        self._proc = None
+        self._reader = None
+        self._writer = None
+        self._start_task = None
+        self._reader_task = None
+        self._error = None
+        writer.close()
+        proc.kill()
+        await asyncio.get_running_loop().run_in_executor(None, proc.wait)
+        await reader_task
+
+    async def _ensure_process(self):
+        # 最初に呼ばれたrunがプロセスを起動し、同時に呼ばれた他のrunはその完了を待つ
+        if self._start_task is not None and self._start_task.done() and self._error is not None and \
+                len(self._queues) == 0:
+            # 停止したプロセスを使っていたバトルが全て終わったので、起動し直す
+            logger.warning(f"restarting simulator stopped by {self._error!r}")
+            self.n_restart += 1
+            await self._stop_process()
+        if self._start_task is None:
+            self._start_task = asyncio.ensure_future(self._start())
+        await self._start_task
+
+    async def _readChunk(self, reader: asyncio.StreamReader) -> Tuple[int, str, str]:
+        try:
+            if self.binary:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                payload = await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+                return decode_chunk_frame(header, payload)
+            line = await reader.readline()
+        except asyncio.IncompleteReadError:
+            raise EOFError("simulator process exited")
+        if not line:
+            raise EOFError("simulator process exited")
+        return decode_chunk_line(line.decode('utf-8'))
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        """
+        シミュレータの出力を読み、バトルIDに対応するキューに振り分ける
+        終了時は理由をself._errorに記録し、待っているバトルに通知する
+        :param reader: このループが読むプロセスの出力。プロセスを起動し直した後は、古いループは何もせず終了する
+        """
+        try:
+            while True:
+                battle_id, chunk_type, chunk_data = await self._readChunk(reader)
+                queue = self._queues.get(battle_id)
+                if queue is None:
+                    # 打ち切ったバトルの残りのchunk
+                    logger.debug(f"dropped chunk for unknown battle {battle_id}")
+                    continue
+                queue.put_nowait((chunk_type, chunk_data))
+        except Exception as ex:
+            # 先に記録された理由(SimHangErrorによる停止など)を優先する
+            if self._error is None:
+                self._error = ex
+        finally:
+            if self._reader is not reader:
+                return
+            if self._error is None:
+                self._error = EOFError("simulator process exited")
+            for queue in self._queues.values():
+                queue.put_nowait(None)
+
+    async def _writeChunk(self, battle_id: int, commands: List[str]):
+        if self.binary:
+            self._writer.write(encode_chunk_frame(battle_id, commands))
+        else:
+            self._writer.write(encode_chunk_line(battle_id, commands).encode('utf-8'))
+        await self._writer.drain()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError("simulator process stopped") from self._error
+
+    async def run(self, parties: List[Party], processors: List[BattleStreamProcessor],
+                  seed: Optional[List[int]] = None) -> dict:
+        """
+        バトルを１回行う。複数のrunを並行して呼び出せる
+        DEBUGログ出力時は、対戦ログの解析(format_battle_log.py)のため1つずつ行う
+        :param parties:
+        :param processors: バトルごとに別のインスタンスが必要
+        :param seed: バトルの乱数シード(0~65535の整数4個)。Noneの場合シミュレータが決める
+        :return: endメッセージの内容 {'winner': 'p1', 'turns': 34, 'end_reason': 'normal', ...}
+        """
+        if logging.getLogger('pokeai.sim.sim').isEnabledFor(logging.DEBUG):
+            # 並行させると複数のバトルのreadChunkのログが混ざる
+            if self._debug_lock is None:
+                self._debug_lock = asyncio.Lock()
+            async with self._debug_lock:
+                return await self._run(parties, processors, seed)
+        return await self._run(parties, processors, seed)
+
+    async def _run(self, parties: List[Party], processors: List[BattleStreamProcessor],
+                   seed: Optional[List[int]]) -> dict:
+        await self._ensure_process()
+        self._check_error()
+        battle = SimBattle(self._next_battle_id, parties, processors, seed, max_turns=self.max_turns)
+        self._next_battle_id += 1
+        queue = asyncio.Queue()
+        self._queues[battle.battle_id] = queue
+        try:
+            await self._writeChunk(battle.battle_id, battle.start())
+            while battle.result is None:
+                self._check_error()
+                try:
+                    item = await asyncio.wait_for(queue.get(), self.read_timeout)
+                except asyncio.TimeoutError:
+                    # どのバトルが原因か特定できないので、プロセスを止めて進行中のバトルは全て引き分けとする
+                    logger.warning(f"no response from simulator in {self.read_timeout} seconds, "
+                                   f"discarding {len(self._queues)} battles")
+                    if self._error is None:
+                        self._error = SimHangError(f"no response from simulator in {self.read_timeout} seconds")
+                    self._proc.kill()
+                    item = None
+                if item is None:
+                    self._check_error()
+                chunk_type, chunk_data = item
+                for command in battle.process_chunk(chunk_type, chunk_data):
+                    await self._writeChunk(battle.battle_id, [command])
+                if self.max_battle_seconds is not None and battle.result is None and not battle.sent_forcetie and \
+                        time.time() - battle.start_time > self.max_battle_seconds:
+                    await self._writeChunk(battle.battle_id, battle.force_tie('time_limit'))
+        except Exception as ex:
+            if battle.result is None:
+                battle.abort()
+                if isinstance(self._error, SimHangError):
+                    return {'winner': '', 'turns': battle.turn, 'seed': battle.seed, 'end_reason': 'sim_hang'}
+                if isinstance(ex, SIM_CRASH_ERRORS):
+                    # 読み込み側より先に、書き込みでプロセスの終了を検出した
+                    raise RuntimeError("simulator process stopped") from ex
+            raise
+        finally:
+            del self._queues[battle.battle_id]
+        return battle.result
+
+    async def close(self):
+        """
+        シミュレータプロセスを終了する。進行中のバトルがない状態で呼び出すこと
+        """
+        if self._start_task is not None:
+            await self._start_task
+            proc, writer, reader_task = self._proc, self._writer, self._reader_task
+            self._proc = None
+            self._reader = None
+            self._writer = None
+            self._start_task = None
+            self._reader_task = None
+            self._error = None
+            # 入力を閉じるとシミュレータは終了する
+            writer.close()
+            await asyncio.get_running_loop().run_in_executor(None, proc.wait)
+            await reader_task
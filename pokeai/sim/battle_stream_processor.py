@@ -8,12 +8,22 @@ import re
 from typing import Optional, List, Tuple
 from logging import getLogger
 
-from pokeai.ai.battle_status import BattleStatus, parse_hp_condition
+from pokeai import stage_timer
+from pokeai.ai.battle_status import BattleStatus, parse_hp_condition_code
+from pokeai.ai.state_feature_extractor import StateFeatureBuffer
 from pokeai.sim.party_generator import Party
 from pokeai.util import pickle_base64_dumps
 
 logger = getLogger(__name__)
 
+# 1行のメッセージを分割したもの: |switch|p1a: Ninetales|Ninetales, L50, M|179/179 => ('switch', ['p1a: Ninetales', ...])
+Message = Tuple[str, List[str]]
+
+
+def parse_message(line: str) -> Message:
+    lineparts = line.split('|')
+    return lineparts[1], lineparts[2:]
+
 
 class BattleStreamProcessor:
     side: Optional[str]  # p1 or p2
@@ -21,7 +31,9 @@ class BattleStreamProcessor:
     last_request: dict  # 最新の行動選択時における味方の状態
     last_request_my_action: str  # 直前のrequestで要求された行動の種類 none | turn_start | force_switch
     battle_status: BattleStatus
+    state_feature: Optional[StateFeatureBuffer]  # 方策が用いる場合、battle_statusの変化に合わせて更新する状態特徴量
     policy: "ActionPolicy"
+    rng: Optional[random.Random]  # このバトルで方策が用いる乱数生成器
     # 処理しないメッセージ（進行上重要でなく、AIの判断に使わない情報）
     ignore_msgs = ['',
                    'debug',
@@ -61,11 +73,13 @@ class BattleStreamProcessor:
                    'win',  # 勝敗決定(勝者の取得は別途endメッセージで行う)
                    'tie',  # 引き分け(forcetieで発生)
                    ]
+    ignore_msgs_set = frozenset(ignore_msgs)
 
     def __init__(self):
         self.side = None
         self.side_party = None
         self.policy = None
+        self.rng = None
         self._handlers = {
             'request': self._handle_request,
             'switch': self._handle_switch,
@@ -94,19 +108,25 @@ class BattleStreamProcessor:
     def set_policy(self, policy: "ActionPolicy"):
         self.policy = policy
 
-    def start_battle(self, side: str, side_party: Party):
+    def start_battle(self, side: str, side_party: Party, seed: Optional[str] = None):
         """
         バトルの開始。バトルの状態を初期化する。
         :param side:
+        :param seed: 方策の乱数シード。Noneの場合方策の乱数生成器を変更しない
         :return:
         """
         assert self.policy is not None
+        self.rng = random.Random(seed) if seed is not None else None
         self.side = side
         self.side_party = side_party
         self.last_request = None
         self.last_request_my_action = 'none'
         # FIXME: BattleStatusと責任境界が分かれてない
         self.battle_status = BattleStatus(side, side_party)
+        self.state_feature = None
+        if self.policy.use_state_feature_buffer:
+            self.state_feature = StateFeatureBuffer(self.battle_status)
+            self.battle_status.state_feature = self.state_feature
         self.policy.game_start()
 
     def process_chunk(self, chunk_type: str, data: str) -> Optional[str]:
@@ -116,21 +136,33 @@ class BattleStreamProcessor:
         :param data:
         :return: "move 2"や"switch 1"のような行動
         """
+        # |request|xxx
+        return self.process_messages(chunk_type, [parse_message(line) for line in data.splitlines()])
+
+    def process_messages(self, chunk_type: str, messages: List[Message]) -> Optional[str]:
+        """
+        分割済みのメッセージからなるchunkを処理し、行動がある場合はそれを返す
+        :param chunk_type:
+        :param messages: parse_messageで分割したメッセージのリスト。引数は書き換えないので、複数のプロセッサで共有してよい
+        :return: "move 2"や"switch 1"のような行動
+        """
+        t = stage_timer.start()
         choice = None
-        for line in data.splitlines():
-            # |request|xxx
-            lineparts = line.split('|')
-            msg = lineparts[1]
-            msgargs = lineparts[2:]
-            handler = self._handlers.get(msg)
+        handlers = self._handlers
+        for msg, msgargs in messages:
+            handler = handlers.get(msg)
             if handler is not None:
                 handler(msgargs)
-            elif msg in BattleStreamProcessor.ignore_msgs:
+            elif msg in BattleStreamProcessor.ignore_msgs_set:
                 # 安全に無視できるメッセージ
                 pass
             else:
-                raise NotImplementedError(f"unknown message {msg} in {data}")
+                raise NotImplementedError(f"unknown message {msg} in {messages}")
+        stage_timer.stop("bsp.handlers", t)
         if chunk_type == "update":
+            if self.rng is not None and self.last_request_my_action != 'none':
+                # 方策は複数のバトルで共有されうるので、このバトルの乱数生成器を都度設定する
+                self.policy.rng = self.rng
             if self.last_request_my_action == 'turn_start':
                 choice = self.policy.choice_turn_start(self.battle_status, self.last_request)
             elif self.last_request_my_action == 'force_switch':
@@ -182,6 +214,8 @@ class BattleStreamProcessor:
         :return:
         """
         self.battle_status.switch(msgargs[0], msgargs[1], msgargs[2])
+        if self.state_feature is not None:
+            self.state_feature.update_active(msgargs[0][:2])
         return None
 
     def _handle_drag(self, msgargs: List[str]) -> Optional[str]:
@@ -192,6 +226,8 @@ class BattleStreamProcessor:
         :return:
         """
         self.battle_status.switch(msgargs[0], msgargs[1], msgargs[2])
+        if self.state_feature is not None:
+            self.state_feature.update_active(msgargs[0][:2])
         # 今のところswitchと違いはない
         return None
 
@@ -204,6 +240,8 @@ class BattleStreamProcessor:
         ss = self.battle_status.side_statuses[msgargs[0]]
         ss.total_pokes = teamsize
         ss.remaining_pokes = teamsize
+        if self.state_feature is not None:
+            self.state_feature.update_remaining_count(msgargs[0])
         return None
 
     def _handle_turn(self, msgargs: List[str]) -> Optional[str]:
@@ -223,26 +261,28 @@ class BattleStreamProcessor:
         :return:
         """
         # |-start|p1a: Ninetales|Substitute
-        self.battle_status.get_side(msgargs[0]).active.volatile_statuses.add(msgargs[1])
+        self.battle_status.get_side(msgargs[0]).active.add_volatile(msgargs[1])
         return None
 
     def _handle_end(self, msgargs: List[str]) -> Optional[str]:
         # 状態変化終了
         # |-start|p1a: Ninetales|Substitute
-        # set.removeでなくset.discard(要素なくてもエラーにならない)を使用
+        # removeでなくdiscard(要素なくてもエラーにならない)を使用
         # |-end|p2a: Dodrio|move: Bide
         # という例あり
-        self.battle_status.get_side(msgargs[0]).active.volatile_statuses.discard(msgargs[1])
+        self.battle_status.get_side(msgargs[0]).active.discard_volatile(msgargs[1])
         return None
 
     def _handle_damage(self, msgargs: List[str]) -> Optional[str]:
         # ダメージを受けた
         # |-damage|p1a: Ninetales|135/179
         # |-damage|p2a: Granbull|184/196 tox|[from] psn
-        hp_current, hp_max, status = parse_hp_condition(msgargs[1])
+        hp_current, hp_max, status_code = parse_hp_condition_code(msgargs[1])
         active = self.battle_status.get_side(msgargs[0]).active
         active.hp_current = hp_current
-        active.status = status
+        active.status_code = status_code
+        if self.state_feature is not None:
+            self.state_feature.update_hp_status(msgargs[0][:2])
         return None
 
     def _handle_heal(self, msgargs: List[str]) -> Optional[str]:
@@ -251,10 +291,12 @@ class BattleStreamProcessor:
         # |-resisted|p1a: Natu
         # |-damage|p1a: Natu|139/160
         # |-heal|p2a: Skiploom|132/176|[from] drain|[of] p1a: Natu
-        hp_current, hp_max, status = parse_hp_condition(msgargs[1])
+        hp_current, hp_max, status_code = parse_hp_condition_code(msgargs[1])
         active = self.battle_status.get_side(msgargs[0]).active
         active.hp_current = hp_current
-        active.status = status
+        active.status_code = status_code
+        if self.state_feature is not None:
+            self.state_feature.update_hp_status(msgargs[0][:2])
         return None
 
     def _handle_status(self, msgargs: List[str]) -> Optional[str]:
@@ -262,12 +304,16 @@ class BattleStreamProcessor:
         # |move|p1a: Ninetales|Toxic|p2a: Granbull
         # |-status|p2a: Granbull|tox
         self.battle_status.get_side(msgargs[0]).active.status = msgargs[1]
+        if self.state_feature is not None:
+            self.state_feature.update_hp_status(msgargs[0][:2])
         return None
 
     def _handle_curestatus(self, msgargs: List[str]) -> Optional[str]:
         # 状態異常が回復
         # |-curestatus|p2a: Granbull|tox
         self.battle_status.get_side(msgargs[0]).active.status = ''
+        if self.state_feature is not None:
+            self.state_feature.update_hp_status(msgargs[0][:2])
         return None
 
     def _handle_cureteam(self, msgargs: List[str]) -> Optional[str]:
@@ -275,15 +321,19 @@ class BattleStreamProcessor:
         # |-cureteam|p2a: Snubbull|[from] move: Heal Bell
         # 現状控えのポケモンの状態異常を管理していないため、curestatusと同じ
         self.battle_status.get_side(msgargs[0]).active.status = ''
+        if self.state_feature is not None:
+            self.state_feature.update_hp_status(msgargs[0][:2])
         return None
 
     def _handle_sethp(self, msgargs: List[str]) -> Optional[str]:
         # HPを特定の値にセット(いたみわけで発生)
         # |-sethp|p1a: Cleffa|104/171 par|[from] move: Pain Split|[silent]
-        hp_current, hp_max, status = parse_hp_condition(msgargs[1])
+        hp_current, hp_max, status_code = parse_hp_condition_code(msgargs[1])
         active = self.battle_status.get_side(msgargs[0]).active
         active.hp_current = hp_current
-        active.status = status
+        active.status_code = status_code
+        if self.state_feature is not None:
+            self.state_feature.update_hp_status(msgargs[0][:2])
         return None
 
     def _handle_boost(self, msgargs: List[str]) -> Optional[str]:
@@ -292,6 +342,8 @@ class BattleStreamProcessor:
         # |-boost|p2a: Porygon|def|2
         # 数値は変化量
         self.battle_status.get_side(msgargs[0]).active.rank_boost(msgargs[1], int(msgargs[2]))
+        if self.state_feature is not None:
+            self.state_feature.update_rank(msgargs[0][:2])
         return None
 
     def _handle_unboost(self, msgargs: List[str]) -> Optional[str]:
@@ -299,12 +351,16 @@ class BattleStreamProcessor:
         # |move|p2a: Granbull|Tail Whip|p1a: Ninetales
         # |-unboost|p1a: Ninetales|def|1
         self.battle_status.get_side(msgargs[0]).active.rank_unboost(msgargs[1], int(msgargs[2]))
+        if self.state_feature is not None:
+            self.state_feature.update_rank(msgargs[0][:2])
         return None
 
     def _handle_setboost(self, msgargs: List[str]) -> Optional[str]:
         # ランク変化（特定の値をセット）　はらだいこなど
         # 数値は変化後の値
         self.battle_status.get_side(msgargs[0]).active.rank_setboost(msgargs[1], int(msgargs[2]))
+        if self.state_feature is not None:
+            self.state_feature.update_rank(msgargs[0][:2])
         return None
 
     def _handle_copyboost(self, msgargs: List[str]) -> Optional[str]:
@@ -317,28 +373,32 @@ class BattleStreamProcessor:
         # じこあんじをしたのはNatuなのでNatuが変化する側
         source = self.battle_status.get_side(msgargs[1]).active
         target = self.battle_status.get_side(msgargs[0]).active
-        target.ranks = source.ranks.copy()
+        target.ranks = source.ranks  # タプルなので共有してよい
+        if self.state_feature is not None:
+            self.state_feature.update_rank(msgargs[0][:2])
         return None
 
     def _handle_clearallboost(self, msgargs: List[str]) -> Optional[str]:
         # 全てのポケモンの全てのランク変化をリセット（くろいきり）
         # |move|p2a: Golbat|Haze|p2a: Golbat
         # |-clearallboost
-        for side in self.battle_status.side_statuses.values():
-            side.active.rank_clearallboost()
+        for side, side_status in self.battle_status.side_statuses.items():
+            side_status.active.rank_clearallboost()
+            if self.state_feature is not None:
+                self.state_feature.update_rank(side)
         return None
 
     def _handle_sidestart(self, msgargs: List[str]) -> Optional[str]:
         # プレイヤーの場に生じる状態の発生
         # |move|p2a: Skiploom|Reflect|p2a: Skiploom
         # |-sidestart|p2: p2|Reflect
-        self.battle_status.get_side(msgargs[0]).side_statuses.add(msgargs[1])
+        self.battle_status.get_side(msgargs[0]).add_side_condition(msgargs[1])
         return None
 
     def _handle_sideend(self, msgargs: List[str]) -> Optional[str]:
         # プレイヤーの場に生じる状態の消滅
         # |-sideend|p2: p2|Safeguard
-        self.battle_status.get_side(msgargs[0]).side_statuses.remove(msgargs[1])
+        self.battle_status.get_side(msgargs[0]).remove_side_condition(msgargs[1])
         return None
 
     def _handle_faint(self, msgargs: List[str]) -> Optional[str]:
@@ -346,6 +406,8 @@ class BattleStreamProcessor:
         # |-damage|p2a: Granbull|0 fnt|[from] psn|[of] p1a: Ninetales
         # |faint|p2a: Granbull
         self.battle_status.get_side(msgargs[0]).remaining_pokes -= 1
+        if self.state_feature is not None:
+            self.state_feature.update_remaining_count(msgargs[0][:2])
         return None
 
     def _handle_weather(self, msgargs: List[str]) -> Optional[str]:
@@ -354,6 +416,8 @@ class BattleStreamProcessor:
         # |-weather|SunnyDay
         # SunnyDay,RainDance,Sandstorm,none
         self.battle_status.weather = msgargs[0]
+        if self.state_feature is not None:
+            self.state_feature.update_weather()
         return None
 
 
@@ -0,0 +1,123 @@
+"""
+並行に進むバトルの行動選択の計算をまとめる
+Sim.run_multi(batch_decisions=True)は、受け取ったchunkをバトルごとのスレッドで処理する
+各スレッド内の方策がモデルの計算をsubmitで要求すると、処理中の全スレッドが要求を出すか処理を終えるまで待ち、
+同じキーの要求をまとめて1回のbatch_fnで計算する
+
+使用例(方策側)
+q_vector = decision_batcher.submit(model, functools.partial(forward_batch, model), obs)
+
+バッチ処理中のスレッド以外からの要求(通常のSimでのバトルなど)は、その場でbatch_fnを呼んで計算する
+"""
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from pokeai import stage_timer
+
+
+class _Request:
+    __slots__ = ['key', 'batch_fn', 'item', 'done', 'result', 'error']
+
+    def __init__(self, key: Any, batch_fn: Callable[[List[Any]], List[Any]], item: Any):
+        self.key = key
+        self.batch_fn = batch_fn
+        self.item = item
+        self.done = False
+        self.result = None
+        self.error = None  # type: Optional[BaseException]
+
+
+class DecisionBatcher:
+    """
+    バトルを処理するスレッド群の計算要求をまとめる
+    処理を始めるスレッド数をreserveで登録し、各スレッドはtask内で処理を行う
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._active = 0  # 処理中(要求を出しうる)のスレッド数
+        self._pending = []  # type: List[_Request]
+        self._local = threading.local()
+
+    def reserve(self, n: int):
+        """
+        これからn個のスレッドがtask内で処理を始めることを登録する
+        全スレッドの開始前に登録しないと、先に始めたスレッドの要求が単独で計算される
+        :param n:
+        :return:
+        """
+        with self._cond:
+            self._active += n
+
+    @contextmanager
+    def task(self):
+        """
+        reserveで登録したスレッドの処理。この中のsubmitはまとめて計算される
+        :return:
+        """
+        self._local.in_task = True
+        try:
+            yield
+        finally:
+            self._local.in_task = False
+            with self._cond:
+                self._active -= 1
+                batch = self._take_batch()
+            if batch is not None:
+                self._run_batch(batch)
+
+    def submit(self, key: Any, batch_fn: Callable[[List[Any]], List[Any]], item: Any) -> Any:
+        """
+        計算を要求し、結果を待つ
+        :param key: まとめて計算できる要求を表すキー(モデルなど)。hash可能であること
+        :param batch_fn: itemのリストを受け取り、同じ順序の結果のリストを返す関数。同じkeyには同じ計算をする関数を与えること
+        :param item:
+        :return: itemに対するbatch_fnの結果
+        """
+        if not getattr(self._local, "in_task", False):
+            return batch_fn([item])[0]
+        request = _Request(key, batch_fn, item)
+        with self._cond:
+            self._pending.append(request)
+            batch = self._take_batch()
+        if batch is not None:
+            self._run_batch(batch)
+        with self._cond:
+            while not request.done:
+                self._cond.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _take_batch(self) -> Optional[List[_Request]]:
+        # 処理中の全スレッドが要求を出して待っていれば、それらを取り出す
+        if len(self._pending) == 0 or len(self._pending) < self._active:
+            return None
+        batch = self._pending
+        self._pending = []
+        return batch
+
+    def _run_batch(self, batch: List[_Request]):
+        # 計算中も他のスレッドが処理を終えられるよう、ロックの外で計算する
+        t = stage_timer.start()
+        groups = {}  # type: Dict[Any, List[_Request]]
+        for request in batch:
+            groups.setdefault(request.key, []).append(request)
+        for requests in groups.values():
+            try:
+                results = requests[0].batch_fn([request.item for request in requests])
+                for request, result in zip(requests, results):
+                    request.result = result
+            except BaseException as ex:
+                for request in requests:
+                    request.error = ex
+        stage_timer.stop("decision_batcher.batch", t)
+        with self._cond:
+            for request in batch:
+                request.done = True
+            self._cond.notify_all()
+
+
+# プロセス内で共有するインスタンス。方策とSim.run_multiはこれを介して計算をまとめる
+decision_batcher = DecisionBatcher()
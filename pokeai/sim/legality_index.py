@@ -0,0 +1,225 @@
+"""
+ポケモン単体の正当性を、シミュレータ(TeamValidator)を介さずに判定するための索引
+pokedex.jsonの習得方法(learnset)から、レギュレーションごとに事前計算する
+
+判定結果は3値
+True: 正当と確定
+False: 不正と確定
+None: 索引では判定できない(イベント技、複数の卵技の同時遺伝経路など)。シミュレータで判定すること
+
+python -m pokeai.sim.legality_index default --n 1000
+で、ランダムな個体についてシミュレータの判定結果と一致するか確認できる
+"""
+import argparse
+import random
+from typing import Dict, List, NamedTuple, Optional
+
+from pokeai.sim.party_generator import Party, PartyPoke
+from pokeai.util import DATASET_DIR, json_load
+
+
+class MoveSources(NamedTuple):
+    """
+    ある種族がある技を覚える方法の要約
+    """
+    gen2_level: Optional[int]  # 第2世代の技マシン・教え技・レベルアップで覚えられる最低レベル(技マシン等は1)
+    gen1_level: Optional[int]  # 第1世代の技マシン・レベルアップで覚えられる最低レベル
+    egg: bool  # 第2世代の卵技
+    event: bool  # 配布個体の技
+
+
+class SpeciesLegality(NamedTuple):
+    min_level: int  # 進化レベルによる最低レベル
+    gender: str  # 性別固定の場合その文字('M', 'F', 'N')、そうでなければ''
+    moves: Dict[str, MoveSources]
+
+
+def _species_chain(pokedex: dict, species: str) -> List[str]:
+    # 種族と、その進化前の種族のリスト
+    chain = []
+    while species and species in pokedex:
+        chain.append(species)
+        species = pokedex[species].get('prevo')
+    return chain
+
+
+def _min_or_none(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def _build_species(pokedex: dict, species: str) -> SpeciesLegality:
+    chain = _species_chain(pokedex, species)
+    moves = {}  # type: Dict[str, MoveSources]
+    for sp in chain:
+        for move, sources in pokedex[sp]['learnset'].items():
+            gen2_level, gen1_level, egg, event = moves.get(move, MoveSources(None, None, False, False))
+            for source in sources:
+                # "2L51": 第2世代LV51で習得, "1M": 第1世代技マシン, "2E": 卵技, "2S0": 配布個体0番, "2T": 教え技
+                gen, kind = source[0], source[1]
+                level = int(source[2:]) if kind == 'L' else 1
+                if kind in 'LMT':
+                    if gen == '2':
+                        gen2_level = _min_or_none(gen2_level, level)
+                    elif gen == '1':
+                        gen1_level = _min_or_none(gen1_level, level)
+                elif kind == 'E':
+                    egg = True
+                elif kind == 'S':
+                    event = True
+            moves[move] = MoveSources(gen2_level, gen1_level, egg, event)
+    # 進化レベルは進化前を含めた最大値
+    min_level = max([pokedex[sp].get('evoLevel') or 1 for sp in chain])
+    gender = pokedex[species].get('gender') or ''
+    return SpeciesLegality(min_level, gender, moves)
+
+
+class LegalityIndex:
+    """
+    レギュレーションごとのポケモン単体の正当性の索引
+    RandomPartyGeneratorが生成する形式(特性なし、努力値・個体値固定)以外の個体はNone(判定不能)とする
+    """
+    species: Dict[str, SpeciesLegality]
+
+    def __init__(self, regulation: str = "default"):
+        pokedex = json_load(DATASET_DIR.joinpath('pokedex.json'))
+        pokemons = json_load(DATASET_DIR.joinpath('regulations', regulation, 'pokemons.json'))
+        self.items = set(json_load(DATASET_DIR.joinpath('regulations', regulation, 'items.json')))
+        self.items.add('')
+        self.species = {species: _build_species(pokedex, species) for species in pokemons}
+        # 第1世代に存在する技
+        self.gen1_moves = set(move for entry in pokedex.values()
+                              for move, sources in entry['learnset'].items()
+                              if any(source.startswith('1') for source in sources))
+
+    def _check_fixed_fields(self, poke: PartyPoke, legality: SpeciesLegality) -> bool:
+        # 技以外の項目が、索引で扱える形式か
+        if poke.get('ability') != 'No Ability' or poke.get('nature') or poke.get('shiny'):
+            return False
+        if poke.get('item') not in self.items:
+            return False
+        if poke.get('ivs') != {'hp': 30, 'atk': 30, 'def': 30, 'spa': 30, 'spd': 30, 'spe': 30}:
+            return False
+        evs = poke.get('evs')
+        if not isinstance(evs, dict) or set(evs.keys()) != {'hp', 'atk', 'def', 'spa', 'spd', 'spe'} or \
+                not all(isinstance(v, int) and 0 <= v <= 255 for v in evs.values()):
+            return False
+        # 攻撃個体値maxはオスとなる
+        if poke.get('gender') != (legality.gender or 'M'):
+            return False
+        level = poke.get('level')
+        if not isinstance(level, int) or not 1 <= level <= 100:
+            return False
+        return True
+
+    def check_poke(self, poke: PartyPoke) -> Optional[bool]:
+        """
+        ポケモン1体の正当性を判定する
+        :param poke:
+        :return: True: 正当, False: 不正, None: 判定不能
+        """
+        legality = self.species.get(poke.get('species'))
+        if legality is None:
+            return None
+        if not self._check_fixed_fields(poke, legality):
+            return None
+        level = poke['level']
+        if level < legality.min_level:
+            return False
+        moves = poke.get('moves')
+        if not isinstance(moves, list) or not 1 <= len(moves) <= 4:
+            return None
+        if len(set(moves)) != len(moves):
+            return False
+        gen1_only = []  # 第1世代でしか覚えられない技
+        egg_only = []  # 卵技でしか覚えられない技
+        for move in moves:
+            sources = legality.moves.get(move)
+            if sources is None:
+                return False
+            if sources.gen2_level is not None and sources.gen2_level <= level:
+                continue
+            if sources.gen1_level is not None and sources.gen1_level <= level:
+                gen1_only.append(move)
+            elif sources.egg:
+                egg_only.append(move)
+            elif sources.event:
+                return None
+            else:
+                # レベルが足りない
+                return False
+        if len(egg_only) >= 2:
+            # 同時に遺伝させる経路があるかは判定しない
+            return None
+        if len(egg_only) == 1 and len(gen1_only) > 0:
+            # 卵技を第2世代で遺伝させた後、第1世代に送って技を覚えさせることになる
+            # 第1世代に存在しない卵技は第1世代に送れない
+            if egg_only[0] not in self.gen1_moves:
+                return False
+        return True
+
+    def check(self, party: Party) -> Optional[bool]:
+        """
+        パーティの各ポケモンの正当性を判定する。ポケモン・アイテムの重複は検査しない(TeamValidatorと同様)
+        :param party:
+        :return: True: 全ポケモンが正当, False: 不正なポケモンを含む, None: 判定不能
+        """
+        result = True
+        for poke in party:
+            r = self.check_poke(poke)
+            if r is False:
+                return False
+            if r is None:
+                result = None
+        return result
+
+
+def main():
+    # ランダムな個体について、シミュレータの判定結果と一致するか確認
+    from pokeai.sim.team_validator import TeamValidator
+    parser = argparse.ArgumentParser()
+    parser.add_argument("regulation")
+    parser.add_argument("--n", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    index = LegalityIndex(args.regulation)
+    validator = TeamValidator()
+    pokedex = json_load(DATASET_DIR.joinpath('pokedex.json'))
+    levels = json_load(DATASET_DIR.joinpath('regulations', args.regulation, 'regulation.json'))['levels']
+    all_learnsets = json_load(DATASET_DIR.joinpath('all_learnsets.json'))
+    counts = {True: 0, False: 0, None: 0}
+    n_mismatch = 0
+    for i in range(args.n):
+        species = random.choice(list(index.species))
+        # 索引の内容とは独立に、全世代の習得可能技から選ぶ
+        available_moves = all_learnsets[species]
+        poke = {
+            'name': species,
+            'species': species,
+            'moves': random.sample(available_moves, min(4, len(available_moves))),
+            'ability': 'No Ability',
+            'evs': {'hp': 255, 'atk': 255, 'def': 255, 'spa': 255, 'spd': 255, 'spe': 255},
+            'ivs': {'hp': 30, 'atk': 30, 'def': 30, 'spa': 30, 'spd': 30, 'spe': 30},
+            'item': random.choice(list(index.items)),
+            'level': random.choice(levels),
+            'shiny': False,
+            'gender': pokedex[species]['gender'] or 'M',
+            'nature': ''
+        }
+        result = index.check_poke(poke)
+        counts[result] += 1
+        if result is None:
+            continue
+        expected = validator.validate([poke]) is None
+        if result != expected:
+            print("mismatch", poke, "index", result, "validator", expected)
+            n_mismatch += 1
+    print(f"legal: {counts[True]}, illegal: {counts[False]}, uncertain: {counts[None]}, mismatch: {n_mismatch}")
+
+
+if __name__ == '__main__':
+    main()
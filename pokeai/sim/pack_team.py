@@ -0,0 +1,175 @@
+"""
+パーティのpacked形式への変換
+シミュレータの>playerコマンドに与えるチーム文字列を、nodeプロセスを介さずに生成する
+"""
+import hashlib
+import json
+import re
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+from pokeai.sim.party_generator import Party
+from pokeai.util import DATASET_DIR, json_load, json_dump
+
+_pokedex = None  # type: Optional[dict]
+
+
+def _get_pokedex() -> dict:
+    global _pokedex
+    if _pokedex is None:
+        _pokedex = json_load(DATASET_DIR.joinpath('pokedex.json'))
+    return _pokedex
+
+
+def to_id(text) -> str:
+    # Pokemon-Showdown/sim/dex-data.ts toID の移植
+    if not isinstance(text, (str, int)):
+        return ''
+    return re.sub('[^a-z0-9]+', '', str(text).lower())
+
+
+def _js_str(value) -> str:
+    # javascriptの文字列連結と同じ表記にする
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    return str(value)
+
+
+def pack_team(party: Party) -> str:
+    """
+    パーティをpacked形式の文字列に変換する
+    Pokemon-Showdown/sim/dex.ts Dex.packTeam の移植
+    :param party:
+    :return:
+    """
+    pokedex = _get_pokedex()
+    buf = ''
+    for poke in party:
+        if buf:
+            buf += ']'
+        # name
+        buf += poke.get('name') or poke.get('species')
+        # species
+        species_id = to_id(poke.get('species') or poke.get('name'))
+        buf += '|' + ('' if to_id(poke.get('name') or poke.get('species')) == species_id else species_id)
+        # item
+        buf += '|' + to_id(poke.get('item'))
+        # ability
+        template = pokedex.get(species_id, {})
+        abilities = template.get('abilities')
+        ability_id = to_id(poke.get('ability'))
+        if abilities:
+            for slot, mark in [('0', ''), ('1', '1'), ('H', 'H'), ('S', 'S')]:
+                if ability_id == to_id(abilities.get(slot)):
+                    buf += '|' + mark
+                    break
+            else:
+                buf += '|' + ability_id
+        else:
+            buf += '|' + ability_id
+        # moves
+        buf += '|' + ','.join(to_id(move) for move in poke['moves'])
+        # nature
+        buf += '|' + (poke.get('nature') or '')
+        # evs
+        evs = poke.get('evs')
+        evs_str = '|'
+        if evs:
+            evs_str = '|' + ','.join(_js_str(evs.get(stat) or '') for stat in ['hp', 'atk', 'def', 'spa', 'spd', 'spe'])
+        buf += '|' if evs_str == '|,,,,,' else evs_str
+        # gender
+        gender = poke.get('gender')
+        if gender and gender != template.get('gender'):
+            buf += '|' + gender
+        else:
+            buf += '|'
+        # ivs
+        ivs = poke.get('ivs')
+        ivs_str = '|'
+        if ivs:
+            ivs_str = '|' + ','.join('' if ivs.get(stat, 31) == 31 else _js_str(ivs[stat])
+                                     for stat in ['hp', 'atk', 'def', 'spa', 'spd', 'spe'])
+        buf += '|' if ivs_str == '|,,,,,' else ivs_str
+        # shiny
+        buf += '|S' if poke.get('shiny') else '|'
+        # level
+        level = poke.get('level')
+        buf += '|' + _js_str(level) if level and level != 100 else '|'
+        # happiness
+        happiness = poke.get('happiness')
+        buf += '|' + _js_str(happiness) if happiness is not None and happiness != 255 else '|'
+    return buf
+
+
+def party_hash(party: Party) -> str:
+    """
+    パーティの内容によるハッシュ値
+    dictのキー順序によらず、同じ内容なら同じ値となる
+    :param party:
+    :return:
+    """
+    return hashlib.sha256(json.dumps(party, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class PackedTeamCache:
+    """
+    パーティの内容のハッシュ値をキーとした、packed形式のチーム文字列のキャッシュ
+    学習中のパーティは固定なので、バトルのたびに変換し直す必要がない
+    """
+    path: Optional[Path]
+    _cache: Dict[str, str]
+
+    def __init__(self, path: Optional[Union[str, Path]] = None, use_sim_util: bool = False):
+        """
+        :param path: キャッシュを保存するjsonファイル。存在すれば読み込む。Noneの場合メモリ上のみ
+        :param use_sim_util: Trueの場合、変換にシミュレータ(js/simutil.js)を用いる
+        """
+        self.path = Path(path) if path is not None else None
+        self.use_sim_util = use_sim_util
+        self._cache = {}
+        if self.path is not None and self.path.exists():
+            self._cache = json_load(self.path)
+
+    def get(self, party: Party) -> str:
+        key = party_hash(party)
+        packed = self._cache.get(key)
+        if packed is None:
+            if self.use_sim_util:
+                from pokeai.sim.simutil import sim_util
+                packed = sim_util.call('packTeam', {'party': party})
+            else:
+                packed = pack_team(party)
+            self._cache[key] = packed
+        return packed
+
+    def save(self):
+        if self.path is not None:
+            json_dump(self._cache, self.path)
+
+
+# Simが用いるキャッシュ
+packed_team_cache = PackedTeamCache()
+
+
+def demo():
+    # シミュレータのDex.packTeamと結果が一致するか確認
+    from pokeai.sim.simutil import sim_util
+    from pokeai.sim.random_party_generator import RandomPartyGenerator
+    generator = RandomPartyGenerator()
+    n_mismatch = 0
+    for i in range(100):
+        party = generator.generate()
+        expected = sim_util.call('packTeam', {'party': party})
+        actual = pack_team(party)
+        if expected != actual:
+            print("mismatch", party)
+            print("expected", expected)
+            print("actual  ", actual)
+            n_mismatch += 1
+    print(f"{n_mismatch} mismatches")
+
+
+if __name__ == '__main__':
+    demo()
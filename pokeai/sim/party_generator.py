@@ -30,3 +30,9 @@ class PartyGenerator(metaclass=ABCMeta):
     @abstractmethod
     def neighbor(self, party: Party) -> Party:
         raise NotImplementedError
+
+    def neighbors(self, party: Party, n: int) -> List[Party]:
+        """
+        近傍パーティを複数生成する
+        """
+        return [self.neighbor(party) for _ in range(n)]
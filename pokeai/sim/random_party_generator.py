@@ -2,6 +2,7 @@ import copy
 import random
 from typing import Set, Optional, List
 
+from pokeai.sim.legality_index import LegalityIndex
 from pokeai.sim.party_generator import PartyGenerator, Party, PartyPoke
 from pokeai.util import DATASET_DIR
 from pokeai.sim.team_validator import TeamValidator
@@ -14,6 +15,7 @@ class RandomPartyGenerator(PartyGenerator):
                  neighbor_poke_change_rate: float = 0.1,
                  neighbor_item_change_rate: float = 0.1):
         self._validator = TeamValidator()
+        self._legality_index = LegalityIndex(regulation)
         self._pokedex = json_load(DATASET_DIR.joinpath('pokedex.json'))
         self._lv55_pokemons = json_load(DATASET_DIR.joinpath('lv55_pokemons.json'))
         self._regulation = json_load(DATASET_DIR.joinpath('regulations', regulation, 'regulation.json'))
@@ -27,6 +29,13 @@ class RandomPartyGenerator(PartyGenerator):
     def party_size(self) -> int:
         return len(self._regulation['levels'])
 
+    def _validate_single(self, poke: PartyPoke) -> bool:
+        # 索引で判定できない場合のみシミュレータで判定する
+        result = self._legality_index.check_poke(poke)
+        if result is None:
+            result = self._validator.validate([poke]) is None
+        return result
+
     def _single_random(self, level: int, species: Optional[str] = None) -> PartyPoke:
         # 1体ランダム個体を生成(validationしない)
         if species is None:
@@ -78,10 +87,22 @@ class RandomPartyGenerator(PartyGenerator):
         else:
             raise NotImplementedError('_shuffle_levels_for_species is not implemented for this levels')
 
-    def generate(self, fix_species: Optional[List[str]] = None) -> Party:
+    def validate_parties(self, parties: List[Party]):
+        """
+        複数のパーティをまとめて検証する。不正なパーティがあれば例外を送出する
+        :param parties:
+        :return:
+        """
+        for val_error in self._validator.validate_many(parties):
+            if val_error:
+                # 単体ではOKの個体の組み合わせでエラーになることは想定していない
+                raise RuntimeError('party validation failed: ' + str(val_error))
+
+    def generate(self, fix_species: Optional[List[str]] = None, validate: bool = True) -> Party:
         """
         ランダムなパーティを1つ生成する。
         :param fix_species: 使用するポケモンの種族を固定する場合、パーティのポケモン数分の種族名リスト。シャッフルせずに使用される。ex. ["gyarados", "dugtrio", "ninetales"]
+        :param validate: パーティ全体の検証を行う。Falseの場合、呼び出し側でvalidate_partiesによりまとめて検証すること
         :return:
         """
         if fix_species is not None:
@@ -99,7 +120,7 @@ class RandomPartyGenerator(PartyGenerator):
                 # ポケモン単体でおかしくないか＆種族が被っていないか
                 # アイテムなしは重複可能
                 if (cand['species'] not in species) and ((cand['item'] == '') or (cand['item'] not in items)) and (
-                        self._validator.validate([cand]) is None):
+                        self._validate_single(cand)):
                     break
                 abort_ctr += 1
                 if abort_ctr > 100:
@@ -107,16 +128,25 @@ class RandomPartyGenerator(PartyGenerator):
             party.append(cand)
             species.add(cand['species'])
             items.add(cand['item'])
-        val_error = self._validator.validate(party)
-        if val_error:
-            # 単体ではOKの個体の組み合わせでエラーになることは想定していない
-            raise RuntimeError('party validation failed: ' + str(val_error))
+        if validate:
+            self.validate_parties([party])
         return party
 
-    def neighbor(self, party: Party) -> Party:
+    def generate_many(self, n: int) -> List[Party]:
+        """
+        ランダムなパーティを複数生成する。パーティ全体の検証はまとめて行う
+        :param n:
+        :return:
+        """
+        parties = [self.generate(validate=False) for _ in range(n)]
+        self.validate_parties(parties)
+        return parties
+
+    def neighbor(self, party: Party, validate: bool = True) -> Party:
         """
         近傍パーティを生成する
         :param party:
+        :param validate: パーティ全体の検証を行う。Falseの場合、呼び出し側でvalidate_partiesによりまとめて検証すること
         :return:ポケモン1匹か、ポケモン1匹の技1つか、道具を変更したパーティ。まれに変更なしの場合あり。
         """
         new_party = copy.deepcopy(party)
@@ -128,7 +158,7 @@ class RandomPartyGenerator(PartyGenerator):
             while True:
                 cand = self._single_random(new_party[change_idx]['level'])
                 # ポケモン単体でおかしくないか＆種族が被っていないか
-                if (cand['species'] not in species) and (self._validator.validate([cand]) is None):
+                if (cand['species'] not in species) and self._validate_single(cand):
                     break
             new_party[change_idx] = cand
         else:
@@ -155,12 +185,15 @@ class RandomPartyGenerator(PartyGenerator):
                             continue
                         change_poke['moves'][change_move_idx] = new_move
                         # 両立不可などの理由でダメな場合を弾く
-                        if self._validator.validate([change_poke]) is None:
+                        if self._validate_single(change_poke):
                             break
                         # 変えた技を元に戻す
                         change_poke['moves'][change_move_idx] = current_moves[change_move_idx]
-        val_error = self._validator.validate(new_party)
-        if val_error:
-            # 単体ではOKの個体の組み合わせでエラーになることは想定していない
-            raise RuntimeError('party validation failed: ' + str(val_error))
+        if validate:
+            self.validate_parties([new_party])
         return new_party
+
+    def neighbors(self, party: Party, n: int) -> List[Party]:
+        new_parties = [self.neighbor(party, validate=False) for _ in range(n)]
+        self.validate_parties(new_parties)
+        return new_parties
@@ -5,148 +5,647 @@ import os
 import random
 import subprocess
 import json
-import re
-from typing import List, Optional
+import logging
+import queue
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
 from logging import getLogger
 
+from pokeai import stage_timer
 from pokeai.ai.action_policy import ActionPolicy
-from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor, Message, parse_message
+from pokeai.sim.decision_batcher import decision_batcher
 from pokeai.sim.party_generator import Party
-from pokeai.sim.simutil import sim_util
-from pokeai.util import ROOT_DIR, side2idx, idx2side
+from pokeai.sim.pack_team import packed_team_cache
+from pokeai.sim.sim_daemon import start_node_process
+from pokeai.util import side2idx, idx2side
 
 logger = getLogger(__name__)
 
 
-class Sim:
+def encode_chunk_line(battle_id: int, commands: List[str]) -> str:
     """
-    シミュレータ
+    シミュレータ(js/simpipe.js)に送るコマンドを1行にエンコードする
+    :param battle_id:
+    :param commands:
+    :return: 改行を含む1行
+    """
+    chunk = '\n'.join(commands)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("writeChunk " + json.dumps(chunk))
+    return json.dumps([battle_id, chunk]) + '\n'
+
+
+def decode_chunk_line(line: str) -> Tuple[int, str, str]:
+    """
+    シミュレータから受け取った1行をデコードする
+    :param line:
+    :return: バトルID, chunkの種類, chunkの内容
+    """
+    battle_id, rawstr = json.loads(line)
+    if logger.isEnabledFor(logging.DEBUG):
+        # バトルIDを含めない形式で記録する(format_battle_log.pyで解析)
+        logger.debug("readChunk " + json.dumps(rawstr))
+    chunk_type, chunk_data = rawstr.split('\n', 1)  # 最初の1要素(update, endなど)のみ分離
+    return battle_id, chunk_type, chunk_data
+
+
+def split_update_for_sides(chunk_data: str) -> Tuple[List[Message], List[Message]]:
+    """
+    updateのchunkを1回の走査で行に分割し、p1, p2それぞれに見えるメッセージのリストを作る
+    Pokemon-Showdown/sim/battle.ts extractUpdateForSide と同じ結果となる
+    '|split|p1'の次の行(秘密情報)はp1にのみ、その次の行(公開情報)はp1以外にのみ送る
+    :param chunk_data:
+    :return: p1向けのメッセージ, p2向けのメッセージ
+    """
+    t = stage_timer.start()
+    lines = chunk_data.split('\n')
+    p1_messages = []
+    p2_messages = []
+    n_lines = len(lines)
+    i = 0
+    while i < n_lines:
+        line = lines[i]
+        # 先頭行は(extractUpdateForSideの正規表現と同様に)分割の対象としない
+        if i > 0 and line.startswith('|split|') and i + 1 < n_lines:
+            owner = line[7:]
+            secret_line = lines[i + 1]
+            public_line = lines[i + 2] if i + 2 < n_lines else None
+            i += 3
+            for side, messages in [('p1', p1_messages), ('p2', p2_messages)]:
+                if side == owner:
+                    if secret_line:
+                        messages.append(parse_message(secret_line))
+                elif public_line:
+                    messages.append(parse_message(public_line))
+            continue
+        if line:
+            message = parse_message(line)
+            # 公開情報は両者で同じオブジェクトを共有する
+            p1_messages.append(message)
+            p2_messages.append(message)
+        i += 1
+    stage_timer.stop("sim.split_update", t)
+    return p1_messages, p2_messages
+
+
+# バイナリフレーム(js/simpipe.js --binary)のヘッダ: ペイロード長, バトルID, chunkの種類
+FRAME_HEADER = struct.Struct('<IIB')
+FRAME_CHUNK_TYPES = ['update', 'sideupdate', 'end']
+
+
+def encode_chunk_frame(battle_id: int, commands: List[str]) -> bytes:
+    """
+    シミュレータに送るコマンドをバイナリフレームにエンコードする
+    :param battle_id:
+    :param commands:
+    :return:
+    """
+    chunk = '\n'.join(commands)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("writeChunk " + json.dumps(chunk))
+    payload = chunk.encode('utf-8')
+    return FRAME_HEADER.pack(len(payload), battle_id, 0) + payload
+
+
+def decode_chunk_frame(header: bytes, payload: bytes) -> Tuple[int, str, str]:
+    """
+    シミュレータから受け取ったバイナリフレームをデコードする
+    :param header:
+    :param payload:
+    :return: バトルID, chunkの種類, chunkの内容
+    """
+    _, battle_id, chunk_type_code = FRAME_HEADER.unpack(header)
+    chunk_type = FRAME_CHUNK_TYPES[chunk_type_code]
+    chunk_data = payload.decode('utf-8')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("readChunk " + json.dumps(chunk_type + '\n' + chunk_data))
+    return battle_id, chunk_type, chunk_data
+
+
+class BattleSpec(NamedTuple):
+    """
+    Sim.run_multiに与える1バトル分の設定
     """
     parties: List[Party]
-    processors: List[BattleStreamProcessor]
-    policies: List[ActionPolicy]
-    proc: subprocess.Popen
-    n_battle: int
+    processors: List[BattleStreamProcessor]  # バトルごとに別のインスタンスが必要
+    seed: Optional[List[int]] = None  # バトルの乱数シード(0~65535の整数4個)。Noneの場合ランダム
 
-    def __init__(self):
-        self.n_battle = 0
-        self.proc = None
-        self.parties = None
-        self.processors = None
 
-    def set_party(self, parites: List[Party]):
-        self.parties = parites
+class SimBattle:
+    """
+    シミュレータ上で進行中の1バトル
+    シミュレータから来たchunkを適切なプロセッサに振り分け、シミュレータに送るコマンドを返す
+    """
+    battle_id: int
+    parties: List[Party]
+    processors: List[BattleStreamProcessor]
+    seed: Optional[List[int]]
+    max_turns: int
+    sent_forcetie: bool
+    end_reason: str  # バトル終了の理由 'normal', 'turn_limit', 'time_limit', 'sim_hang'
+    turn: int  # 最後に受け取ったターン番号
+    start_time: Optional[float]
+    result: Optional[dict]  # バトル終了後、endメッセージの内容。end_reasonを付加する
+    chunk_log: Optional[List[Tuple[str, str]]]  # 記録する場合、受け取ったchunkのリスト
 
-    def set_processor(self, processors: List[BattleStreamProcessor]):
+    def __init__(self, battle_id: int, parties: List[Party], processors: List[BattleStreamProcessor],
+                 seed: Optional[List[int]] = None, record_chunks: bool = False, max_turns: int = 100):
+        """
+        :param battle_id:
+        :param parties:
+        :param processors:
+        :param seed: バトルの乱数シード。方策の乱数シードもここから決める。Noneの場合シミュレータが決める
+        :param record_chunks: 受け取ったchunkをchunk_logに記録する
+        :param max_turns: このターン数に達したら引き分けとする
+        """
+        if parties is None:
+            raise Exception('parties not set')
+        self.battle_id = battle_id
+        self.parties = parties
         self.processors = processors
+        self.seed = seed
+        self.max_turns = max_turns
+        self.sent_forcetie = False
+        self.end_reason = 'normal'
+        self.turn = 0
+        self.start_time = None
+        self.result = None
+        self.chunk_log = [] if record_chunks else None
 
-    def _writeChunk(self, commands: List[str]):
-        logger.debug("writeChunk " + json.dumps('\n'.join(commands)))
-        self.proc.stdin.write(json.dumps('\n'.join(commands)) + '\n')
-        self.proc.stdin.flush()
+    def start(self) -> List[str]:
+        """
+        バトルを開始する
+        :return: シミュレータに送るコマンド
+        """
+        self.start_time = time.time()
+        for i in [0, 1]:
+            side = idx2side(i)
+            policy_seed = f'{self.seed}:{side}' if self.seed is not None else None
+            self.processors[i].start_battle(side, self.parties[i], policy_seed)
+        spec = {'formatid': 'gen2customgame'}
+        if self.seed is not None:
+            spec['seed'] = self.seed
+        return [
+            f'>start {json.dumps(spec)}',
+            f'>player p1 {json.dumps(self._makePartySpec("p1", self.parties[0]))}',
+            f'>player p2 {json.dumps(self._makePartySpec("p2", self.parties[1]))}',
+        ]
 
-    def _readChunk(self) -> List[str]:
-        line = self.proc.stdout.readline()
-        logger.debug("readChunk " + line)
-        rawstr = json.loads(line)
-        return rawstr.split('\n', 1)  # 最初の1要素(update, endなど)のみ分離
+    def force_tie(self, reason: str) -> List[str]:
+        """
+        バトルを引き分けで打ち切る
+        :param reason: 結果のend_reasonに記録する理由
+        :return: シミュレータに送るコマンド
+        """
+        logger.warning(f"battle {self.battle_id} hit {reason} at turn {self.turn}, exiting as tie")
+        self.sent_forcetie = True
+        self.end_reason = reason
+        # この後はendメッセージを待つだけ。エージェントにchoiceを送らせてはいけない
+        # (|error|[Invalid choice] Can't do anything: The game is over)というエラーになる
+        return [f'>forcetie']
 
-    def run(self):
+    def abort(self):
         """
-        バトルを１回行う
-        :return: endメッセージの内容 {'winner': 'p1', 'turns': 34, ...}
+        シミュレータの異常により、バトルを途中で打ち切る
+        :return:
         """
-        # シミュレータプログラムの実行。長く運用するとクラッシュすることがあるので定期的に再起動
-        if self.n_battle >= 1000:
-            self.proc.stdin.close()
-            self.proc.terminate()
-            self.proc = None
-            self.n_battle = 0
-        if self.proc is None:
-            self.proc = subprocess.Popen(['node', 'js/simpipe'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                         encoding='utf-8', cwd=str(ROOT_DIR))
-        self.n_battle += 1
+        for processor in self.processors:
+            processor.policy.game_abort()
 
-        for i in [0, 1]:
-            self.processors[i].start_battle(idx2side(i), self.parties[i])
-
-        self._writeStart()
-        sent_forcetie = False
-        while True:
-            chunk_type, chunk_data = self._readChunk()
-            battle_result = None
-            if chunk_data.find('|turn|100') >= 0 and not sent_forcetie:
+    def process_chunk(self, chunk_type: str, chunk_data: str) -> List[str]:
+        """
+        chunkを処理する。バトルが終了した場合はself.resultにendメッセージの内容が入る
+        :param chunk_type:
+        :param chunk_data:
+        :return: シミュレータに送るコマンド
+        """
+        if self.chunk_log is not None:
+            self.chunk_log.append((chunk_type, chunk_data))
+        turn_pos = chunk_data.rfind('|turn|')
+        if turn_pos >= 0:
+            turn_end = chunk_data.find('\n', turn_pos)
+            self.turn = int(chunk_data[turn_pos + 6:turn_end if turn_end >= 0 else len(chunk_data)])
+            if self.turn >= self.max_turns and not self.sent_forcetie:
                 # 長すぎるバトルをカット
-                logger.warning(f"battle reached to 100 turns, exiting as tie")
-                self._writeChunk([
-                    f'>forcetie'
-                ])
-                sent_forcetie = True
-                # この後はendメッセージを待つだけ。エージェントにchoiceを送らせてはいけない
-                # (|error|[Invalid choice] Can't do anything: The game is over)というエラーになる
-                continue
-            try:
-                battle_result = self._processChunk(chunk_type, chunk_data, sent_forcetie)
-            except Exception as ex:
-                raise ValueError(f"Exception on processing chunk {chunk_type},{chunk_data}", ex)
-            if battle_result is not None:
-                # FIXME: ここで呼ぶべきか、processorにメソッドを設けるべきか
-                winner = battle_result['winner']  # 'p1', 'p2', '' (forcetieで引き分けの時)
-                reward_p1 = {'p1': 1.0, 'p2': -1.0, '': 0.0}[winner]
-                for side, sign in [('p1', 1.0), ('p2', -1.0)]:
-                    self.processors[side2idx(side)].policy.game_end(reward=reward_p1 * sign)
-
-                return battle_result
-
-    def _extractUpdateForSide(self, side: str, chunk_data: str):
-        # Pokemon-Showdown/sim/battle.ts の移植
-        if side == 'omniscient':
-            # 全データ取得
-            return re.sub('\n\\|split\\|p[1234]\n([^\n]*)\n(?:[^\n]*)', '\n\\1', chunk_data)
-        # 各プレイヤーごとの秘密情報を、他のプレイヤー向けには削除する
-        # '|split|p1'の次の行は、p1にのみ送る（他のプレイヤーの場合削除）
-        if side.startswith('p'):
-            chunk_data = re.sub('\n\\|split\\|' + side + '\n([^\n]*)\n(?:[^\n]*)', '\n\\1', chunk_data)
-        return re.sub('\n\\|split\\|(?:[^\n]*)\n(?:[^\n]*)\n\n?', '\n', chunk_data)  # 対象でない秘密データ削除
-
-    def _processChunk(self, chunk_type: str, chunk_data: str, sent_forcetie: bool) -> Optional[object]:
-        """
-        chunkの種類ごとに適切なプロセッサに振り分ける。バトル終了の場合はendメッセージの内容を返す
+                return self.force_tie('turn_limit')
+        t = stage_timer.start()
+        try:
+            commands, battle_result = self._processChunk(chunk_type, chunk_data)
+        except Exception as ex:
+            raise ValueError(f"Exception on processing chunk {chunk_type},{chunk_data}", ex)
+        stage_timer.stop("sim.process_chunk", t)
+        if battle_result is not None:
+            # FIXME: ここで呼ぶべきか、processorにメソッドを設けるべきか
+            winner = battle_result['winner']  # 'p1', 'p2', '' (forcetieで引き分けの時)
+            reward_p1 = {'p1': 1.0, 'p2': -1.0, '': 0.0}[winner]
+            for side, sign in [('p1', 1.0), ('p2', -1.0)]:
+                self.processors[side2idx(side)].policy.game_end(reward=reward_p1 * sign)
+            battle_result['end_reason'] = self.end_reason
+            self.result = battle_result
+        return commands
+
+    def _processChunk(self, chunk_type: str, chunk_data: str) -> Tuple[List[str], Optional[dict]]:
+        """
+        chunkの種類ごとに適切なプロセッサに振り分ける。
         :param chunk_type:
         :param chunk_data:
-        :return:
+        :return: シミュレータに送るコマンド, バトル終了の場合はendメッセージの内容
         """
         # 振り分けについては
         # battle-stream.ts を参考にする
         if chunk_type == 'end':
             # バトル終了
-            return json.loads(chunk_data)  # バトルの結果を返す
-        if sent_forcetie:
+            return [], json.loads(chunk_data)  # バトルの結果を返す
+        if self.sent_forcetie:
             # forcetieを送った後は、endメッセージ以外無視
-            return None
+            return [], None
+        commands = []
         if chunk_type == 'sideupdate':
             side, side_data = chunk_data.split('\n')
             choice = self.processors[side2idx(side)].process_chunk(chunk_type, side_data)
             if choice is not None:
-                self._writeChunk([f'>{side} {choice}'])
+                commands.append(f'>{side} {choice}')
         elif chunk_type == 'update':
-            for side in ['p1', 'p2']:
-                choice = self.processors[side2idx(side)].process_chunk(chunk_type,
-                                                                       self._extractUpdateForSide(side, chunk_data))
+            for side, messages in zip(['p1', 'p2'], split_update_for_sides(chunk_data)):
+                choice = self.processors[side2idx(side)].process_messages(chunk_type, messages)
                 if choice is not None:
-                    self._writeChunk([f'>{side} {choice}'])
+                    commands.append(f'>{side} {choice}')
         else:
             raise NotImplementedError(f"Unknown chunk type {chunk_type}")
+        return commands, None
 
     def _makePartySpec(self, name, party):
-        return {'name': name, 'team': sim_util.call('packTeam', {'party': party})}
+        return {'name': name, 'team': packed_team_cache.get(party)}
 
-    def _writeStart(self):
-        if self.parties is None:
-            raise Exception('parties not set')
-        spec = {'formatid': 'gen2customgame'}
-        self._writeChunk([
-            f'>start {json.dumps(spec)}',
-            f'>player p1 {json.dumps(self._makePartySpec("p1", self.parties[0]))}',
-            f'>player p2 {json.dumps(self._makePartySpec("p2", self.parties[1]))}',
-        ])
+
+# シミュレータプロセスの異常終了を示す例外
+SIM_CRASH_ERRORS = (EOFError, ConnectionError)
+
+
+class SimHangError(Exception):
+    """
+    シミュレータからの応答が一定時間以上ない
+    """
+    pass
+
+
+def get_process_rss_mb(pid: int) -> Optional[float]:
+    """
+    プロセスの常駐メモリ量(MB)を取得する。取得できない環境ではNone
+    :param pid:
+    :return:
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024  # kB単位
+    except OSError:
+        pass
+    return None
+
+
+class Sim:
+    """
+    シミュレータ
+    1つのシミュレータプロセス上で、バトルIDで区別された複数のバトルを並行して進められる
+    """
+    parties: List[Party]
+    processors: List[BattleStreamProcessor]
+    policies: List[ActionPolicy]
+    proc: subprocess.Popen
+    n_battle: int
+    binary: bool
+    latency: Optional[float]  # シミュレータからの応答待ち時間(秒)の指数移動平均
+    batch_decisions: bool
+    _chunk_queue: Optional[queue.Queue]  # read_timeoutまたはbatch_decisions指定時、読み込みスレッドが受け取った生のchunk
+    _read_error: Optional[Exception]  # 受け取れるchunkをまとめて読む際に見つけた、読み込みスレッドの終了理由
+
+    def __init__(self, binary: bool = False, max_rss_mb: Optional[float] = 1024.0,
+                 max_latency: Optional[float] = None, max_retries: int = 3,
+                 max_turns: int = 100, max_battle_seconds: Optional[float] = None,
+                 read_timeout: Optional[float] = None, batch_decisions: bool = False):
+        """
+        シミュレータプロセスは状態を監視し、閾値を超えたらバトルのない時点で再起動する
+        プロセスが異常終了した場合は再起動し、進行中だったバトルを同じパーティ・乱数シードでやり直す
+        :param binary: シミュレータとの通信に、jsonの行ではなく長さ付きのバイナリフレームを用いる
+        :param max_rss_mb: シミュレータプロセスのメモリ使用量(MB)の上限
+        :param max_latency: シミュレータからの応答待ち時間(秒)の指数移動平均の上限
+        :param max_retries: 1つのバトルをやり直す回数の上限
+        :param max_turns: このターン数に達したバトルは引き分けとする(end_reason='turn_limit')
+        :param max_battle_seconds: 開始からこの秒数を超えたバトルは引き分けとする(end_reason='time_limit')
+        :param read_timeout: シミュレータからこの秒数応答がない場合、プロセスを再起動し、
+        進行中のバトルは引き分けとする(end_reason='sim_hang')。Noneの場合無制限に待つ
+        :param batch_decisions: run_multiで、その時点で受け取れるchunkをバトルごとのスレッドで並行に処理し、
+        方策がdecision_batcherを介して要求するモデルの計算をバトル間でまとめる
+        """
+        self.binary = binary
+        self.max_rss_mb = max_rss_mb
+        self.max_latency = max_latency
+        self.max_retries = max_retries
+        self.max_turns = max_turns
+        self.max_battle_seconds = max_battle_seconds
+        self.read_timeout = read_timeout
+        self.batch_decisions = batch_decisions
+        self._chunk_queue = None
+        self._read_error = None
+        self._write_lock = threading.Lock()
+        self.n_battle = 0
+        self.n_restart = 0
+        self.latency = None
+        self.proc = None
+        self.parties = None
+        self.processors = None
+        self._next_battle_id = 0
+        self._seed_rng = random.Random()
+
+    def set_party(self, parites: List[Party]):
+        self.parties = parites
+
+    def set_processor(self, processors: List[BattleStreamProcessor]):
+        self.processors = processors
+
+    def _writeChunk(self, battle_id: int, commands: List[str]):
+        t = stage_timer.start()
+        # batch_decisionsの場合、複数のスレッドから呼ばれる
+        with self._write_lock:
+            if self.binary:
+                self.proc.stdin.write(encode_chunk_frame(battle_id, commands))
+            else:
+                self.proc.stdin.write(encode_chunk_line(battle_id, commands))
+            self.proc.stdin.flush()
+        stage_timer.stop("sim.write", t)
+
+    def _readRaw(self, proc):
+        # デコード前のchunkを読む。デコード(とそのログ出力)は呼び出し側のスレッドで行う
+        if self.binary:
+            header = proc.stdout.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                raise EOFError("simulator process exited")
+            payload_length = FRAME_HEADER.unpack(header)[0]
+            return header, proc.stdout.read(payload_length)
+        line = proc.stdout.readline()
+        if not line:
+            raise EOFError("simulator process exited")
+        return line
+
+    def _read_loop(self, proc, chunk_queue: queue.Queue):
+        # read_timeout指定時の読み込みスレッド。プロセスが終了したら例外をキューに入れて終了
+        try:
+            while True:
+                chunk_queue.put(self._readRaw(proc))
+        except Exception as ex:
+            chunk_queue.put(ex)
+
+    def _decode(self, raw) -> Tuple[int, str, str]:
+        if self.binary:
+            return decode_chunk_frame(*raw)
+        return decode_chunk_line(raw)
+
+    def _readAvailableChunks(self) -> List[Tuple[int, str, str]]:
+        """
+        読み込みスレッドが受け取り済みのchunkを、待たずに全て取り出す
+        :return:
+        """
+        chunks = []
+        while self._read_error is None:
+            try:
+                raw = self._chunk_queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(raw, Exception):
+                # 受け取ったchunkを処理した後、次の_readChunkで送出する
+                self._read_error = raw
+                break
+            chunks.append(self._decode(raw))
+        return chunks
+
+    def _readChunk(self) -> Tuple[int, str, str]:
+        t = stage_timer.start()
+        start_time = time.perf_counter()
+        if self._read_error is not None:
+            raise self._read_error
+        if self._chunk_queue is not None:
+            try:
+                raw = self._chunk_queue.get(timeout=self.read_timeout)
+            except queue.Empty:
+                raise SimHangError(f"no response from simulator in {self.read_timeout} seconds")
+            if isinstance(raw, Exception):
+                raise raw
+        else:
+            raw = self._readRaw(self.proc)
+        chunk = self._decode(raw)
+        elapsed = time.perf_counter() - start_time
+        self.latency = elapsed if self.latency is None else self.latency * 0.99 + elapsed * 0.01
+        # シミュレータの処理時間と通信時間を含む
+        stage_timer.stop("sim.read", t)
+        return chunk
+
+    def _is_healthy(self) -> bool:
+        if self.max_rss_mb is not None:
+            rss_mb = get_process_rss_mb(self.proc.pid)
+            if rss_mb is not None and rss_mb > self.max_rss_mb:
+                logger.info(f"simulator uses {rss_mb:.0f}MB memory after {self.n_battle} battles, restarting")
+                return False
+        if self.max_latency is not None and self.latency is not None and self.latency > self.max_latency:
+            logger.info(f"simulator latency is {self.latency:.4f}s after {self.n_battle} battles, restarting")
+            return False
+        return True
+
+    def _stop_process(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            # 異常終了していて閉じられない
+            pass
+        self.proc.kill()
+        self.proc.wait()
+        self.proc = None
+        self._chunk_queue = None
+        self._read_error = None
+        self.n_battle = 0
+        self.latency = None
+
+    def _prepare_process(self):
+        # シミュレータプログラムの実行。長く運用するとメモリ使用量の増加や速度低下が起きるので、その場合は再起動
+        # 進行中のバトルがない状態で呼び出すこと
+        if self.proc is not None and (self.proc.poll() is not None or not self._is_healthy()):
+            self._stop_process()
+        if self.proc is None:
+            if self.binary:
+                self.proc = start_node_process('js/simpipe', ('--binary',))
+            else:
+                self.proc = start_node_process('js/simpipe', encoding='utf-8')
+            if self.read_timeout is not None or self.batch_decisions:
+                self._chunk_queue = queue.Queue()
+                threading.Thread(target=self._read_loop, args=(self.proc, self._chunk_queue), daemon=True).start()
+
+    def run(self, seed: Optional[List[int]] = None):
+        """
+        バトルを１回行う
+        :param seed: バトルの乱数シード(0~65535の整数4個)。Noneの場合ランダム
+        :return: endメッセージの内容 {'winner': 'p1', 'turns': 34, 'seed': [...], ...}
+        """
+        return self.run_multi([BattleSpec(self.parties, self.processors, seed)])[0]
+
+    def run_multi(self, specs: List[BattleSpec], max_concurrent: Optional[int] = None,
+                  record_chunks: bool = False) -> List[dict]:
+        """
+        複数のバトルを並行して行う
+        Python側で行動選択をしている間も、シミュレータは他のバトルを進めることができる
+        同じpolicyを複数のバトルで共有する場合、policyがバトル中の内部状態を持たないことを確認すること
+        :param specs: 各バトルのパーティとプロセッサ
+        :param max_concurrent: 同時に進行させるバトル数の上限。Noneの場合全バトルを同時に開始
+        DEBUGログ出力時は、対戦ログの解析(format_battle_log.py)のため常に1つずつ行う
+        :param record_chunks: 各バトルで受け取ったchunkのリストを、結果の'chunks'に格納する
+        :return: 各バトルのendメッセージの内容(specsと同じ順序)
+        """
+        t = stage_timer.start()
+        self._prepare_process()
+        if max_concurrent is None:
+            max_concurrent = len(specs)
+        if logger.isEnabledFor(logging.DEBUG):
+            # 並行させると複数のバトルのreadChunkのログが混ざる
+            max_concurrent = 1
+        results = [None] * len(specs)  # type: List[Optional[dict]]
+        # シミュレータの異常終了時にやり直せるよう、乱数シードはここで決める
+        seeds = [spec.seed if spec.seed is not None else [self._seed_rng.randrange(0x10000) for _ in range(4)]
+                 for spec in specs]
+        retries = [0] * len(specs)
+        pending = deque(range(len(specs)))  # 未開始のバトル
+        running = {}  # type: Dict[int, Tuple[int, SimBattle]]
+        executor = None
+        if self.batch_decisions and max_concurrent > 1:
+            executor = ThreadPoolExecutor(max_workers=min(max_concurrent, len(specs)))
+        try:
+            self._run_battles(specs, results, seeds, retries, pending, running, max_concurrent, record_chunks,
+                              executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        stage_timer.stop("sim.run_multi", t)
+        return results
+
+    def _process_battle_chunks(self, battle: SimBattle, chunks: List[Tuple[str, str]]):
+        for chunk_type, chunk_data in chunks:
+            for command in battle.process_chunk(chunk_type, chunk_data):
+                self._writeChunk(battle.battle_id, [command])
+
+    def _process_battle_chunks_task(self, battle: SimBattle, chunks: List[Tuple[str, str]]):
+        # executorのスレッドで実行され、方策のモデル計算は他のバトルのスレッドとまとめられる
+        with decision_batcher.task():
+            self._process_battle_chunks(battle, chunks)
+
+    def _process_chunks(self, running: Dict[int, Tuple[int, SimBattle]], chunks: List[Tuple[int, str, str]],
+                        executor: Optional[ThreadPoolExecutor]) -> Tuple[List[SimBattle], Optional[BaseException]]:
+        """
+        受け取ったchunkを処理し、コマンドをシミュレータに送る
+        executorがあれば、複数のバトルのchunkをバトルごとのスレッドで並行に処理する(1つのバトルのchunkは順に処理する)
+        :param running:
+        :param chunks: (バトルID, chunkの種類, chunkの内容)のリスト
+        :param executor:
+        :return: chunkを処理したバトル, 並行に処理した場合に発生した例外
+        (他のバトルの結果を記録してから送出できるよう、送出せずに返す)
+        """
+        chunks_by_battle = {}  # type: Dict[int, List[Tuple[str, str]]]
+        for battle_id, chunk_type, chunk_data in chunks:
+            chunks_by_battle.setdefault(battle_id, []).append((chunk_type, chunk_data))
+        battles = [running[battle_id][1] for battle_id in chunks_by_battle]
+        if executor is None or len(battles) == 1:
+            for battle in battles:
+                self._process_battle_chunks(battle, chunks_by_battle[battle.battle_id])
+            return battles, None
+        # 先に全スレッドを登録しないと、最初のスレッドの要求が単独で計算される
+        decision_batcher.reserve(len(battles))
+        futures = [executor.submit(self._process_battle_chunks_task, battle, chunks_by_battle[battle.battle_id])
+                   for battle in battles]
+        # 全スレッドの終了を待つ(例外の後も他のスレッドがシミュレータに書き込まないように)
+        errors = [future.exception() for future in futures]
+        return battles, next((error for error in errors if error is not None), None)
+
+    def _run_battles(self, specs: List[BattleSpec], results: List[Optional[dict]], seeds: List[List[int]],
+                     retries: List[int], pending: deque, running: Dict[int, Tuple[int, SimBattle]],
+                     max_concurrent: int, record_chunks: bool, executor: Optional[ThreadPoolExecutor]):
+        while len(pending) > 0 or len(running) > 0:
+            try:
+                while len(pending) > 0 and len(running) < max_concurrent:
+                    spec_idx = pending.popleft()
+                    spec = specs[spec_idx]
+                    battle = SimBattle(self._next_battle_id, spec.parties, spec.processors, seeds[spec_idx],
+                                       record_chunks, self.max_turns)
+                    self._next_battle_id += 1
+                    running[battle.battle_id] = (spec_idx, battle)
+                    self.n_battle += 1
+                    self._writeChunk(battle.battle_id, battle.start())
+                chunks = [self._readChunk()]
+                if executor is not None:
+                    chunks.extend(self._readAvailableChunks())
+                processed_battles, error = self._process_chunks(running, chunks, executor)
+                for battle in processed_battles:
+                    if battle.result is not None:
+                        spec_idx, _ = running.pop(battle.battle_id)
+                        results[spec_idx] = battle.result
+                        if record_chunks:
+                            results[spec_idx]['chunks'] = battle.chunk_log
+                if error is not None:
+                    raise error
+                if self.max_battle_seconds is not None:
+                    now = time.time()
+                    for _, running_battle in running.values():
+                        if not running_battle.sent_forcetie and \
+                                now - running_battle.start_time > self.max_battle_seconds:
+                            self._writeChunk(running_battle.battle_id, running_battle.force_tie('time_limit'))
+            except SimHangError as ex:
+                # どのバトルが原因か特定できず、やり直しても再発しうるので、進行中のバトルは全て引き分けとする
+                logger.warning(f"{ex}, restarting and discarding {len(running)} battles")
+                self._stop_process()
+                self.n_restart += 1
+                for spec_idx, battle in running.values():
+                    battle.abort()
+                    results[spec_idx] = {'winner': '', 'turns': battle.turn, 'seed': battle.seed,
+                                         'end_reason': 'sim_hang'}
+                    if record_chunks:
+                        results[spec_idx]['chunks'] = battle.chunk_log
+                running = {}
+                self._prepare_process()
+            except SIM_CRASH_ERRORS as ex:
+                logger.warning(f"simulator crashed ({ex!r}), restarting and retrying {len(running)} battles")
+                self._stop_process()
+                self.n_restart += 1
+                retry_idxs = []
+                for spec_idx, battle in running.values():
+                    battle.abort()
+                    retries[spec_idx] += 1
+                    if retries[spec_idx] > self.max_retries:
+                        raise RuntimeError(f"battle failed {retries[spec_idx]} times by simulator crash") from ex
+                    retry_idxs.append(spec_idx)
+                running = {}
+                pending.extendleft(sorted(retry_idxs, reverse=True))
+                self._prepare_process()
+
+
+def replay(seed: List[int], parties: List[Party], policies: List[ActionPolicy], sim: Optional[Sim] = None) \
+        -> Tuple[dict, List[Tuple[str, str]]]:
+    """
+    乱数シードを指定してバトルを行い、受け取ったchunkを記録する
+    同じシード・パーティ・方策(方策が内部状態を持たない場合)であれば、同じchunkの列が再現される
+    :param seed: バトルの乱数シード。以前のバトルのendメッセージの'seed'
+    :param parties:
+    :param policies:
+    :param sim: 用いるシミュレータ。Noneの場合新たに起動する
+    :return: endメッセージの内容, chunk(種類, 内容)のリスト
+    """
+    if sim is None:
+        sim = Sim()
+    processors = []
+    for policy in policies:
+        processor = BattleStreamProcessor()
+        processor.set_policy(policy)
+        processors.append(processor)
+    result = sim.run_multi([BattleSpec(parties, processors, seed)], record_chunks=True)[0]
+    return result, result.pop('chunks')
@@ -0,0 +1,222 @@
+"""
+シミュレータ(node)プロセスを事前に起動しておくデーモン
+Pokemon-Showdownの読み込みには数秒かかるため、短いジョブを多数実行する場合は起動済みのプロセスを使い回す
+
+デーモンの起動
+python -m pokeai.sim.sim_daemon --socket /tmp/pokeai_sim.sock
+
+環境変数 POKEAI_SIM_DAEMON にソケットのパスを設定すると、SimやSimUtilはデーモンから起動済みのプロセスを受け取る
+(プロセスの標準入出力のファイルディスクリプタをUnixソケット経由で受け渡す)
+デーモンに接続できない場合は、通常通り自身でプロセスを起動する
+"""
+import argparse
+import array
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import time
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+
+from pokeai.util import ROOT_DIR
+
+logger = getLogger(__name__)
+
+DAEMON_SOCKET_ENV = 'POKEAI_SIM_DAEMON'
+# デーモンが起動しておくスクリプトと引数の組み合わせ
+WARM_COMMANDS = [('js/simpipe',), ('js/simpipe', '--binary'), ('js/simutil',)]
+
+
+class AttachedProcess:
+    """
+    デーモンから受け取ったプロセス
+    subprocess.Popenのうち、Sim, SimUtilが用いる機能を提供する
+    自身の子プロセスではないため、終了の検出はpidの存在確認で行う(デーモンが回収する)
+    """
+
+    def __init__(self, pid: int, stdin, stdout):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.returncode = None
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                # 終了コードは取得できない
+                self.returncode = 0
+        return self.returncode
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def wait(self, timeout: float = 10.0) -> Optional[int]:
+        deadline = time.time() + timeout
+        while self.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        return self.returncode
+
+
+def _send_fds(sock: socket.socket, data: bytes, fds: List[int]):
+    # socket.send_fdsはPython 3.9以降のため、sendmsgで同等の処理を行う
+    sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+
+def _recv_fds(sock: socket.socket, bufsize: int, maxfds: int) -> Tuple[bytes, List[int]]:
+    # socket.recv_fdsはPython 3.9以降のため、recvmsgで同等の処理を行う
+    fds = array.array('i')
+    msg, ancdata, _, _ = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    return msg, list(fds)
+
+
+def _attach(socket_path: str, command: Tuple[str, ...], encoding: Optional[str]) -> Optional[AttachedProcess]:
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall((json.dumps({'command': list(command)}) + '\n').encode('utf-8'))
+            msg, fds = _recv_fds(sock, 1024, 2)
+    except OSError as ex:
+        logger.warning(f"cannot attach to simulator daemon at {socket_path}: {ex!r}")
+        return None
+    if len(fds) != 2:
+        for fd in fds:
+            os.close(fd)
+        logger.warning(f"simulator daemon refused: {msg!r}")
+        return None
+    pid = json.loads(msg.decode('utf-8'))['pid']
+    stdin_fd, stdout_fd = fds
+    if encoding is not None:
+        stdin = os.fdopen(stdin_fd, 'w', encoding=encoding)
+        stdout = os.fdopen(stdout_fd, 'r', encoding=encoding)
+    else:
+        stdin = os.fdopen(stdin_fd, 'wb')
+        stdout = os.fdopen(stdout_fd, 'rb')
+    return AttachedProcess(pid, stdin, stdout)
+
+
+def start_node_process(script: str, args: Tuple[str, ...] = (), encoding: Optional[str] = None):
+    """
+    標準入出力で通信するnodeプロセスを起動する
+    環境変数でデーモンが指定されていれば、起動済みのプロセスを受け取る
+    :param script: ROOT_DIRからの相対パス ex. 'js/simpipe'
+    :param args: スクリプトへの引数
+    :param encoding: テキストモードの場合のエンコーディング。Noneの場合バイナリモード
+    :return: subprocess.PopenまたはAttachedProcess
+    """
+    command = (script,) + tuple(args)
+    socket_path = os.environ.get(DAEMON_SOCKET_ENV)
+    if socket_path:
+        proc = _attach(socket_path, command, encoding)
+        if proc is not None:
+            return proc
+    return subprocess.Popen(['node'] + list(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            encoding=encoding, cwd=str(ROOT_DIR))
+
+
+class SimDaemon:
+    """
+    起動済みのnodeプロセスを保持し、要求に応じて受け渡すデーモン
+    """
+    _warm: Dict[Tuple[str, ...], List[subprocess.Popen]]
+    _detached: List[subprocess.Popen]  # 受け渡し済みのプロセス。終了後に回収する
+
+    def __init__(self, socket_path: str, pool_size: int):
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self._warm = {command: [] for command in WARM_COMMANDS}
+        self._detached = []
+
+    def _spawn(self, command: Tuple[str, ...]) -> subprocess.Popen:
+        return subprocess.Popen(['node'] + list(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                cwd=str(ROOT_DIR))
+
+    def _refill(self):
+        for command, procs in self._warm.items():
+            # 待機中に異常終了したものは除く
+            alive = [proc for proc in procs if proc.poll() is None]
+            self._detached.extend(proc for proc in procs if proc.poll() is not None)
+            while len(alive) < self.pool_size:
+                alive.append(self._spawn(command))
+            self._warm[command] = alive
+
+    def _reap(self):
+        self._detached = [proc for proc in self._detached if proc.poll() is None]
+
+    def _handle(self, conn: socket.socket):
+        with conn:
+            request = b''
+            while not request.endswith(b'\n'):
+                data = conn.recv(4096)
+                if not data:
+                    return
+                request += data
+            command = tuple(json.loads(request.decode('utf-8'))['command'])
+            procs = self._warm.get(command)
+            if procs is None:
+                conn.sendall(json.dumps({'error': f'unknown command {command}'}).encode('utf-8'))
+                return
+            proc = procs.pop(0) if len(procs) > 0 else self._spawn(command)
+            _send_fds(conn, json.dumps({'pid': proc.pid}).encode('utf-8'),
+                      [proc.stdin.fileno(), proc.stdout.fileno()])
+            # 受け渡したので、このプロセス側のファイルは閉じる(クライアントが閉じるとnodeは終了する)
+            proc.stdin.close()
+            proc.stdout.close()
+            self._detached.append(proc)
+            logger.info(f"handed {' '.join(command)} (pid {proc.pid})")
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._refill()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(self.socket_path)
+            server.listen()
+            selector = selectors.DefaultSelector()
+            selector.register(server, selectors.EVENT_READ)
+            logger.info(f"simulator daemon listening on {self.socket_path}")
+            try:
+                while True:
+                    if selector.select(timeout=1.0):
+                        conn, _ = server.accept()
+                        try:
+                            self._handle(conn)
+                        except OSError as ex:
+                            logger.warning(f"failed to handle request: {ex!r}")
+                    self._refill()
+                    self._reap()
+            finally:
+                os.remove(self.socket_path)
+                for procs in self._warm.values():
+                    for proc in procs:
+                        proc.kill()
+
+
+def main():
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default=str(ROOT_DIR.joinpath('pokeai_sim.sock')))
+    parser.add_argument("--pool_size", type=int, default=2, help="スクリプトごとに起動しておくプロセス数")
+    args = parser.parse_args()
+    SimDaemon(args.socket, args.pool_size).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+シミュレータを持つワーカープロセス群によるバトルの並列実行
+各ワーカーは自身のSimと方策を持ち、キューからバトルのジョブを受け取って実行する
+"""
+import multiprocessing
+import queue
+import random
+import traceback
+from logging import getLogger
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from pokeai.ai.action_policy import ActionPolicy
+from pokeai.sim.battle_stream_processor import BattleStreamProcessor
+from pokeai.sim.party_generator import Party
+from pokeai.sim.sim import Sim, BattleSpec
+
+logger = getLogger(__name__)
+
+
+class BattleJob(NamedTuple):
+    parties: List[Party]
+    policy_specs: List[Any]  # 各プレイヤーの方策の指定。ワーカー内でpolicy_builderに与えられる。pickle可能であること
+    seed: Optional[int] = None  # ワーカー内の乱数シードおよびバトルの乱数シード(Noneの場合は設定しない)
+    collect_replay: bool = False  # 結果にreplay_collectorで取り出した各プレイヤーのリプレイを含める
+
+
+class BattleJobResult(NamedTuple):
+    winner: str  # 'p1', 'p2', '' (forcetieで引き分けの時)
+    turns: int
+    replay: Optional[List[Any]]  # collect_replay指定時、各プレイヤーのリプレイ
+    end_reason: str = 'normal'  # 'normal', 'turn_limit', 'time_limit', 'sim_hang'
+
+
+def _run_jobs(sim: Sim, jobs: List[BattleJob], policy_builder: Callable[[Any], ActionPolicy],
+              replay_collector: Optional[Callable[[ActionPolicy], Any]]) -> List[BattleJobResult]:
+    specs = []
+    policies_list = []
+    for job in jobs:
+        battle_seed = None
+        if job.seed is not None:
+            # 方策の構築に乱数を用いる場合に備えて標準のrandom, np.randomも設定する
+            random.seed(job.seed)
+            np.random.seed(job.seed)
+            battle_seed = [(job.seed >> (16 * i)) & 0xffff for i in range(4)]
+        bsps = []
+        policies = []
+        for policy_spec in job.policy_specs:
+            policy = policy_builder(policy_spec)
+            bsp = BattleStreamProcessor()
+            bsp.set_policy(policy)
+            bsps.append(bsp)
+            policies.append(policy)
+        specs.append(BattleSpec(job.parties, bsps, battle_seed))
+        policies_list.append(policies)
+    battle_results = sim.run_multi(specs)
+    results = []
+    for job, policies, battle_result in zip(jobs, policies_list, battle_results):
+        replay = None
+        if job.collect_replay:
+            replay = [replay_collector(policy) for policy in policies]
+        results.append(BattleJobResult(battle_result['winner'], battle_result['turns'], replay,
+                                       battle_result.get('end_reason', 'normal')))
+    return results
+
+
+def _worker_main(job_queue, result_queue, policy_builder, replay_collector, initializer, initargs: tuple,
+                 battles_per_worker: int, sim_kwargs: Dict[str, Any]):
+    if initializer is not None:
+        initializer(*initargs)
+    sim = Sim(**sim_kwargs)
+    while True:
+        item = job_queue.get()
+        if item is None:
+            break
+        items = [item]
+        # 1つのシミュレータで複数のバトルを並行して進める
+        while len(items) < battles_per_worker:
+            try:
+                item = job_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # 終了指示は他のワーカーのために戻す
+                job_queue.put(None)
+                break
+            items.append(item)
+        job_idxs = [job_idx for job_idx, _ in items]
+        try:
+            results = _run_jobs(sim, [job for _, job in items], policy_builder, replay_collector)
+        except Exception:
+            for job_idx in job_idxs:
+                result_queue.put((job_idx, None, traceback.format_exc()))
+            # シミュレータの状態が不明なので作り直す
+            sim = Sim(**sim_kwargs)
+            continue
+        for job_idx, result in zip(job_idxs, results):
+            result_queue.put((job_idx, result, None))
+
+
+class SimPool:
+    """
+    バトルを並列に実行するワーカープロセス群
+    方策はpickle可能な指定(policy spec)で渡し、ワーカー内でpolicy_builderにより構築する
+    """
+
+    def __init__(self, n_workers: int, policy_builder: Callable[[Any], ActionPolicy],
+                 replay_collector: Optional[Callable[[ActionPolicy], Any]] = None,
+                 initializer: Optional[Callable[..., None]] = None, initargs: tuple = (),
+                 battles_per_worker: int = 1, sim_kwargs: Optional[Dict[str, Any]] = None):
+        """
+        ワーカープロセスを起動する
+        :param n_workers: ワーカープロセス数
+        :param policy_builder: policy specから方策を生成する関数。モジュールレベルで定義されていること。
+        バトルごとに呼ばれるため、重い資源(モデル等)は関数内でキャッシュすること。
+        :param replay_collector: バトル終了後の方策からリプレイを取り出す関数。モジュールレベルで定義されていること。
+        :param initializer: ワーカー起動時に呼ばれる関数(torchの勾配計算の無効化など)。モジュールレベルで定義されていること。
+        :param initargs: initializerの引数。ワーカー起動時に1回だけ送られるので、全ジョブで使う大きなもの(共有メモリ上のモデル等)を渡す
+        :param battles_per_worker: 各ワーカーが1つのシミュレータで同時に進行させるバトル数
+        :param sim_kwargs: ワーカー内のSimの引数(max_turns, max_battle_seconds, read_timeoutなど)。
+        Noneの場合、応答しないシミュレータでワーカーが停止しないようread_timeoutのみ設定する
+        """
+        if sim_kwargs is None:
+            sim_kwargs = {'read_timeout': 60.0}
+        # torchを使うためforkではなくspawnを用いる
+        ctx = multiprocessing.get_context("spawn")
+        self._job_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+        self._workers = []
+        for _ in range(n_workers):
+            worker = ctx.Process(target=_worker_main,
+                                 args=(self._job_queue, self._result_queue, policy_builder, replay_collector,
+                                       initializer, initargs, battles_per_worker, sim_kwargs),
+                                 daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def run(self, jobs: List[BattleJob]) -> List[BattleJobResult]:
+        """
+        バトルを並列に実行する
+        :param jobs:
+        :return: jobsと同じ順序の結果
+        """
+        for job_idx, job in enumerate(jobs):
+            self._job_queue.put((job_idx, job))
+        results = [None] * len(jobs)  # type: List[Optional[BattleJobResult]]
+        errors = []
+        for _ in range(len(jobs)):
+            while True:
+                try:
+                    job_idx, result, error = self._result_queue.get(timeout=5.0)
+                    break
+                except queue.Empty:
+                    # ワーカーが異常終了していると結果が返らず停止するので検出する
+                    dead = [worker.pid for worker in self._workers if not worker.is_alive()]
+                    if len(dead) > 0:
+                        raise RuntimeError(f"worker processes {dead} exited unexpectedly")
+            if error is not None:
+                errors.append(error)
+            results[job_idx] = result
+        if len(errors) > 0:
+            raise RuntimeError(f"{len(errors)} battle jobs failed in workers:\n" + errors[0])
+        return results
+
+    def close(self):
+        for _ in self._workers:
+            self._job_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,6 +1,5 @@
-import subprocess
 import json
-from pokeai.util import ROOT_DIR
+from pokeai.sim.sim_daemon import start_node_process
 
 
 class SimUtilError(Exception):
@@ -12,13 +11,18 @@ class SimUtilError(Exception):
 class SimUtil:
     """
     シミュレータの付属機能呼び出し
+    プロセスは最初の呼び出し時に起動する
     """
 
     def __init__(self):
-        self.proc = subprocess.Popen(['node', 'js/simutil'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                     encoding='utf-8', cwd=str(ROOT_DIR))
+        self.proc = None
+
+    def _ensure_process(self):
+        if self.proc is None:
+            self.proc = start_node_process('js/simutil', encoding='utf-8')
 
     def call(self, method: str, params):
+        self._ensure_process()
         self.proc.stdin.write(json.dumps({'method': method, 'params': params}) + '\n')
         self.proc.stdin.flush()
         result = json.loads(self.proc.stdout.readline())
@@ -26,5 +30,25 @@ class SimUtil:
             raise SimUtilError(result['error'])
         return result['result']
 
+    def call_batch(self, method: str, params_list: list) -> list:
+        """
+        同じメソッドを複数のparamsについて1回の通信で呼び出す
+        :param method:
+        :param params_list:
+        :return: params_listと同じ順序の結果
+        """
+        self._ensure_process()
+        self.proc.stdin.write(json.dumps({'method': method, 'params_list': params_list}) + '\n')
+        self.proc.stdin.flush()
+        response = json.loads(self.proc.stdout.readline())
+        if response['error'] is not None:
+            raise SimUtilError(response['error'])
+        results = []
+        for result in response['result']:
+            if result['error'] is not None:
+                raise SimUtilError(result['error'])
+            results.append(result['result'])
+        return results
+
 
 sim_util = SimUtil()
@@ -1,10 +1,69 @@
-from typing import Optional, List
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, List, Union
+
+from pokeai.sim.pack_team import party_hash
 from pokeai.sim.simutil import sim_util
+from pokeai.util import json_load, json_dump
 
 
 class TeamValidator:
+    """
+    パーティの正当性の検証
+    結果はパーティの内容のハッシュ値をキーとしてLRUキャッシュし、ファイルに保存することもできる
+    """
+    _cache: OrderedDict
+
+    def __init__(self, cache_size: int = 100000, cache_path: Optional[Union[str, Path]] = None):
+        """
+        :param cache_size: キャッシュするパーティ数の上限
+        :param cache_path: キャッシュを保存するjsonファイル。存在すれば読み込む。Noneの場合メモリ上のみ
+        """
+        self.cache_size = cache_size
+        self.cache_path = Path(cache_path) if cache_path is not None else None
+        self._cache = OrderedDict()
+        if self.cache_path is not None and self.cache_path.exists():
+            self._cache.update(json_load(self.cache_path))
+
+    def _cache_put(self, key: str, result: Optional[List[str]]):
+        self._cache[key] = result
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
     def validate(self, party) -> Optional[List[str]]:
-        return sim_util.call('validateTeam', {'party': party})
+        """
+        パーティを検証する
+        :param party:
+        :return: 正当ならNone、不正なら理由を列挙したリスト
+        """
+        return self.validate_many([party])[0]
+
+    def validate_many(self, parties: list) -> List[Optional[List[str]]]:
+        """
+        複数のパーティを検証する。キャッシュにないものはシミュレータへ1回の通信でまとめて問い合わせる
+        :param parties:
+        :return: partiesと同じ順序の検証結果
+        """
+        keys = [party_hash(party) for party in parties]
+        results = {}
+        miss_parties = {}
+        for key, party in zip(keys, parties):
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                results[key] = self._cache[key]
+            else:
+                miss_parties[key] = party
+        if len(miss_parties) > 0:
+            miss_results = sim_util.call_batch('validateTeam', [{'party': party} for party in miss_parties.values()])
+            for key, result in zip(miss_parties.keys(), miss_results):
+                results[key] = result
+                self._cache_put(key, result)
+        return [results[key] for key in keys]
+
+    def save_cache(self):
+        if self.cache_path is not None:
+            json_dump(self._cache, self.cache_path)
 
 
 def demo():
@@ -0,0 +1,126 @@
+"""
+処理段階ごとの所要時間の計測
+計測は既定で無効。enable()で有効にすると、段階ごとに所要時間のヒストグラム(2のべき乗のバケット)を記録する
+
+使用例
+t = stage_timer.start()
+...処理...
+stage_timer.stop("sim.read", t)
+
+無効時はstart, stopとも変数の参照のみで、計測のための時刻取得は行わない
+計測結果はプロセスごとに記録される(SimPoolのワーカー内の処理は含まれない)
+"""
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Union
+
+enabled = False
+
+
+class StageHistogram:
+    """
+    1つの段階の所要時間のヒストグラム
+    counts[i]は所要時間(ナノ秒)のビット長がiであった回数(2^(i-1) <= t < 2^i)
+    """
+    __slots__ = ['count', 'total_ns', 'max_ns', 'counts']
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.counts = [0] * 64
+
+    def add(self, elapsed_ns: int):
+        self.count += 1
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+        self.counts[min(elapsed_ns.bit_length(), 63)] += 1
+
+    def percentile_us(self, q: float) -> float:
+        # バケットの上端で近似する
+        threshold = self.count * q
+        cumsum = 0
+        for i, c in enumerate(self.counts):
+            cumsum += c
+            if cumsum >= threshold:
+                return (1 << i) / 1000
+        return self.max_ns / 1000
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "total_sec": self.total_ns / 1e9,
+            "mean_us": self.total_ns / self.count / 1000 if self.count > 0 else 0.0,
+            "p50_us": self.percentile_us(0.5),
+            "p90_us": self.percentile_us(0.9),
+            "p99_us": self.percentile_us(0.99),
+            "max_us": self.max_ns / 1000,
+            # バケットの上端(マイクロ秒) => 回数
+            "histogram": {str((1 << i) / 1000): c for i, c in enumerate(self.counts) if c > 0},
+        }
+
+
+_histograms = {}  # type: Dict[str, StageHistogram]
+
+
+def enable(flag: bool = True):
+    global enabled
+    enabled = flag
+
+
+def start() -> int:
+    """
+    計測開始
+    :return: 開始時刻。無効時は0
+    """
+    if enabled:
+        return time.perf_counter_ns()
+    return 0
+
+
+def stop(stage: str, start_ns: int):
+    """
+    計測終了
+    :param stage: 段階名
+    :param start_ns: startの戻り値
+    :return:
+    """
+    if enabled and start_ns:
+        elapsed_ns = time.perf_counter_ns() - start_ns
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = StageHistogram()
+        histogram.add(elapsed_ns)
+
+
+def summary() -> Dict[str, dict]:
+    return {stage: histogram.summary() for stage, histogram in sorted(_histograms.items())}
+
+
+def reset():
+    _histograms.clear()
+
+
+def dump(path: Union[str, Path], extra: dict = None):
+    """
+    計測結果をjsonファイルに書き出す
+    :param path:
+    :param extra: 結果に付加する情報(バトル数など)
+    :return:
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(dict(extra or {}, stages=summary()), f, indent=2)
+
+
+def format_summary() -> List[str]:
+    """
+    計測結果を人が読む形式で整形する
+    :return: 段階ごとの行
+    """
+    lines = []
+    for stage, s in summary().items():
+        lines.append(f"{stage}: count={s['count']} total={s['total_sec']:.3f}s mean={s['mean_us']:.1f}us "
+                     f"p50={s['p50_us']:.1f}us p99={s['p99_us']:.1f}us")
+    return lines